@@ -13,12 +13,16 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+from threading import Lock
 
 
 class CacheDict:
     def __init__(self, capacity):
         self.capacity = capacity
         self.values = collections.OrderedDict()
+        # whether anything has been set or deleted since this was last
+        # saved; get() only reorders, which isn't worth saving for
+        self.dirty = False
 
     def __contains__(self, item):
         return item in self.values
@@ -40,15 +44,60 @@ class CacheDict:
             if len(self.values) >= self.capacity:
                 self.values.popitem(last=False)
         self.values[key] = value
+        self.dirty = True
 
     def delete(self, key):
         try:
             del self.values[key]
+            self.dirty = True
         except KeyError:
             pass
 
+    def delete_prefix(self, prefix):
+        for key in [key for key in self.values if key.startswith(prefix)]:
+            del self.values[key]
+            self.dirty = True
+
+    def clear(self):
+        if self.values:
+            self.values.clear()
+            self.dirty = True
+
     def __setitem__(self, key, value):
         return self.set(key, value)
 
     def __getitem__(self, item):
         return self.get(item, None)
+
+
+class SharedCacheDict(CacheDict):
+    """
+    A CacheDict which may be used by many threads at once.
+    """
+    def __init__(self, capacity):
+        super(SharedCacheDict, self).__init__(capacity)
+        self.lock = Lock()
+
+    def __contains__(self, item):
+        with self.lock:
+            return super(SharedCacheDict, self).__contains__(item)
+
+    def get(self, key, default):
+        with self.lock:
+            return super(SharedCacheDict, self).get(key, default)
+
+    def set(self, key, value):
+        with self.lock:
+            super(SharedCacheDict, self).set(key, value)
+
+    def delete(self, key):
+        with self.lock:
+            super(SharedCacheDict, self).delete(key)
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            super(SharedCacheDict, self).delete_prefix(prefix)
+
+    def clear(self):
+        with self.lock:
+            super(SharedCacheDict, self).clear()
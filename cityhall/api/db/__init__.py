@@ -13,6 +13,9 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from abc import abstractmethod
+from heapq import nsmallest
+from threading import Lock
+from api.cache import SharedCacheDict
 
 
 class DbState(object):
@@ -30,6 +33,55 @@ class Rights(object):
     Grant = 4
 
 
+# what Db.get_children_page() can return for each child
+CHILD_FIELDS = ('id', 'name', 'override', 'value', 'protect')
+
+# what Env.get_children_page() can return for each child: CHILD_FIELDS, and
+# its path
+CHILD_RESPONSE_FIELDS = ('name', 'id', 'override', 'path', 'value', 'protect')
+
+
+def write_target(write):
+    """
+    The id of the value a write of Db.set_many() changes, or of the value it
+    creates one under, or None if that is created by the same batch.
+    """
+    if write['id'] is not None:
+        return write['id']
+    if isinstance(write['parent'], dict):
+        return None
+    return write['parent']
+
+
+def history_page(versions, since=None, until=None, after=None, limit=None):
+    """
+    Takes one page of history out of versions, an iterable of them sorted
+    oldest first, see Db.get_history_page().
+    """
+    page = []
+    last, seen = after if after else (None, 0)
+    skip = seen
+
+    for version in versions:
+        when = version['datetime']
+        if (since is not None and when < since) or \
+                (last is not None and when < last):
+            continue
+        if until is not None and when >= until:
+            break
+        if skip and when == last:
+            skip -= 1
+            continue
+        if limit is not None and len(page) == limit:
+            return page, (last, seen)
+
+        page.append(version)
+        seen = seen + 1 if when == last else 1
+        last = when
+
+    return page, None
+
+
 class DbFactory(object):
     """
     This class is the factory which will create light-weight Db classes which
@@ -38,6 +90,37 @@ class DbFactory(object):
     def __init__(self, settings):
         assert isinstance(settings, dict)
         self.settings = settings
+        self.env_caches = {}
+        self.env_caches_lock = Lock()
+        # root id -> how many times the environment has been written to
+        self.env_versions = {}
+
+    def get_env_cache(self, kind, root_id):
+        """
+        A cache of the environment with the given root, which every Env of
+        this process shares.  Its capacity is the '<kind>_capacity' cache
+        setting.
+
+        :param kind: which cache: 'path' for path -> index, 'missing' for
+         the paths known not to exist, or 'value' for resolved values
+        """
+        with self.env_caches_lock:
+            cache = self.env_caches.get((kind, root_id), None)
+            if cache is None:
+                cache = SharedCacheDict(self.settings['cache'][f'{kind}_capacity'])
+                self.env_caches[(kind, root_id)] = cache
+            return cache
+
+    def get_env_version(self, root_id):
+        return self.env_versions.get(root_id, 0)
+
+    def bump_env_version(self, root_id):
+        """
+        Marks everything cached of the environment with the given root as
+        out of date, see get_env_version().
+        """
+        with self.env_caches_lock:
+            self.env_versions[root_id] = self.env_versions.get(root_id, 0) + 1
 
     @abstractmethod
     def open(self):
@@ -78,6 +161,31 @@ class Db(object):
             return self.parent.settings[key][subkey]
         return self.parent.settings[key]
 
+    def get_env_cache(self, kind, root_id):
+        return self.parent.get_env_cache(kind, root_id)
+
+    def get_env_version(self, root_id):
+        return self.parent.get_env_version(root_id)
+
+    def bump_env_version(self, root_id):
+        self.parent.bump_env_version(root_id)
+
+    def on_commit(self, func):
+        """
+        Calls func once what has been written so far can be seen by others,
+        so that nothing which may yet be rolled back is cached.  Dbs with
+        transactions should override this.
+        """
+        func()
+
+    def reads_are_current(self):
+        """
+        Whether what is read now sees every committed write, and so may be
+        cached for everyone.  Dbs which may read from a replica which is
+        behind should override this.
+        """
+        return True
+
     @abstractmethod
     def create_root(self, author, env):
         pass
@@ -86,12 +194,78 @@ class Db(object):
     def get_children_of(self, index):
         pass
 
+    def get_children_page(self, index, after=None, limit=None, fields=None,
+                          protected=True):
+        """
+        Returns the children of index sorted by (name, override), one page
+        at a time.  Dbs which can do better than get_children_of() should
+        override this.
+
+        :param after: the (name, override) of the last child of the previous
+         page, or None for the first page
+        :param limit: the most children to return, or None for all of them
+        :param fields: which of CHILD_FIELDS to return, or None for all
+        :param protected: whether to include protected children
+        """
+        fields = fields or CHILD_FIELDS
+        after = None if after is None else tuple(after)
+        children = [
+            child for child in self.get_children_of(index)
+            if (protected or not child['protect']) and
+            (after is None or (child['name'], child['override']) > after)
+        ]
+        key = lambda child: (child['name'], child['override'])
+        children = sorted(children, key=key) if limit is None else \
+            nsmallest(limit, children, key=key)
+        return [{field: child[field] for field in fields} for child in children]
+
+    def get_subtree(self, index, depth=None, protected=True):
+        """
+        Returns everything under index, down to the given depth (children
+        are at depth 1), as one flat list.  Only global values have
+        children.  Dbs which can do better than calling get_children_of()
+        for every value should override this.
+
+        :param depth: how many levels to go down, or None for all of them
+        :param protected: whether to include protected values; if not, what
+         is under a protected value is left out as well
+        :return: dicts with the id, parent, name, override, value, protect
+         and depth of each value
+        """
+        tree = []
+        level = [index]
+        current = 1
+
+        while level and (depth is None or current <= depth):
+            below = []
+            for parent in level:
+                for child in self.get_children_of(parent):
+                    if not protected and child['protect']:
+                        continue
+                    tree.append({
+                        'id': child['id'], 'parent': parent,
+                        'name': child['name'], 'override': child['override'],
+                        'value': child['value'], 'protect': child['protect'],
+                        'depth': current,
+                    })
+                    if child['override'] == '':
+                        below.append(child['id'])
+            level = below
+            current += 1
+
+        return tree
+
     @abstractmethod
     def update(self, user, index, value):
         pass
 
     @abstractmethod
     def create(self, user, parent, name, value, override=''):
+        """
+        :return: the id of the created value, or None if there already is
+         an active value with that parent, name and override, which dbs
+         that can tell under their write lock should refuse to duplicate
+        """
         pass
 
     @abstractmethod
@@ -110,6 +284,26 @@ class Db(object):
     def get_history(self, index):
         pass
 
+    def get_history_page(self, index, since=None, until=None, after=None,
+                         limit=None):
+        """
+        Like get_history(), oldest first, between two times and one page at
+        a time.  Dbs which can do better than sorting all of get_history()
+        should override this.
+
+        :param since: leave out versions from before this datetime
+        :param until: leave out versions from this datetime on
+        :param after: the cursor returned with the previous page, or None
+        :param limit: the most versions to return, or None for all of them
+        :return: the versions, and the cursor of the next page (None if this
+         is the last one): the datetime of the last version in the page, and
+         how many versions of that datetime have been returned so far
+        """
+        history = sorted(
+            self.get_history(index), key=lambda version: version['datetime']
+        )
+        return history_page(history, since, until, after, limit)
+
     @abstractmethod
     def delete(self, author, index):
         pass
@@ -137,3 +331,91 @@ class Db(object):
     @abstractmethod
     def get_child(self, parent, name, override=''):
         pass
+
+    def get_path_index(self, root_id, names, override=''):
+        """
+        Resolves a whole path in one go, for dbs that can do better than
+        walking it with get_children_of() one level at a time.
+
+        :param root_id: the id of the environment root to start from
+        :param names: the names along the path, e.g. ['a', 'b'] for /a/b/
+        :param override: the override of the last item in the path
+        :return: the id of the value, -1 if it doesn't exist, or None if
+         this db doesn't support resolving whole paths
+        """
+        return None
+
+    def get_value_by_path(self, root_id, names, override, fallback=True):
+        """
+        Looks up a value by its whole path, like get_value_for() does by
+        parent and name.
+
+        :param fallback: if the value has no such override, whether to
+         return its global ('') value instead
+        :return: (value, protect), (None, None) if the value doesn't exist,
+         or None if this db doesn't support looking up whole paths
+        """
+        return None
+
+    def set_many(self, author, writes):
+        """
+        Applies a batch of writes, in order and all together.  Dbs which can
+        do better than one call per write should override this.
+
+        :param writes: a list of dicts, each with:
+            id: the id of the value to change, or None to create one, in
+             which case it is filled in with the id of the created value
+            parent, name, override: where to create the value; parent may
+             also be an earlier write in the list, if it creates the parent
+            value: the new value, or None to leave it as is
+            protect: the new protect status, or None to leave it as is
+        :return: the writes whose value (or the parent they create one
+         under) was deleted since the batch was planned, in which case
+         nothing was written
+        """
+        gone = set(
+            index for index in set(map(write_target, writes)) - {None}
+            if self.get_value(index) == (None, None)
+        )
+        failed = [write for write in writes if write_target(write) in gone]
+        if failed:
+            return failed
+
+        for write in writes:
+            if write['id'] is None:
+                parent = write['parent']
+                if isinstance(parent, dict):
+                    parent = parent['id']
+                write['id'] = self.create(
+                    author, parent, write['name'],
+                    '' if write['value'] is None else write['value'],
+                    write['override'],
+                )
+                if write['id'] is not None:
+                    if write['protect']:
+                        self.set_protect_status(author, write['id'], True)
+                    continue
+
+                # created by someone else since the batch was planned, so
+                # it is changed instead
+                write['id'] = self.get_child(
+                    parent, write['name'], write['override']
+                )['id']
+
+            if write['value'] is not None:
+                self.update(author, write['id'], write['value'])
+            if write['protect'] is not None:
+                self.set_protect_status(author, write['id'], write['protect'])
+        return []
+
+    @abstractmethod
+    def compact_history(self, keep_versions, keep_days, batch_size):
+        """
+        Deletes at most batch_size inactive versions which are either older
+        than keep_days or not among the newest keep_versions versions of
+        their id (None disables either rule).  The newest version of an id
+        is always kept.
+
+        :return: the number of versions deleted
+        """
+        pass
@@ -26,18 +26,56 @@ class Auth(object):
         )
         self.user_root = user_root
         self.users_env = None
+        # whether this has changed since it was last kept in the session,
+        # see api.session.end_request()
+        self.changed = True
+
+    @property
+    def dirty(self):
+        # Envs are never changed once created, only added to or dropped
+        # from roots_cache
+        return self.changed or self.roots_cache.dirty
+
+    def mark_clean(self):
+        self.changed = False
+        self.roots_cache.dirty = False
 
     def _ensure_users_env(self):
         if self.users_env is None:
             self.users_env = self.db.get_env_root('users')
+            self.changed = True
+
+    def _users_changed(self):
+        # users and their rights are values of the users environment, so
+        # what Envs have cached of it is out of date
+        self._ensure_users_env()
+        self.db.bump_env_version(self.users_env)
+        self.db.get_env_cache('missing', self.users_env).clear()
+        # a user who is deleted and created again gets a new folder
+        self.db.get_env_cache('path', self.users_env).clear()
 
     def create_env(self, env):
         if self.db.create_root(self.name, env):
-            return self.db.create(self.name, self.user_root, env, Rights.Grant)
+            created = self.db.create(self.name, self.user_root, env, Rights.Grant)
+            self._users_changed()
+            return created
         return False
 
-    def get_env(self, env):
+    def cached_env(self, env):
+        """
+        The Env in roots_cache for env, or None.  Envs read back from the
+        session are only decoded here, when first asked for, see
+        api.session.serialize.SerializedEnv.
+        """
         cached = self.roots_cache.get(env, None)
+        if cached is not None and not isinstance(cached, Env):
+            cached = cached.load(self.db)
+            # the session already holds it, so this doesn't make it dirty
+            self.roots_cache.values[env] = cached
+        return cached
+
+    def get_env(self, env):
+        cached = self.cached_env(env)
 
         if not cached:
             root_id = self.db.get_env_root(env)
@@ -56,6 +94,7 @@ class Auth(object):
         if not exists:
             user_root = self.db.create(self.name, self.users_env, user, '')
             self.db.create_user(self.name, user, passhash, user_root)
+            self._users_changed()
 
     def update_user(self, user, passhash):
         self._ensure_users_env()
@@ -66,6 +105,7 @@ class Auth(object):
             self.db.delete(self.name, right['id'])
         self.db.delete(self.name, delete_root['id'])
         self.db.delete_user(self.name, delete)
+        self._users_changed()
 
     def delete_user(self, delete):
         self._ensure_users_env()
@@ -104,7 +144,7 @@ class Auth(object):
 
     def get_permissions(self, env):
         if env in self.roots_cache:
-            return self.roots_cache[env].permissions
+            return self.cached_env(env).permissions
 
         rights = self.db.get_child(self.user_root, env)
         if rights:
@@ -128,6 +168,7 @@ class Auth(object):
 
             if not existing:
                 self.db.create(self.name, user_folder['id'], env, rights)
+                self._users_changed()
                 return (
                     'Ok',
                     f"Rights for '{user}' created",
@@ -140,6 +181,7 @@ class Auth(object):
                 )
             else:
                 self.db.update(self.name, existing['id'], rights)
+                self._users_changed()
                 return (
                     'Ok',
                     f"Rights for '{user}' updated",
@@ -0,0 +1,93 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from threading import Event, Thread
+from django.db import close_old_connections
+
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryCompactor(Thread):
+    """
+    Background thread which prunes old versions of values, following the
+    'history' retention policy of CITY_HALL_OPTIONS.
+
+    Every `interval` seconds, it asks the db to compact its history in
+    batches of `batch_size` versions, until a batch comes back short.  Each
+    batch is its own (short) transaction or lock, so requests are never held
+    up for more than one batch.
+    """
+    def __init__(self, db_factory, options):
+        super(HistoryCompactor, self).__init__(daemon=True)
+        self.db_factory = db_factory
+        self.keep_versions = options.get('keep_versions', None)
+        self.keep_days = options.get('keep_days', None)
+        self.batch_size = options.get('batch_size', 1000)
+        self.interval = options.get('interval', 60)
+        self.reclaimed = 0
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.compact()
+            except Exception:
+                logger.exception('Failed to compact history')
+            finally:
+                close_old_connections()
+
+    def compact(self):
+        """
+        Runs batches until there is nothing left to prune.
+
+        :return: the number of versions pruned
+        """
+        db = self.db_factory.get_db()
+        reclaimed = 0
+
+        while True:
+            pruned = db.compact_history(
+                self.keep_versions, self.keep_days, self.batch_size
+            )
+            reclaimed += pruned
+            if pruned < self.batch_size:
+                break
+
+        self.reclaimed += reclaimed
+        logger.info(
+            f'History compaction reclaimed {reclaimed} versions '
+            f'({self.reclaimed} since start)'
+        )
+        return reclaimed
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_history_compactor(db_factory, options):
+    """
+    Starts a HistoryCompactor if the given 'history' options ask for any
+    retention at all.
+
+    :return: the running compactor, or None
+    """
+    if options.get('keep_versions', None) is None and \
+            options.get('keep_days', None) is None:
+        return None
+
+    compactor = HistoryCompactor(db_factory, options)
+    compactor.start()
+    return compactor
@@ -14,6 +14,7 @@
 
 import sys
 from api.db.auth import Auth
+from api.db.compactor import start_history_compactor
 from api.db.django.db_factory import Factory
 from api.db.memory.db_factory import CityHallDbFactory
 
@@ -62,3 +63,7 @@ def get_new_db():
 
 Instance = Connection(get_new_db())
 Instance.connect()
+Compactor = start_history_compactor(
+    Instance.db_connection,
+    sys.modules['django.conf'].settings.CITY_HALL_OPTIONS.get('history', {})
+)
@@ -12,7 +12,9 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from django.db import transaction
 from api.db.django.environments import Environments
+from api.db.django.router import reads_from_primary
 from api.db.django.users import Users
 from api.db.django.values import Values
 from api.db import Db as AbstractDb
@@ -21,3 +23,9 @@ from api.db import Db as AbstractDb
 class Db(Environments, Users, Values, AbstractDb):
     def __init__(self, parent):
         AbstractDb.__init__(self, parent)
+
+    def on_commit(self, func):
+        transaction.on_commit(func)
+
+    def reads_are_current(self):
+        return reads_from_primary()
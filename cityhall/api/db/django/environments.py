@@ -14,12 +14,27 @@
 
 from django.db import transaction
 from django.db.models import ObjectDoesNotExist
+from api.db.django.router import primary
 from api.models import Value
 
 
+# Environment name -> root id, shared by every Db in this process.  Roots are
+# never deleted or renamed, so once a root is committed its entry stays valid.
+# Entries are only added after the transaction that read (or created) the
+# root commits, so a rolled back root is never remembered.
+_env_roots = {}
+
+
+def _remember_env_root(env, root_id):
+    transaction.on_commit(lambda: _env_roots.setdefault(env, root_id))
+
+
 class Environments(object):
+    @primary()
     @transaction.atomic
     def create_root(self, author, env):
+        _env_roots.pop(env, None)
+
         if self.get_env_root(env) < 0:
             root = Value()
             root.name = env
@@ -30,11 +45,19 @@ class Environments(object):
             root.protect = False
             root.parent = -1
             root.save()
+            _remember_env_root(env, root.id)
             return root.id
         return False
 
     def get_env_root(self, env):
+        root_id = _env_roots.get(env, None)
+        if root_id is not None:
+            return root_id
+
         try:
-            return Value.objects.get(active=True, parent=-1, name=env).id
+            root_id = Value.objects.get(active=True, parent=-1, name=env).id
         except ObjectDoesNotExist:
             return -1
+
+        _remember_env_root(env, root_id)
+        return root_id
@@ -0,0 +1,147 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+from threading import local
+from time import time
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+SESSION_PRIMARY_UNTIL = 'cityhall-primary-until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# what the current thread has been pinned to the primary by:
+#   depth: how many primary() blocks it is in
+#   until: the time() until which it stays pinned after its last write
+_pinned = local()
+
+
+def replica_options():
+    return settings.CITY_HALL_OPTIONS.get('replica', {})
+
+
+def pinned_to_primary():
+    return getattr(_pinned, 'depth', 0) > 0 or \
+        time() < getattr(_pinned, 'until', 0)
+
+
+def reads_from_primary():
+    """
+    Whether reads of the current thread go to the primary, i.e. see every
+    write which has been committed.
+    """
+    return replica_options().get('alias', None) is None or pinned_to_primary()
+
+
+@contextmanager
+def primary(sticky=True):
+    """
+    Sends the reads of the current thread to the primary while in the
+    block, so that a write never reads what it changes from a replica which
+    is behind.  If sticky, they keep going there for 'sticky_seconds' after
+    the block, so that the writer sees its own writes.  Can also be used as
+    a decorator.  Without a replica, there is nothing to do.
+    """
+    if replica_options().get('alias', None) is None:
+        yield
+        return
+
+    _pinned.depth = getattr(_pinned, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _pinned.depth -= 1
+        if sticky:
+            _pinned.until = max(
+                getattr(_pinned, 'until', 0),
+                time() + replica_options().get('sticky_seconds', 0),
+            )
+
+
+class ReplicaRouter(object):
+    """
+    Sends reads of City Hall's models to the replica named by
+    CITY_HALL_OPTIONS['replica']['alias'], unless the current thread is
+    pinned to the primary, and writes to the primary, i.e. 'default'.
+    Everything else (sessions, django's own tables) is left to 'default'.
+    """
+    @staticmethod
+    def _ours(model):
+        return model._meta.app_label == 'api'
+
+    def db_for_read(self, model, **hints):
+        if not self._ours(model):
+            return None
+
+        if reads_from_primary():
+            return DEFAULT_DB_ALIAS
+        return replica_options()['alias']
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS if self._ours(model) else None
+
+
+class StickyPrimaryMiddleware(object):
+    """
+    Keeps a session's reads on the primary for 'sticky_seconds' after it
+    last wrote, by carrying the pin of the thread serving it over in the
+    session.  Requests with a token don't use the session, so a cookie
+    carries it for them instead.  Requests which may write are served from
+    the primary throughout.  Without a replica, it does nothing, so that
+    the session isn't saved for it.  Must come after SessionMiddleware.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    @staticmethod
+    def _load(request, token):
+        if not token:
+            return request.session.get(SESSION_PRIMARY_UNTIL, 0)
+        try:
+            return float(request.COOKIES.get(SESSION_PRIMARY_UNTIL, 0))
+        except ValueError:
+            return 0
+
+    def __call__(self, request):
+        if replica_options().get('alias', None) is None:
+            return self.get_response(request)
+
+        from api.session import get_token
+        token = get_token(request) is not None
+        until = self._load(request, token)
+        _pinned.until = until
+        _pinned.depth = 0
+
+        try:
+            if request.method in SAFE_METHODS:
+                response = self.get_response(request)
+            else:
+                with primary(sticky=False):
+                    response = self.get_response(request)
+        finally:
+            wrote_until = _pinned.until
+            _pinned.until = 0
+
+        if token:
+            if wrote_until > until:
+                response.set_cookie(
+                    SESSION_PRIMARY_UNTIL, str(wrote_until),
+                    max_age=max(1, int(wrote_until - time()) + 1),
+                )
+        elif wrote_until > until:
+            request.session[SESSION_PRIMARY_UNTIL] = wrote_until
+        elif SESSION_PRIMARY_UNTIL in request.session and until <= time():
+            request.session.pop(SESSION_PRIMARY_UNTIL, None)
+        return response
@@ -14,6 +14,7 @@
 
 from copy import copy
 from django.db import transaction
+from api.db.django.router import primary
 from api.models import User
 
 
@@ -22,6 +23,7 @@ class Users(object):
         ret = User.objects.get_users_for_env(env)
         return {u.name: u.entry for u in ret}
 
+    @primary()
     def create_user(self, author, user, passhash, user_root):
         u = User()
         u.author = author
@@ -31,6 +33,7 @@ class Users(object):
         u.password = passhash
         u.save()
 
+    @primary()
     @transaction.atomic
     def delete_user(self, author, user):
         existing = User.objects.get(active=True, name=user)
@@ -42,6 +45,7 @@ class Users(object):
         new_value.author = author
         new_value.save()
 
+    @primary()
     @transaction.atomic
     def update_user(self, author, user, passhash):
         existing = User.objects.get(active=True, name=user)
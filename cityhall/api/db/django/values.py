@@ -12,10 +12,25 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import transaction
-from django.db.models import Q
-from copy import copy
-from api.models import Value
+from datetime import timedelta
+from heapq import merge
+from django.db import connections, router, transaction
+from django.db.models import Count, Exists, OuterRef, Q
+from django.utils import timezone
+from api.db import CHILD_FIELDS, Db, history_page, write_target
+from api.db.django.router import primary
+from api.models import Value, ValueHistory, child_value_path, value_path
+
+
+# how many versions of history are fetched from the database at a time
+HISTORY_CHUNK = 500
+
+
+def _aware(when):
+    # naive datetimes are taken to be in the current time zone
+    if when is not None and timezone.is_naive(when):
+        return timezone.make_aware(when)
+    return when
 
 
 class Values(object):
@@ -25,20 +40,10 @@ class Values(object):
             return ret.entry, ret.protect
         return None, None
 
-    @transaction.atomic
+    @primary()
+    @transaction.atomic(savepoint=False)
     def update(self, author, index, value):
-        existing = Value.objects.by_id(index)
-        existing.first_last = False
-        new_value = copy(existing)
-
-        existing.active = False
-        existing.save()
-
-        new_value.pk = None
-        new_value.author = author
-        new_value.entry = value
-        new_value.datetime = None
-        new_value.save()
+        Value.objects.supersede(index, author, entry=value)
 
     def get_children_of(self, index):
         return [
@@ -56,6 +61,107 @@ class Values(object):
             for child in Value.objects.children_of(index)
         ]
 
+    def get_children_page(self, index, after=None, limit=None, fields=None,
+                          protected=True):
+        """
+        Keyset pagination over the (active, parent, name, override) index,
+        fetching only the requested columns, without building models.
+        """
+        columns = [
+            'entry' if field == 'value' else field
+            for field in (fields or CHILD_FIELDS)
+        ]
+        children = Value.objects.\
+            filter(active=True, parent=index).\
+            order_by('name', 'override')
+
+        if not protected:
+            children = children.filter(protect=False)
+        if after is not None:
+            name, override = after
+            children = children.filter(
+                Q(name__gt=name) | Q(name=name, override__gt=override)
+            )
+        if limit is not None:
+            children = children[:limit]
+
+        renamed = {'entry': 'value'}
+        return [
+            {renamed.get(column, column): child[column] for column in columns}
+            for child in children.values(*columns)
+        ]
+
+    def get_subtree(self, index, depth=None, protected=True):
+        """
+        One recursive query, following only global values down, and leaving
+        protected values (and what is under them) out if asked to.
+        """
+        table = Value._meta.db_table
+        params = [True, index]
+        only_unprotected = ''
+        if not protected:
+            only_unprotected = 'AND {}protect = %s'
+            params.append(False)
+
+        params.append(True)
+        if not protected:
+            params.append(False)
+
+        depth_limit = ''
+        if depth is not None:
+            depth_limit = 'AND tree.depth < %s'
+            params.append(depth)
+
+        sql = f"""
+            WITH RECURSIVE tree(id, parent, name, override, entry, protect, depth) AS (
+                SELECT id, parent, name, override, entry, protect, 1
+                FROM {table}
+                WHERE active = %s AND parent = %s {only_unprotected.format('')}
+                UNION ALL
+                SELECT val.id, val.parent, val.name, val.override, val.entry,
+                    val.protect, tree.depth + 1
+                FROM {table} val
+                JOIN tree ON val.parent = tree.id AND tree.override = ''
+                WHERE val.active = %s {only_unprotected.format('val.')}
+                    {depth_limit}
+            )
+            SELECT id, parent, name, override, entry, protect, depth FROM tree
+        """
+
+        with connections[router.db_for_read(Value)].cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        columns = ('id', 'parent', 'name', 'override', 'value', 'protect', 'depth')
+        tree = [dict(zip(columns, row)) for row in rows]
+        for val in tree:
+            val['override'] = val['override'] or ''
+            val['protect'] = bool(val['protect'])
+        return tree
+
+    def get_path_index(self, root_id, names, override=''):
+        index = Value.objects.\
+            filter(active=True, path=value_path(root_id, names, override)).\
+            values_list('id', flat=True).\
+            first()
+        return -1 if index is None else index
+
+    def get_value_by_path(self, root_id, names, override, fallback=True):
+        paths = [value_path(root_id, names, override)]
+        if fallback and override:
+            paths.append(value_path(root_id, names, ''))
+
+        ret = None
+        protect = None
+
+        for item in Value.objects.filter(active=True, path__in=paths):
+            ret = item.entry
+            protect = item.protect
+
+            if item.override == override:
+                return ret, protect
+        return ret, protect
+
     def get_value_for(self, parent_index, name, override):
         ret = None
         protect = None
@@ -75,35 +181,25 @@ class Values(object):
             pass
         return ret, protect
 
-    @transaction.atomic
+    @primary()
+    @transaction.atomic(savepoint=False)
     def delete(self, author, index):
-        existing = Value.objects.by_id(index)
+        existing = Value.objects.lock(index)
 
-        existing.active = False
-        existing.save()
+        if existing:
+            Value.objects.archive([index], deleted_by=author)
+            if existing.path is not None and existing.override == '':
+                # the children of the value can no longer be reached, nor
+                # can theirs; its overrides are left alone
+                Value.objects.clear_paths_below(existing.path_prefix)
+            existing.delete()
 
-        new_value = copy(existing)
-        new_value.pk = None
-        new_value.datetime = None
-        new_value.author = author
-        new_value.first_last = True
-        new_value.save()
-
-    @transaction.atomic
+    @primary()
+    @transaction.atomic(savepoint=False)
     def set_protect_status(self, author, index, status):
-        existing = Value.objects.by_id(index)
-        new_value = copy(existing)
-
-        existing.active = False
-        existing.save()
-
-        new_value.pk = None
-        new_value.author = author
-        new_value.protect = status
-        new_value.datetime = None
-        new_value.first_last = False
-        new_value.save()
+        Value.objects.supersede(index, author, protect=status)
 
+    @primary()
     def create(self, user, parent, name, value, override=''):
         create = Value()
         create.active = True
@@ -117,24 +213,154 @@ class Values(object):
         create.save()
         return create.id
 
-    def get_history(self, index):
-        history = Value.objects.filter(id=index) | \
-            Value.objects.filter(Q(parent=index) & Q(first_last=True))
+    @primary()
+    @transaction.atomic(savepoint=False)
+    def set_many(self, author, writes):
+        """
+        Moves every changed value to the history with one INSERT, changes
+        them all with one bulk_update, and inserts every new value with one
+        bulk_create (Django splits either into several statements only
+        where the database limits the number of parameters).  On SQLite,
+        the write lock is taken first, so that the ids reserved for the new
+        values can't be taken by another writer; elsewhere, the values
+        written to are locked as they are read.
+        """
+        Value.objects.lock_for_writes()
+        if Value.objects.reserve_entry_ids(0) is None:
+            # Values is mixed into Db, but doesn't subclass it
+            return Db.set_many(self, author, writes)
 
-        return [
-            {
-                'id': child.id,
-                'name': child.name,
-                'override': child.override,
-                'author': child.author,
-                'datetime': child.datetime,
-                'value': child.entry,
-                'protect': child.protect,
-                'parent': child.parent,
-                'active': child.active
-            }
-            for child in history
+        existing = {
+            value.id: value for value in Value.objects.select_for_update().
+            filter(active=True, id__in=set(map(write_target, writes)) - {None})
+        }
+        failed = [
+            write for write in writes
+            if write_target(write) is not None and
+            write_target(write) not in existing
         ]
+        if failed:
+            return failed
+
+        created = [write for write in writes if write['id'] is None]
+        is_created = set(id(write) for write in created)
+        Value.objects.archive(list(set(
+            write['id'] for write in writes if id(write) not in is_created
+        )))
+        # every new value gets its entry_id up front, so they all go in one
+        # INSERT
+        entry_ids = iter(Value.objects.reserve_entry_ids(len(created)))
+        for write in created:
+            write['id'] = next(entry_ids)
+
+        # see child_value_path(); paths only lead through global values
+        parent_paths = {
+            write['parent']: existing[write['parent']].path
+            for write in created if not isinstance(write['parent'], dict) and
+            existing[write['parent']].override == ''
+        }
+
+        now = timezone.now()
+        changed = []
+        rows = []
+        for write in writes:
+            if id(write) not in is_created:
+                row = existing[write['id']]
+                row.author = author
+                row.datetime = now
+                row.first_last = False
+                row.entry = row.entry if write['value'] is None else write['value']
+                row.protect = row.protect if write['protect'] is None else write['protect']
+                changed.append(row)
+                continue
+
+            parent = write['parent']
+            if isinstance(parent, dict):
+                path = child_value_path(
+                    parent_paths.get(parent['id'], None), parent['override'],
+                    write['name'], write['override']
+                )
+                parent = parent['id']
+            else:
+                path = child_value_path(
+                    parent_paths.get(parent, None), '',
+                    write['name'], write['override']
+                )
+
+            parent_paths[write['id']] = path
+            rows.append(Value(
+                entry_id=write['id'], id=write['id'], active=True,
+                parent=parent, name=write['name'], override=write['override'],
+                author=author, protect=bool(write['protect']), first_last=True,
+                entry='' if write['value'] is None else write['value'],
+                path=path,
+            ))
+
+        Value.objects.bulk_update(
+            changed, ['author', 'datetime', 'first_last', 'entry', 'protect']
+        )
+        Value.objects.bulk_create(rows)
+        return []
+
+    def get_history(self, index):
+        return list(self._history(index))
+
+    def get_history_page(self, index, since=None, until=None, after=None,
+                         limit=None):
+        since, until = _aware(since), _aware(until)
+        if after is not None:
+            after = (_aware(after[0]), after[1])
+
+        # the page can't start before the cursor
+        start = since
+        if after is not None and (start is None or after[0] > start):
+            start = after[0]
+
+        return history_page(
+            self._history(index, start, until), since, until, after, limit
+        )
+
+    def _history(self, index, since=None, until=None):
+        """
+        The versions of the value and the first and last versions of its
+        children, oldest first, streamed from ValueHistory and the current
+        versions in chunks of HISTORY_CHUNK.  Both are read in order of the
+        (id, datetime) and (parent, first_last, datetime) indexes.
+        """
+        versions = Q(id=index) | Q(parent=index, first_last=True)
+        if since is not None:
+            versions &= Q(datetime__gte=since)
+        if until is not None:
+            versions &= Q(datetime__lt=until)
+
+        history = ValueHistory.objects.\
+            filter(versions).\
+            order_by('datetime', 'entry_id').\
+            iterator(chunk_size=HISTORY_CHUNK)
+        current = Value.objects.\
+            filter(versions, active=True).\
+            order_by('datetime', 'entry_id').\
+            iterator(chunk_size=HISTORY_CHUNK)
+
+        return merge(
+            (self._version(child, False) for child in history),
+            (self._version(child, True) for child in current),
+            key=lambda version: version['datetime'],
+        )
+
+    @staticmethod
+    def _version(child, active):
+        return {
+            'id': child.id,
+            'name': child.name,
+            'override': child.override,
+            'author': child.author,
+            'datetime': child.datetime,
+            'value': child.entry,
+            'protect': child.protect,
+            'parent': child.parent,
+            'active': active,
+        }
 
     def get_child(self, parent, name, override=''):
         child = Value.objects.child(parent, name, override)
@@ -152,3 +378,47 @@ class Values(object):
                 'parent': parent,
             }
         return None
+
+    @primary(sticky=False)
+    @transaction.atomic
+    def compact_history(self, keep_versions, keep_days, batch_size):
+        prune = []
+        # a version in the history is never the newest one of its value if
+        # there is a newer one in the history, or the value is still there
+        newer = ValueHistory.objects.filter(
+            id=OuterRef('id'), entry_id__gt=OuterRef('entry_id')
+        )
+        current = Value.objects.filter(active=True, id=OuterRef('id'))
+
+        if keep_days is not None:
+            cutoff = timezone.now() - timedelta(days=keep_days)
+            prune += ValueHistory.objects.\
+                filter(datetime__lt=cutoff).\
+                annotate(newer=Exists(newer), current=Exists(current)).\
+                filter(Q(newer=True) | Q(current=True)).\
+                values_list('entry_id', flat=True)[:batch_size]
+
+        if keep_versions is not None and len(prune) < batch_size:
+            keep = max(keep_versions, 1)
+            crowded = ValueHistory.objects.\
+                values('id').\
+                annotate(versions=Count('entry_id'), current=Exists(current)).\
+                filter(Q(versions__gt=keep) | Q(versions=keep, current=True)).\
+                values_list('id', 'current')[:batch_size]
+
+            for val_id, is_current in crowded:
+                # the current version counts towards the ones kept
+                older = ValueHistory.objects.\
+                    filter(id=val_id).\
+                    order_by('-entry_id').\
+                    values_list('entry_id', flat=True)[keep - is_current:]
+                prune += [
+                    entry_id for entry_id in older if entry_id not in prune
+                ][:batch_size - len(prune)]
+
+                if len(prune) >= batch_size:
+                    break
+
+        if not prune:
+            return 0
+        return ValueHistory.objects.filter(entry_id__in=prune).delete()[0]
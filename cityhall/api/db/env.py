@@ -12,8 +12,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from api.cache import CacheDict
-from api.db import Rights
+from time import time
+from api.db import Rights, CHILD_FIELDS, CHILD_RESPONSE_FIELDS
 
 
 def sanitize_path(path):
@@ -35,9 +35,14 @@ def path_split(path):
 class Env(object):
     def __init__(self, db, env, permissions, name, root_id):
         self.db = db
-        self.cache = CacheDict(
-            capacity=self.db.settings('cache', 'path_capacity'),
-        )
+        # path -> (index, until), shared with every other Env of this
+        # environment
+        self.cache = db.get_env_cache('path', root_id)
+        # path -> until when it is known not to exist, shared likewise
+        self.missing = db.get_env_cache('missing', root_id)
+        # (path, override, fallback) -> (version, until, (value, protect)),
+        # valid while the version of the environment stays the same
+        self.resolved = db.get_env_cache('value', root_id)
         self.env = env
         self.root_id = root_id
         self.permissions = permissions
@@ -65,21 +70,64 @@ class Env(object):
 
     def _index_from_cache(self, cache_key):
         """
-        Attempts to retrieve the index of this path from cache
+        Attempts to retrieve the index of this path from cache.  Indexes are
+        only kept for the 'path_seconds' cache setting, so that paths deleted
+        and created again by other processes are seen.
 
         :param cache_key: The string representation of the cahce key in
          the form of /fully/sanatized/path/:override
         :return: the int() index_id or None
         """
-        return self.cache.get(cache_key, None)
+        cached = self.cache.get(cache_key, None)
+        if cached is None or cached[1] <= time():
+            return None
+        return cached[0]
+
+    def _cache_index(self, cache_key, index):
+        # what a replica which is behind says isn't cached for everyone
+        if not self.db.reads_are_current():
+            return
+        until = time() + self.db.settings('cache', 'path_seconds')
+        # the index may belong to a value which isn't committed yet
+        self.db.on_commit(lambda: self.cache.set(cache_key, (index, until)))
+
+    def _is_missing(self, cache_key):
+        """
+        Whether the path in cache_key (see _index_from_cache) was recently
+        found not to exist.  Paths are only remembered as missing for the
+        'missing_seconds' cache setting, so that values created by other
+        processes are seen.
+        """
+        expires = self.missing.get(cache_key, None)
+        return expires is not None and expires > time()
+
+    def _cache_missing(self, cache_key):
+        if not self.db.reads_are_current():
+            return
+        self.missing.set(
+            cache_key, time() + self.db.settings('cache', 'missing_seconds')
+        )
+
+    def _forget_missing(self, sanitized_path, override):
+        # at once for this transaction, and again on commit, in case someone
+        # else found the path missing in between
+        keys = {f"{sanitized_path}:", f"{sanitized_path}:{override}"}
+
+        def forget():
+            for key in keys:
+                self.missing.delete(key)
+        forget()
+        self.db.on_commit(forget)
 
     def _get_index_of(self, path, override=None,
                       parent_id=None, parent_path=None):
         """
         Returns the index of the given path.
 
-        It searches out from /, recursively calling itself with the next item
-        in the path.  As it searches, it greedily caches all paths it finds.
+        If the path isn't cached, the db is asked to resolve it whole (see
+        Db.get_path_index).  If the db can't, it searches out from /,
+        recursively calling itself with the next item in the path.  As it
+        searches, it greedily caches all paths it finds.
 
         :param path: This should be a string.  When _get_index_of() calls
          itself it is an array of strings (broken up by '/'). which must be
@@ -101,12 +149,23 @@ class Env(object):
             path = sanitize_path(path)
             cache_key = f"{path}:{override}"
             index = self._index_from_cache(cache_key)
+            if index is None and self._is_missing(cache_key):
+                return -1
+
+            if index is None:
+                index = self.db.get_path_index(
+                    self.root_id, path_split(path), override
+                )
 
             if index is None:
-                return self._get_index_of(
+                index = self._get_index_of(
                     path_split(path), override, self.root_id, '/'
                 )
 
+            if index >= 0:
+                self._cache_index(cache_key, index)
+            else:
+                self._cache_missing(cache_key)
             return index
 
         children = self.db.get_children_of(parent_id)
@@ -123,7 +182,7 @@ class Env(object):
 
         for child in children:
             cache_key = f"{parent_path}{ child['name']}/:{child['override']}"
-            self.cache[cache_key] = child['id']
+            self._cache_index(cache_key, child['id'])
 
             if child['name'] == path[0] and child['override'] == seek_override:
                 if len(path) == 1:
@@ -155,6 +214,7 @@ class Env(object):
 
         if (path == '/') and (override == ''):
             self.db.update(self.name, self.root_id, value)
+            self._changed()
             return True
 
         if path == '/':
@@ -171,6 +231,7 @@ class Env(object):
                 self.cache.delete(cache_key)
             else:
                 self.db.update(self.name, cached, value)
+                self._changed()
                 return True
 
         parent_index = self._get_parent_id(path)
@@ -184,8 +245,9 @@ class Env(object):
 
         for child in children:
             if (child['name'] == search) and (child['override'] == override):
-                self.cache[cache_key] = child['id']
+                self._cache_index(cache_key, child['id'])
                 self.db.update(self.name, child['id'], value)
+                self._changed()
                 return True
             if (child['name'] == search) and (child['override'] == ''):
                 global_entry_must_be_created = False
@@ -193,12 +255,132 @@ class Env(object):
         if global_entry_must_be_created:
             self.db.create(self.name, parent_index, search, '', '')
 
-        self.db.create(
+        created = self.db.create(
             self.name, parent_index, search, value, override,
         )
+        if created is None:
+            # someone else created it since the children were listed
+            existing = self.db.get_child(parent_index, search, override)
+            self.db.update(self.name, existing['id'], value)
+        self._forget_missing(path, override)
+        self._changed()
 
         return True
 
+    def set_many(self, items):
+        """
+        Sets a batch of values, all or nothing.  Each parent path is only
+        resolved (and its children only listed) once, and values may be
+        created under values created earlier in the same batch.
+
+        :param items: a list of dicts, with 'path', and optionally
+         'override', and 'value' and/or 'protect'
+        :return: whether the batch was applied, and a result for each item
+        """
+        if self.permissions < Rights.Write:
+            return False, [
+                {'Response': 'Failure', 'Message': 'Do not have write permissions'}
+                for _ in items
+            ]
+
+        parents = {}
+        children = {}
+        planned = {}
+        writes = []
+
+        def plan(path, override, value, protect):
+            write = planned.get((path, override), None)
+
+            if write is None and path == '/':
+                write = {'id': self.root_id, 'value': None, 'protect': None}
+            elif write is None:
+                parent = get_parent(sanitize_path(Env._get_parent_path(path)))
+                if parent is None:
+                    return None
+
+                name = get_name_of_value(path)
+                existing = None
+                if not isinstance(parent, dict):
+                    existing = get_children(parent).get((name, override), None)
+
+                if existing is None and override:
+                    # an override may only be created next to a global value
+                    plan(path, '', None, None)
+
+                write = {
+                    'id': existing, 'parent': parent, 'name': name,
+                    'override': override, 'value': None, 'protect': None,
+                }
+
+            if (path, override) not in planned:
+                planned[(path, override)] = write
+                writes.append(write)
+
+            write['value'] = write['value'] if value is None else value
+            write['protect'] = write['protect'] if protect is None else protect
+            return write
+
+        def get_parent(parent_path):
+            # the id of the parent, or the write which will create it
+            write = planned.get((parent_path, ''), None)
+            if write is not None:
+                return write if write['id'] is None else write['id']
+
+            if parent_path not in parents:
+                parents[parent_path] = self._get_index_of(parent_path)
+            return parents[parent_path] if parents[parent_path] >= 0 else None
+
+        def get_children(parent):
+            if parent not in children:
+                children[parent] = {
+                    (child['name'], child['override']): child['id']
+                    for child in self.db.get_children_of(parent)
+                }
+            return children[parent]
+
+        results = []
+        for item in items:
+            path = item.get('path', None)
+            override = item.get('override', None) or ''
+            value = item.get('value', None)
+            protect = item.get('protect', None)
+            write = None
+
+            if not path or ((value is None) and (protect is None)):
+                message = 'Expected a path, and a value or protect to set'
+            elif path == '/' and override:
+                message = 'Cannot create overrides for root'
+            else:
+                write = plan(sanitize_path(path), override, value, protect)
+                message = 'The parent of this path does not exist'
+
+            if write is None:
+                results.append({'Response': 'Failure', 'Message': message})
+            else:
+                results.append({'Response': 'Ok', 'write': write})
+
+        if any(result['Response'] != 'Ok' for result in results):
+            for result in results:
+                result.pop('write', None)
+            return False, results
+
+        created = [key for key, write in planned.items() if write['id'] is None]
+        failed = set(id(write) for write in self.db.set_many(self.name, writes))
+        if failed:
+            for result in results:
+                if id(result.pop('write')) in failed:
+                    result['Response'] = 'Failure'
+                    result['Message'] = 'Deleted while the batch was applied'
+            return False, results
+
+        for path, override in created:
+            self._forget_missing(path, override)
+        self._changed()
+
+        for result in results:
+            result['id'] = result.pop('write')['id']
+        return True, results
+
     def delete(self, path, override=None):
         sanitized_path = sanitize_path(path)
         if sanitized_path == '/':
@@ -212,30 +394,102 @@ class Env(object):
             for child in children:
                 if child['name'] == name:
                     self.db.delete(self.name, child['id'])
+            # its overrides, and everything below it, are gone as well
+            self.cache.delete_prefix(sanitized_path)
         else:
             index = self._get_index_of(path, override)
             if index >= 0:
                 self.db.delete(self.name, index)
+            self.cache.delete(f"{sanitized_path}:{override}")
+        self._changed()
+
+    def _resolve(self, key, lookup):
+        """
+        The (value, protect) of key, from the resolved value cache if
+        nothing has been written to this environment since it was cached
+        and it is younger than the 'value_seconds' cache setting (writes of
+        other processes aren't seen any sooner), otherwise from lookup().
+        What lookup() read from a replica which may be behind isn't cached.
+        """
+        version = self.db.get_env_version(self.root_id)
+        now = time()
+        cached = self.resolved.get(key, None)
+        if cached is not None and cached[0] == version and cached[1] > now:
+            return cached[2]
+
+        val_pair = lookup()
+        if not self.db.reads_are_current():
+            return val_pair
+        self.resolved.set(
+            key, (version, now + self.db.settings('cache', 'value_seconds'),
+                  val_pair)
+        )
+        return val_pair
+
+    def _changed(self):
+        # at once for this transaction, and again on commit, in case someone
+        # else cached what was there before in between
+        self.db.bump_env_version(self.root_id)
+        self.db.on_commit(lambda: self.db.bump_env_version(self.root_id))
 
     def get_explicit(self, path, override=None):
+        path = sanitize_path(path)
+        override = override or ''
+        return self._honor_permissions(self._resolve(
+            (path, override, False),
+            lambda: self._lookup_explicit(path, override),
+        ))
+
+    def _lookup_explicit(self, path, override):
+        if path != '/':
+            cache_key = f"{path}:{override}"
+            if self._is_missing(cache_key):
+                return None, None
+
+            val_pair = self.db.get_value_by_path(
+                self.root_id, path_split(path), override, False
+            )
+            if val_pair == (None, None):
+                self._cache_missing(cache_key)
+            if val_pair is not None:
+                return val_pair
+
         index = self._get_index_of(path, override)
         if index >= 0:
-            return self._honor_permissions(self.db.get_value(index))
+            return self.db.get_value(index)
         return None, None
 
     def get(self, path):
+        path = sanitize_path(path)
+        return self._honor_permissions(self._resolve(
+            (path, self.name, True), lambda: self._lookup(path)
+        ))
+
+    def _lookup(self, path):
         if path == '/':
-            return self._honor_permissions(self.db.get_value(self.root_id))
+            return self.db.get_value(self.root_id)
 
-        path = sanitize_path(path)
-        parent_id = self._get_parent_id(path)
-        value_name = get_name_of_value(path)
+        # an override only exists next to a global value, so if there is no
+        # global value, there is nothing to get
+        cache_key = f"{path}:"
+        if self._is_missing(cache_key):
+            return None, None
 
-        if parent_id >= 0:
-            return self._honor_permissions(
-                self.db.get_value_for(parent_id, value_name, self.name)
-            )
-        return None, None
+        val_pair = self.db.get_value_by_path(
+            self.root_id, path_split(path), self.name
+        )
+
+        if val_pair is None:
+            parent_id = self._get_parent_id(path)
+            val_pair = None, None
+            if parent_id >= 0:
+                val_pair = self.db.get_value_for(
+                    parent_id, get_name_of_value(path), self.name
+                )
+
+        if val_pair == (None, None):
+            self._cache_missing(cache_key)
+        return val_pair
 
     def get_children(self, path):
         index = self._get_index_of(path)
@@ -261,6 +515,99 @@ class Env(object):
             ]
         return []
 
+    def get_children_page(self, path, after=None, limit=None, fields=None):
+        """
+        Like get_children(), sorted by name and override, one page at a time.
+
+        :param after: the cursor returned with the previous page, or None
+        :param limit: the most children to return, or None for all of them
+        :param fields: which of CHILD_RESPONSE_FIELDS to return for each
+         child, or None for all of them
+        :return: the children, and the cursor of the next page (None if
+         this is the last one)
+        """
+        if self.permissions < Rights.Read:
+            return [], None
+
+        index = self._get_index_of(path)
+        if index < 0:
+            return [], None
+
+        path = sanitize_path(path)
+        fields = fields or CHILD_RESPONSE_FIELDS
+        # name and override are always needed, for the cursor
+        db_fields = ['name', 'override'] + [
+            field for field in CHILD_FIELDS
+            if field in fields and field not in ('name', 'override')
+        ]
+
+        children = self.db.get_children_page(
+            index, after, None if limit is None else limit + 1, db_fields,
+            self.permissions > Rights.Read,
+        )
+
+        cursor = None
+        if limit is not None and len(children) > limit:
+            children = children[:limit]
+            cursor = (children[-1]['name'], children[-1]['override'])
+
+        return [
+            {
+                field: path + child['name'] + '/' if field == 'path'
+                else child[field]
+                for field in fields
+            }
+            for child in children
+        ], cursor
+
+    def get_tree(self, path, depth=None):
+        """
+        Returns everything under path, nested, down to the given depth.
+        Permissions are honored as in get_children(): with only Read rights,
+        protected values are left out, and so is what is under them.
+
+        :param depth: how many levels to go down (1 is the same as
+         get_children), or None for all of them
+        :return: the children of path, each with its own 'children', sorted
+         by name and override.  Values at the depth limit, and overrides,
+         have no 'children'.
+        """
+        if self.permissions < Rights.Read:
+            return []
+
+        index = self._get_index_of(path)
+        if index < 0:
+            return []
+
+        by_parent = {}
+        for val in self.db.get_subtree(
+                index, depth, self.permissions > Rights.Read):
+            by_parent.setdefault(val['parent'], []).append(val)
+
+        def nest(parent_id, parent_path, level):
+            children = sorted(
+                by_parent.get(parent_id, []),
+                key=lambda val: (val['name'], val['override'])
+            )
+            nested = []
+            for child in children:
+                child_path = parent_path + child['name'] + '/'
+                node = {
+                    'name': child['name'],
+                    'id': child['id'],
+                    'override': child['override'],
+                    'path': child_path,
+                    'value': child['value'],
+                    'protect': child['protect'],
+                }
+                if child['override'] == '' and \
+                        (depth is None or level < depth):
+                    node['children'] = nest(child['id'], child_path, level + 1)
+                nested.append(node)
+            return nested
+
+        return nest(index, sanitize_path(path), 1)
+
     def get_history(self, path, override=None):
         if self.permissions < Rights.ReadProtected:
             return []
@@ -281,6 +628,40 @@ class Env(object):
             for item in self.db.get_history(index)
         ]
 
+    def get_history_page(self, path, override=None, since=None, until=None,
+                         after=None, limit=None):
+        """
+        Like get_history(), oldest first, between two times and one page at
+        a time, see Db.get_history_page().
+
+        :return: the versions, and the cursor of the next page (None if
+         this is the last one)
+        """
+        if self.permissions < Rights.ReadProtected:
+            return [], None
+
+        index = self._get_index_of(path, override)
+        if index < 0:
+            return [], None
+
+        history, cursor = self.db.get_history_page(
+            index, since, until, after, limit
+        )
+
+        return [
+            {
+                'id': item['id'],
+                'name': item['name'],
+                'value': item['value'],
+                'author': item['author'],
+                'datetime': item['datetime'],
+                'active': item['active'],
+                'protect': item['protect'],
+                'override': item['override'],
+            }
+            for item in history
+        ], cursor
+
     def set_protect(self, status, path, override):
         if self.permissions < Rights.Write:
             return False
@@ -289,6 +670,7 @@ class Env(object):
 
         if (path == '/') and (override == ''):
             self.db.set_protect_status(self.name, self.root_id, status)
+            self._changed()
             return True
 
         if path == '/':
@@ -297,6 +679,7 @@ class Env(object):
         index = self._get_index_of(path, override)
         if index > -1:
             self.db.set_protect_status(self.name, index, status)
+            self._changed()
             return True
 
         return False
@@ -12,15 +12,23 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from api.db import Db
+from api.db import Db, CHILD_FIELDS, history_page
+from heapq import nsmallest
+from api.db.memory.rows import as_dict
 from datetime import datetime
+from functools import wraps
 
 
-def get_next_id(table):
-    max_id = -1
-    for item in table:
-        max_id = item['id'] if item['id'] > max_id else max_id
-    return max_id + 1
+def writer(method):
+    """
+    Serializes the decorated method with every other writer of the same
+    in-memory db.  Readers do not take the lock, see CityHallDbFactory.
+    """
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.parent.lock:
+            return method(self, *args, **kwargs)
+    return locked
 
 
 class CityHallDb(Db):
@@ -35,12 +43,12 @@ class CityHallDb(Db):
         authCount = len(self.parent.authTable) if self.parent.authTable else 'None'
         return f"(In-Memory Db): Values: {valsCount}, Authorizations: {authCount}"
 
+    @writer
     def create_user(self, author, user, passhash, user_root):
-        for auth in self.parent.authTable:
-            if auth['active'] and auth['user'] == user:
-                return
+        if user in self.parent.authByUser:
+            return
 
-        self.parent.authTable.append({
+        self.parent.add_auth({
             'id': len(self.parent.authTable),
             'active': True,
             'datetime': datetime.now(),
@@ -50,10 +58,11 @@ class CityHallDb(Db):
             'pass': passhash,
         })
 
+    @writer
     def create_root(self, author, env):
         if self.get_env_root(env) < 0:
-            val_id = get_next_id(self.parent.valsTable)
-            self.parent.valsTable.append({
+            val_id = self.parent.nextValId
+            self.parent.add_value({
                 'id': val_id,
                 'parent': val_id,
                 'active': True,
@@ -69,22 +78,89 @@ class CityHallDb(Db):
         return False
 
     def get_env_root(self, env):
-        return next(
-            (val['id'] for val in self.parent.valsTable
-                if val['id'] == val['parent'] and val['name'] == env),
-            -1
-        )
+        return self.parent.rootsByName.get(env, -1)
 
     def get_children_of(self, index):
+        # roots are never indexed as children, not even of themselves
         return [
-            child for child in self.parent.valsTable
-            if child['active'] and child['parent'] == index
-            and child['id'] != index        # do not return roots
+            as_dict(child)
+            for child in self.parent.valsByParent.get(index, {}).values()
+        ]
+
+    def get_path_index(self, root_id, names, override=''):
+        index = root_id
+        last = len(names) - 1
+
+        for position, name in enumerate(names):
+            val = self.parent.valsByName.get(
+                (index, name, override if position == last else ''), None
+            )
+            if val is None:
+                return -1
+            index = val['id']
+        return index
+
+    def get_value_by_path(self, root_id, names, override, fallback=True):
+        parent = self.get_path_index(root_id, names[:-1])
+        if parent < 0:
+            return None, None
+        if fallback:
+            return self.get_value_for(parent, names[-1], override)
+
+        val = self.parent.valsByName.get((parent, names[-1], override), None)
+        if val:
+            return val['value'], val['protect']
+        return None, None
+
+    def get_children_page(self, index, after=None, limit=None, fields=None,
+                          protected=True):
+        # like Db.get_children_page, without copying every child to a dict
+        fields = fields or CHILD_FIELDS
+        after = None if after is None else tuple(after)
+        children = [
+            child for child in self.parent.valsByParent.get(index, {}).values()
+            if (protected or not child['protect']) and
+            (after is None or (child['name'], child['override']) > after)
         ]
+        key = lambda child: (child['name'], child['override'])
+        children = sorted(children, key=key) if limit is None else \
+            nsmallest(limit, children, key=key)
+        return [{field: child[field] for field in fields} for child in children]
+
+    def get_subtree(self, index, depth=None, protected=True):
+        # one pass over valsByParent, without copying rows to dicts first
+        tree = []
+        level = [index]
+        current = 1
+        by_parent = self.parent.valsByParent
+
+        while level and (depth is None or current <= depth):
+            below = []
+            for parent in level:
+                for child in by_parent.get(parent, {}).values():
+                    if not protected and child['protect']:
+                        continue
+                    tree.append({
+                        'id': child['id'], 'parent': parent,
+                        'name': child['name'], 'override': child['override'],
+                        'value': child['value'], 'protect': child['protect'],
+                        'depth': current,
+                    })
+                    if child['override'] == '':
+                        below.append(child['id'])
+            level = below
+            current += 1
+
+        return tree
 
+    @writer
     def create(self, user, parent, name, value, override=''):
-        created_id = get_next_id(self.parent.valsTable)
-        self.parent.valsTable.append({
+        if (parent, name, override) in self.parent.valsByName:
+            # created by another writer since the caller looked
+            return None
+
+        created_id = self.parent.nextValId
+        self.parent.add_value({
             'id': created_id,
             'parent': parent,
             'active': True,
@@ -98,32 +174,29 @@ class CityHallDb(Db):
         })
         return created_id
 
+    @writer
     def update_user(self, author, user, passhash):
-        for auth in self.parent.authTable:
-            if auth['active'] and auth['user'] == user:
-                auth['active'] = False
-                self.parent.authTable.append({
-                    'id': len(self.parent.authTable),
-                    'active': True,
-                    'datetime': datetime.now(),
-                    'author': author,
-                    'user': user,
-                    'pass': passhash,
-                    'user_root': auth['user_root']
-                })
-                return True
+        auth = self.parent.authByUser.get(user, None)
+
+        if auth:
+            self.parent.add_auth({
+                'id': len(self.parent.authTable),
+                'active': True,
+                'datetime': datetime.now(),
+                'author': author,
+                'user': user,
+                'pass': passhash,
+                'user_root': auth['user_root']
+            })
+            return True
         return False
 
+    @writer
     def update(self, user, index, value):
-        original = next((
-            val for val in self.parent.valsTable
-            if val['active'] and val['id'] == index),
-            None
-        )
+        original = self.parent.valsTable.get(index, None)
 
         if original:
-            original['active'] = False
-            self.parent.valsTable.append({
+            self.parent.add_value({
                 'id': index,
                 'parent': original['parent'],
                 'active': True,
@@ -136,16 +209,12 @@ class CityHallDb(Db):
                 'protect': original['protect'],
             })
 
+    @writer
     def delete(self, user, index):
-        original = next((
-            val for val in self.parent.valsTable
-            if val['active'] and val['id'] == index),
-            None
-        )
+        original = self.parent.valsTable.get(index, None)
 
         if original:
-            original['active'] = False
-            self.parent.valsTable.append({
+            self.parent.add_value({
                 'id': index,
                 'parent': original['parent'],
                 'active': False,
@@ -159,45 +228,41 @@ class CityHallDb(Db):
             })
 
     def get_value(self, index):
-        return next((
-            (val['value'], val['protect']) for val in self.parent.valsTable
-            if val['active'] and val['id'] == index),
-            (None, None)
-        )
+        val = self.parent.valsTable.get(index, None)
+        if val:
+            return val['value'], val['protect']
+        return None, None
 
     def get_history(self, index):
-        return [
-            value
-            for value in self.parent.valsTable
-            if ((value['id'] == index) or
-                (value['parent'] == index and value['first_last']))
-        ]
+        return [as_dict(val) for val in self.parent.valsHistory.get(index, [])]
 
-    def get_value_for(self, parent_index, name, override):
-        value_with_no_override = None, None
-
-        for val in self.parent.valsTable:
-            if val['parent'] == parent_index and val['name'] == name and \
-                    val['active']:
-                if val['override'] == override:
-                    return val['value'], val['protect']
-                elif val['override'] == '':
-                    value_with_no_override = val['value'], val['protect']
+    def get_history_page(self, index, since=None, until=None, after=None,
+                         limit=None):
+        # versions are kept oldest first, with naive local datetimes
+        since, until = (
+            when.astimezone().replace(tzinfo=None)
+            if when is not None and when.tzinfo else when
+            for when in (since, until)
+        )
+        return history_page(
+            (as_dict(val) for val in self.parent.valsHistory.get(index, [])),
+            since, until, after, limit,
+        )
 
-        return value_with_no_override
+    def get_value_for(self, parent_index, name, override):
+        val = self.parent.valsByName.get((parent_index, name, override), None)
+        if val is None:
+            val = self.parent.valsByName.get((parent_index, name, ''), None)
+        if val:
+            return val['value'], val['protect']
+        return None, None
 
+    @writer
     def set_protect_status(self, user, index, status):
-        original = next((
-            val for val in self.parent.valsTable
-            if (val['active']
-                and val['id'] == index
-                and val['protect'] != status)),
-            None
-        )
+        original = self.parent.valsTable.get(index, None)
 
-        if original:
-            original['active'] = False
-            self.parent.valsTable.append({
+        if original and original['protect'] != status:
+            self.parent.add_value({
                 'id': index,
                 'parent': original['parent'],
                 'active': True,
@@ -210,39 +275,35 @@ class CityHallDb(Db):
                 'protect': status
             })
 
+    @writer
     def delete_user(self, author, user):
-        for auth in self.parent.authTable:
-            if auth['active'] and auth['user'] == user:
-                auth['active'] = False
-                self.parent.authTable.append({
-                    'id': len(self.parent.authTable),
-                    'active': False,
-                    'datetime': datetime.now(),
-                    'author': author,
-                    'user': user,
-                    'pass': '',
-                    'user_root': auth['user_root']
-                })
-                return True
+        auth = self.parent.authByUser.get(user, None)
+
+        if auth:
+            self.parent.add_auth({
+                'id': len(self.parent.authTable),
+                'active': False,
+                'datetime': datetime.now(),
+                'author': author,
+                'user': user,
+                'pass': '',
+                'user_root': auth['user_root']
+            })
+            return True
         return False
 
-    def get_users(self, env):
-        ret = {}
-        users_root = self.get_env_root('users')
-        all_users = self.get_children_of(users_root)
+    @writer
+    def set_many(self, author, writes):
+        return super(CityHallDb, self).set_many(author, writes)
 
-        for user in all_users:
-            permissions = self.get_children_of(user['id'])
+    @writer
+    def compact_history(self, keep_versions, keep_days, batch_size):
+        return self.parent.compact_history(keep_versions, keep_days, batch_size)
 
-            for permission in permissions:
-                if permission['name'] == env:
-                    ret[user['name']] = permission['value']
-        return ret
+    def get_users(self, env):
+        return dict(self.parent.rightsByEnv.get(env, {}))
 
     def get_child(self, parent, name, override=''):
-        children = self.get_children_of(parent)
-
-        for child in children:
-            if child['active'] and child['name'] == name \
-                    and child['override'] == override:
-                return child
+        return as_dict(
+            self.parent.valsByName.get((parent, name, override), None)
+        )
@@ -13,8 +13,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from api.db import DbFactory, DbState
-from datetime import datetime
+from datetime import datetime, timedelta
+from threading import RLock
 from api.db.memory.db import CityHallDb
+from api.db.memory.journal import Journal
+from api.db.memory.rows import ValueRow, AuthRow
 
 
 class CityHallDbFactory(DbFactory):
@@ -22,16 +25,42 @@ class CityHallDbFactory(DbFactory):
         super(CityHallDbFactory, self).__init__(settings)
         self.state = DbState.Closed
         self.authTable = None
+        self.authByUser = None
         self.valsTable = None
+        self.valsHistory = None
+        self.valsByParent = None
+        self.valsByName = None
+        self.rootsByName = None
+        self.usersByFolder = None
+        self.rightsByEnv = None
+        self.nextValId = None
+        self.compactCursor = 0
+        self.compact = settings.get('memory', {}).get('compact_rows', False)
+        self.journal = None
+        self.restored = False
+        self.lock = RLock()
+
+        journal_path = settings.get('memory', {}).get('journal', None)
+        if journal_path:
+            self.journal = Journal(
+                journal_path,
+                settings['memory'].get('snapshot_every', 10000),
+            )
 
     def open(self):
         if self.state == DbState.Closed:
             self.state = DbState.Open
+            if self.journal:
+                self.restored = self.journal.restore(self)
         else:
             raise Exception("Cannot open new connection, already opened")
 
     def create_default_tables(self):
-        self.valsTable = [
+        if self.restored:
+            # the tables were loaded from the journal, do not wipe them
+            return
+
+        default_values = [
             {
                 'id': 1,
                 'parent': 1,
@@ -105,7 +134,8 @@ class CityHallDbFactory(DbFactory):
                 'first_last': True,
             },
         ]
-        self.authTable = [{
+        self.clear_tables()
+        self.add_auth({
             'id': 0,
             'active': True,
             'datetime': datetime.now(),
@@ -113,7 +143,272 @@ class CityHallDbFactory(DbFactory):
             'author': 'cityhall',
             'user': 'cityhall',
             'pass': '',
-        }]
+        })
+        for val in default_values:
+            self.add_value(val)
+
+    def clear_tables(self):
+        self.authTable = []
+        self.valsTable = {}
+        self.valsHistory = {}
+        self.index_auth()
+        self.index_values()
+
+    def index_auth(self):
+        """
+        Rebuilds authByUser: user -> active row of authTable, which holds
+        every version of every user.
+        """
+        self.authByUser = {
+            auth['user']: auth for auth in self.authTable if auth['active']
+        }
+
+    def index_values(self):
+        """
+        Rebuilds the lookup indexes from the two value stores:
+
+            valsTable: id -> active row, the only live state
+            valsHistory: id -> every version of that id, followed in order
+                by the first/last versions of its children (i.e. exactly
+                what get_history() returns)
+
+        The indexes are:
+
+            valsByParent: parent -> {id: active row}, roots excluded
+            valsByName: (parent, name, override) -> active row, roots excluded
+            rootsByName: environment name -> root id
+            usersByFolder: id of a folder in the users env -> user name
+            rightsByEnv: environment name -> {user name: rights}, from the
+                children of the folders in the users env
+
+        Writers hold self.lock, readers never lock.  So that readers always
+        see a consistent state, stores and indexes are changed so that an
+        entry is only ever replaced, never missing: a new version is put in
+        place before the previous one is retired, and keys are never added
+        to or removed from the buckets of valsByParent and rightsByEnv once
+        published, but the buckets are copied, changed and swapped in.  The
+        row under an existing key of valsByParent is replaced in place.
+        """
+        self.valsByParent = {}
+        self.valsByName = {}
+        self.rootsByName = {}
+        self.nextValId = max(self.valsHistory, default=-1) + 1
+
+        for val in self.valsTable.values():
+            if val['id'] == val['parent']:
+                self.rootsByName[val['name']] = val['id']
+            else:
+                self.valsByParent.setdefault(val['parent'], {})[val['id']] = val
+                self.valsByName[(val['parent'], val['name'], val['override'])] = val
+
+        self.usersByFolder = {}
+        self.rightsByEnv = {}
+        users_root = self.rootsByName.get('users', None)
+
+        for folder in self.valsByParent.get(users_root, {}).values():
+            self.usersByFolder[folder['id']] = folder['name']
+            for right in self.valsByParent.get(folder['id'], {}).values():
+                self.rightsByEnv.setdefault(right['name'], {})[folder['name']] = \
+                    right['value']
+
+    def _reindex_value(self, previous, val):
+        """
+        Points the indexes at the active version val instead of previous.
+        Either may be None, if the value is being created or deleted.
+        """
+        row = previous if val is None else val
+        if row['id'] == row['parent']:
+            # roots are not children of anything, and are never deleted
+            self.rootsByName[row['name']] = row['id']
+            return
+
+        siblings = self.valsByParent.get(row['parent'], {})
+        if previous is not None and val is not None:
+            siblings[val['id']] = val
+        elif val is not None:
+            siblings = dict(siblings)
+            siblings[val['id']] = val
+            self.valsByParent[row['parent']] = siblings
+        elif len(siblings) > 1:
+            siblings = dict(siblings)
+            del siblings[previous['id']]
+            self.valsByParent[row['parent']] = siblings
+        else:
+            self.valsByParent.pop(row['parent'], None)
+
+        if val is not None:
+            self.valsByName[(val['parent'], val['name'], val['override'])] = val
+        if previous is not None:
+            key = (previous['parent'], previous['name'], previous['override'])
+            if self.valsByName.get(key) is previous:
+                del self.valsByName[key]
+
+        self._reindex_rights(previous, val)
+
+    def _reindex_rights(self, previous, val):
+        row = previous if val is None else val
+
+        if row['parent'] == self.rootsByName.get('users', None):
+            if val is not None:
+                self.usersByFolder[val['id']] = val['name']
+            else:
+                # a deleted user folder takes any rights left in it along
+                self.usersByFolder.pop(previous['id'], None)
+                for right in self.valsByParent.get(previous['id'], {}).values():
+                    self._set_rights(right['name'], previous['name'], None)
+        elif row['parent'] in self.usersByFolder:
+            self._set_rights(
+                row['name'],
+                self.usersByFolder[row['parent']],
+                None if val is None else val['value'],
+            )
+
+    def _set_rights(self, env, user, rights):
+        users = dict(self.rightsByEnv.get(env, {}))
+        if rights is None:
+            users.pop(user, None)
+        else:
+            users[user] = rights
+
+        if users:
+            self.rightsByEnv[env] = users
+        else:
+            self.rightsByEnv.pop(env, None)
+
+    def add_value(self, val):
+        """
+        Stores a new version of a value, and writes it to the journal if
+        there is one.
+        """
+        self.store_value(val)
+        self._journal('vals', val)
+
+    def store_value(self, val):
+        """
+        Records a new version of a value.  If there is an active version with
+        the same id, it is marked inactive and replaced in valsTable by the
+        new version (or removed, if the new version is inactive).  The new
+        version is always appended to the history of its id, and if it is
+        the first or last version of a child, to the history of its parent.
+
+        In compact mode, the given dict is stored as a ValueRow.
+        """
+        if self.compact:
+            val = ValueRow.from_dict(val)
+
+        previous = self.valsTable.get(val['id'], None)
+
+        self.valsHistory.setdefault(val['id'], []).append(val)
+        if val['first_last'] and val['id'] != val['parent']:
+            self.valsHistory.setdefault(val['parent'], []).append(val)
+
+        self.nextValId = max(self.nextValId, val['id'] + 1)
+
+        if val['active']:
+            self.valsTable[val['id']] = val
+            self._reindex_value(previous, val)
+        elif previous is not None:
+            del self.valsTable[val['id']]
+            self._reindex_value(previous, None)
+
+        if previous is not None:
+            previous['active'] = False
+
+    def compact_history(self, keep_versions, keep_days, batch_size):
+        """
+        Prunes inactive versions from valsHistory, resuming from where the
+        previous call stopped, and returns how many were pruned.  A version
+        is pruned if it is not among the newest `keep_versions` of its id,
+        or is older than `keep_days` (either may be None).  The newest
+        version of an id is always kept, so deleted ids are never reused.
+
+        The caller must hold self.lock.  Each call prunes at most
+        `batch_size` versions and looks at no more than 10 times as many
+        ids, so it holds the lock for a bounded time.  Pruned versions are
+        not written to the journal; they are dropped from disk by the next
+        snapshot.
+        """
+        cutoff = None
+        if keep_days is not None:
+            cutoff = datetime.now() - timedelta(days=keep_days)
+
+        pruned = 0
+        examined = 0
+        val_id = self.compactCursor
+
+        while pruned < batch_size and examined < batch_size * 10:
+            if val_id >= self.nextValId:
+                val_id = 0
+                if examined:
+                    break
+            examined += 1
+
+            history = self.valsHistory.get(val_id, [])
+            versions = [val for val in history if val['id'] == val_id]
+            prune = [
+                val for position, val in enumerate(versions[:-1])
+                if not val['active'] and (
+                    (keep_versions is not None and
+                     position < len(versions) - keep_versions) or
+                    (cutoff is not None and val['datetime'] < cutoff)
+                )
+            ][:batch_size - pruned]
+
+            if prune:
+                self._prune_versions(val_id, prune)
+                pruned += len(prune)
+            val_id += 1
+
+        self.compactCursor = val_id
+        return pruned
+
+    def _prune_versions(self, val_id, prune):
+        # histories are swapped for pruned copies, so readers walking the
+        # old list are not affected
+        pruned = set(id(val) for val in prune)
+        parents = set(
+            val['parent'] for val in prune
+            if val['first_last'] and val['parent'] != val_id
+        )
+
+        for history_id in [val_id] + list(parents):
+            self.valsHistory[history_id] = [
+                val for val in self.valsHistory[history_id]
+                if id(val) not in pruned
+            ]
+
+    def add_auth(self, auth):
+        """
+        Stores a new version of a user, and writes it to the journal if
+        there is one.
+        """
+        self.store_auth(auth)
+        self._journal('auth', auth)
+
+    def store_auth(self, auth):
+        """
+        Appends a new version of a user to authTable, marking the previously
+        active version of that user inactive.
+
+        In compact mode, the given dict is stored as an AuthRow.
+        """
+        if self.compact:
+            auth = AuthRow.from_dict(auth)
+
+        previous = self.authByUser.get(auth['user'], None)
+        self.authTable.append(auth)
+
+        if auth['active']:
+            self.authByUser[auth['user']] = auth
+        elif previous is not None:
+            del self.authByUser[auth['user']]
+
+        if previous is not None:
+            previous['active'] = False
+
+    def _journal(self, table, row):
+        if self.journal and self.journal.write(table, row):
+            self.journal.snapshot(self)
 
     def is_open(self):
         return self.state == DbState.Open
@@ -122,10 +417,9 @@ class CityHallDbFactory(DbFactory):
         if not self.authTable:
             return None
 
-        for auth in self.authTable:
-            if auth['active'] and (auth['pass'] == passhash)\
-                    and (auth['user'] == user):
-                return auth['user_root']
+        auth = self.authByUser.get(user, None)
+        if auth and auth['pass'] == passhash:
+            return auth['user_root']
         return False
 
     def get_db(self):
@@ -0,0 +1,153 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import pickle
+import simplejson as json
+from datetime import datetime
+from api.db.memory.rows import as_dict
+
+
+class Journal(object):
+    """
+    Makes the in-memory db durable.
+
+    Every row the db stores is appended, as one JSON line, to the journal
+    file.  Every `snapshot_every` lines, the tables are pickled to
+    `<journal>.snapshot` and the journal is started over.  Each line carries
+    a sequence number, and the snapshot records the last one it contains, so
+    a crash between writing the snapshot and truncating the journal is safe.
+
+    Restoring loads the snapshot through mmap and then replays only the
+    journal lines written after it.
+    """
+    def __init__(self, path, snapshot_every):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.entries = 0
+        self.file = None
+
+    def restore(self, factory):
+        """
+        Loads the snapshot and journal (if any) into the factory's tables.
+
+        :return: True if any state was found on disk
+        """
+        snapshot_seq = self._load_snapshot(factory)
+        restored = snapshot_seq is not None
+        self.seq = snapshot_seq or 0
+
+        if not os.path.exists(self.path):
+            return restored
+
+        good_length = 0
+        with open(self.path, 'rb') as journal:
+            for line in journal:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Incomplete journal entry')
+                    entry = json.loads(line)
+                except ValueError:
+                    # a write torn by a crash: nothing follows it, and it must
+                    # be cut off so that new entries start on a fresh line
+                    os.truncate(self.path, good_length)
+                    break
+                good_length += len(line)
+
+                if entry['seq'] <= self.seq:
+                    continue
+
+                if not restored:
+                    factory.clear_tables()
+                    restored = True
+
+                row = entry['row']
+                row['datetime'] = datetime.fromisoformat(row['datetime'])
+                if entry['table'] == 'vals':
+                    factory.store_value(row)
+                else:
+                    factory.store_auth(row)
+
+                self.seq = entry['seq']
+                self.entries += 1
+
+        return restored
+
+    def _load_snapshot(self, factory):
+        if not os.path.exists(self.snapshot_path) or \
+                os.path.getsize(self.snapshot_path) == 0:
+            return None
+
+        with open(self.snapshot_path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            state = pickle.loads(mapped)
+
+        factory.valsTable = state['valsTable']
+        factory.valsHistory = state['valsHistory']
+        factory.authTable = state['authTable']
+        factory.index_auth()
+        factory.index_values()
+        return state['seq']
+
+    def write(self, table, row):
+        """
+        Appends a row to the journal, taking a snapshot of the factory's
+        tables once enough rows have been written.
+
+        :param table: 'vals' or 'auth'
+        :return: True if a snapshot is due
+        """
+        if self.file is None:
+            self.file = open(self.path, 'a')
+
+        row = dict(as_dict(row))
+        row['datetime'] = row['datetime'].isoformat()
+        self.seq += 1
+        self.file.write(
+            json.dumps({'seq': self.seq, 'table': table, 'row': row}) + '\n'
+        )
+        self.file.flush()
+
+        self.entries += 1
+        return self.entries >= self.snapshot_every
+
+    def snapshot(self, factory):
+        temp_path = self.snapshot_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            pickle.dump(
+                {
+                    'seq': self.seq,
+                    'valsTable': factory.valsTable,
+                    'valsHistory': factory.valsHistory,
+                    'authTable': factory.authTable,
+                },
+                f,
+                pickle.HIGHEST_PROTOCOL,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'w')
+        self.entries = 0
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
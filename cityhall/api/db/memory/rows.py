@@ -0,0 +1,98 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from sys import intern
+
+
+class Row(object):
+    """
+    A compact, fixed-layout replacement for the dicts the in-memory db stores
+    in its tables.  Rows still support row['key'] reads and writes, so the
+    db code is the same whichever representation is used, but they are never
+    handed out past the Db interface; callers get as_dict() copies instead.
+
+    Subclasses list their keys in `fields`, and map any key which is not a
+    valid attribute name to a slot in `slot_names`.
+    """
+    __slots__ = ()
+    fields = ()
+    slot_names = {}
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, self.slot_names.get(key, key))
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, self.slot_names.get(key, key), value)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def keys(self):
+        return self.fields
+
+    def as_dict(self):
+        return {key: self[key] for key in self.fields}
+
+    @classmethod
+    def from_dict(cls, row):
+        ret = cls()
+        for key in cls.fields:
+            ret[key] = row[key]
+        return ret
+
+
+class ValueRow(Row):
+    __slots__ = (
+        'id', 'parent', 'active', 'name', 'override', 'author', 'datetime',
+        'value', 'protect', 'first_last',
+    )
+    fields = __slots__
+
+    @classmethod
+    def from_dict(cls, row):
+        ret = super(ValueRow, cls).from_dict(row)
+        ret.name = intern(ret.name)
+        ret.override = intern(ret.override)
+        ret.author = intern(ret.author)
+        return ret
+
+
+class AuthRow(Row):
+    __slots__ = (
+        'id', 'active', 'datetime', 'user_root', 'author', 'user', 'passhash',
+    )
+    fields = (
+        'id', 'active', 'datetime', 'user_root', 'author', 'user', 'pass',
+    )
+    slot_names = {'pass': 'passhash'}
+
+    @classmethod
+    def from_dict(cls, row):
+        ret = super(AuthRow, cls).from_dict(row)
+        ret.user = intern(ret.user)
+        ret.author = intern(ret.author)
+        return ret
+
+
+def as_dict(row):
+    """
+    Returns the given row as a dict.  Rows which are already dicts are
+    returned as they are.
+    """
+    if row is None or isinstance(row, dict):
+        return row
+    return row.as_dict()
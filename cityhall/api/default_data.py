@@ -18,6 +18,8 @@ def load_default_data(apps, schema_editor):
     # version than this migration expects. We use the historical version.
     usermodel = apps.get_model("api", "User")
     valuemodel = apps.get_model("api", "Value")
+    # the alias being migrated, rather than wherever the router sends writes
+    db = schema_editor.connection.alias
 
     auto_env = valuemodel()
     auto_env.active = True
@@ -29,7 +31,7 @@ def load_default_data(apps, schema_editor):
     auto_env.entry = ''
     auto_env.protect = False
     auto_env.first_last = True
-    auto_env.save()
+    auto_env.save(using=db)
 
     users_env = valuemodel()
     users_env.active = True
@@ -41,7 +43,7 @@ def load_default_data(apps, schema_editor):
     users_env.entry = ''
     users_env.protect = False
     users_env.first_last = True
-    users_env.save()
+    users_env.save(using=db)
 
     cityhall_user = valuemodel()
     cityhall_user.active = True
@@ -53,7 +55,7 @@ def load_default_data(apps, schema_editor):
     cityhall_user.entry = ''
     cityhall_user.protect = False
     cityhall_user.first_last = True
-    cityhall_user.save()
+    cityhall_user.save(using=db)
 
     cityhall_auto_rights = valuemodel()
     cityhall_auto_rights.active = True
@@ -65,7 +67,7 @@ def load_default_data(apps, schema_editor):
     cityhall_auto_rights.entry = '4'
     cityhall_auto_rights.protect = False
     cityhall_auto_rights.first_last = True
-    cityhall_auto_rights.save()
+    cityhall_auto_rights.save(using=db)
 
     cityhall_users_rights = valuemodel()
     cityhall_users_rights.active = True
@@ -77,7 +79,7 @@ def load_default_data(apps, schema_editor):
     cityhall_users_rights.entry = '4'
     cityhall_users_rights.protect = False
     cityhall_users_rights.first_last = True
-    cityhall_users_rights.save()
+    cityhall_users_rights.save(using=db)
 
     connect = valuemodel()
     connect.active = True
@@ -89,7 +91,7 @@ def load_default_data(apps, schema_editor):
     connect.entry = ''
     connect.protect = False
     connect.first_last = True
-    connect.save()
+    connect.save(using=db)
 
     cityhall = usermodel()
     cityhall.active = True
@@ -97,4 +99,4 @@ def load_default_data(apps, schema_editor):
     cityhall.author = 'cityhall'
     cityhall.name = 'cityhall'
     cityhall.password = ''
-    cityhall.save()
+    cityhall.save(using=db)
@@ -0,0 +1,36 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# Generated by Django 3.0.8 on 2026-10-18 08:34
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_auto_20150826_0210'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='user',
+            index_together={('user_root', 'active'), ('name', 'password', 'active')},
+        ),
+        migrations.AlterIndexTogether(
+            name='value',
+            index_together={('active', 'parent', 'name', 'override'), ('active', 'id'), ('active', 'parent', 'id'), ('active', 'name', 'parent')},
+        ),
+    ]
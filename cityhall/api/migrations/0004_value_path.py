@@ -0,0 +1,73 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generated by Django 3.0.8 on 2026-10-18 08:49
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 500
+
+
+def backfill_paths(apps, schema_editor):
+    """
+    Fills in Value.path (see api.models.value_path) one level of the tree at
+    a time, starting from the roots, so only values which can be reached
+    from a root get a path.
+    """
+    valuemodel = apps.get_model("api", "Value")
+    values = valuemodel.objects.using(schema_editor.connection.alias)
+
+    roots = list(values.filter(active=True, parent=-1))
+    for root in roots:
+        root.path = f"{root.id}/:"
+    values.bulk_update(roots, ['path'], batch_size=BATCH_SIZE)
+
+    # id of a value -> what the paths of its children start with
+    prefixes = {root.id: f"{root.id}/" for root in roots}
+
+    while prefixes:
+        parent_ids = list(prefixes)
+        next_prefixes = {}
+
+        for start in range(0, len(parent_ids), BATCH_SIZE):
+            children = list(values.filter(
+                active=True, parent__in=parent_ids[start:start + BATCH_SIZE]
+            ))
+            for child in children:
+                prefix = f"{prefixes[child.parent]}{child.name}/"
+                child.path = f"{prefix}:{child.override}"
+                if child.override == '':
+                    next_prefixes[child.id] = prefix
+            values.bulk_update(
+                children, ['path'], batch_size=BATCH_SIZE
+            )
+
+        prefixes = next_prefixes
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_permission_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='value',
+            name='path',
+            field=models.TextField(db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,90 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generated by Django 3.0.8 on 2026-10-18 09:04
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 500
+COLUMNS = 'id, parent, name, override, author, datetime, entry, protect, first_last'
+
+
+def move_history(apps, schema_editor):
+    """
+    Moves the inactive versions of values to ValueHistory, BATCH_SIZE at a
+    time and oldest first, so that they stay in order.
+    """
+    historymodel = apps.get_model("api", "ValueHistory")
+    alias = schema_editor.connection.alias
+    values = apps.get_model("api", "Value").objects.using(alias)
+
+    while True:
+        batch = list(
+            values.filter(active=False).order_by('entry_id')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+
+        historymodel.objects.using(alias).bulk_create([
+            historymodel(
+                id=val.id, parent=val.parent, name=val.name,
+                override=val.override, author=val.author,
+                datetime=val.datetime, entry=val.entry, protect=val.protect,
+                first_last=val.first_last,
+            )
+            for val in batch
+        ])
+        values.filter(entry_id__in=[val.entry_id for val in batch]).delete()
+
+
+def restore_history(apps, schema_editor):
+    # in SQL, as saving a Value would change its datetime
+    value_table = apps.get_model("api", "Value")._meta.db_table
+    history_table = apps.get_model("api", "ValueHistory")._meta.db_table
+    schema_editor.execute(
+        f"INSERT INTO {value_table} (active, {COLUMNS}) "
+        f"SELECT %s, {COLUMNS} FROM {history_table} ORDER BY entry_id",
+        [False]
+    )
+    schema_editor.execute(f"DELETE FROM {history_table}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_value_path'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ValueHistory',
+            fields=[
+                ('entry_id', models.AutoField(primary_key=True, serialize=False)),
+                ('id', models.IntegerField(db_index=True)),
+                ('parent', models.IntegerField()),
+                ('name', models.TextField(max_length=128)),
+                ('override', models.TextField(max_length=64)),
+                ('author', models.TextField(max_length=64)),
+                ('datetime', models.DateTimeField()),
+                ('entry', models.TextField(max_length=2048)),
+                ('protect', models.BooleanField()),
+                ('first_last', models.BooleanField()),
+            ],
+            options={
+                'index_together': {('parent', 'first_last')},
+            },
+        ),
+        migrations.RunPython(move_history, restore_history),
+    ]
@@ -0,0 +1,36 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generated by Django 3.0.8 on 2026-10-18 09:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_value_history'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='valuehistory',
+            name='id',
+            field=models.IntegerField(),
+        ),
+        migrations.AlterIndexTogether(
+            name='valuehistory',
+            index_together={('id', 'datetime'), ('parent', 'first_last', 'datetime')},
+        ),
+    ]
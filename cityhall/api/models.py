@@ -12,10 +12,232 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from django.db import models, transaction
+import sqlite3
+from django.db import connections, models, router, transaction
+from django.db.models.functions import Left
+from django.utils import timezone
 
 
 class ValueManager(models.Manager):
+    def _write_connection(self):
+        return connections[router.db_for_write(self.model)]
+
+    def _next_entry_id_sql(self, connection):
+        """
+        SQL for the entry_id the database will give the next row it inserts,
+        so that a new value can take its id from it in the same INSERT.
+
+        :return: the SQL, or None if writes can't be done with a single
+         INSERT ... RETURNING on this database
+        """
+        table = self.model._meta.db_table
+
+        if connection.vendor == 'postgresql':
+            return f"nextval(pg_get_serial_sequence('{table}', 'entry_id'))"
+        if connection.vendor == 'sqlite' and \
+                sqlite3.sqlite_version_info >= (3, 35):
+            # exactly what AUTOINCREMENT would pick
+            return f"COALESCE((SELECT seq FROM sqlite_sequence " \
+                f"WHERE name = '{table}'), 0) + 1"
+        return None
+
+    def insert_new(self, value):
+        """
+        Inserts the first version of a new value, with its id (the entry_id
+        of that first version) and its path worked out by the database, in
+        a single statement.
+
+        :return: False if this database doesn't support it, in which case
+         nothing was inserted
+        """
+        connection = self._write_connection()
+        next_entry_id = self._next_entry_id_sql(connection)
+        if next_entry_id is None:
+            return False
+
+        table = self.model._meta.db_table
+        fields = [
+            field for field in self.model._meta.concrete_fields
+            if field.attname not in ('entry_id', 'id', 'path')
+        ]
+        params = [
+            field.get_db_prep_save(field.pre_save(value, True), connection)
+            for field in fields
+        ]
+
+        if value.path is not None:
+            path_sql = '%s'
+            params.append(value.path)
+        elif value.parent < 0:
+            path_sql = "CAST(allocated.entry_id AS TEXT) || '/:'"
+        else:
+            # see value_path() and Value.child_path(); the path of a global
+            # parent always ends in ':'
+            path_sql = f"""(
+                SELECT SUBSTR(parent.path, 1, LENGTH(parent.path) - 1) || %s
+                FROM {table} parent
+                WHERE parent.active = %s AND parent.id = %s
+                    AND parent.override = ''
+            )"""
+            params += [f"{value.name}/:{value.override}", True, value.parent]
+
+        columns = ', '.join(field.column for field in fields)
+        placeholders = ', '.join(['%s'] * len(fields))
+        sql = f"""
+            INSERT INTO {table} (entry_id, id, {columns}, path)
+            SELECT allocated.entry_id, allocated.entry_id, {placeholders},
+                {path_sql}
+            FROM (SELECT {next_entry_id} AS entry_id) allocated
+            RETURNING entry_id, path
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            value.entry_id, value.path = cursor.fetchone()
+
+        value.id = value.entry_id
+        value._state.adding = False
+        value._state.db = connection.alias
+        return True
+
+    def archive(self, ids, deleted_by=None):
+        """
+        Copies the active versions of the given values to ValueHistory, with
+        a single INSERT ... SELECT, before they are changed or deleted.
+
+        :param deleted_by: if the values are being deleted, who by; the
+         deletion is recorded after them as their last version
+        """
+        if not ids:
+            return
+
+        connection = self._write_connection()
+        table = self.model._meta.db_table
+        fields = [
+            field for field in ValueHistory._meta.concrete_fields
+            if field.attname != 'entry_id'
+        ]
+        where = f"FROM {table} WHERE active = %s AND id IN " \
+            f"({', '.join(['%s'] * len(ids))})"
+        params = [True] + list(ids)
+        selects = [
+            f"SELECT {', '.join(field.column for field in fields)} {where}"
+        ]
+
+        if deleted_by is not None:
+            deletion = {
+                'author': deleted_by,
+                'datetime': timezone.now(),
+                'first_last': True,
+            }
+            columns = []
+            for field in fields:
+                if field.attname in deletion:
+                    columns.append('%s')
+                    params.append(field.get_db_prep_save(
+                        deletion[field.attname], connection
+                    ))
+                else:
+                    columns.append(field.column)
+            selects.append(f"SELECT {', '.join(columns)} {where}")
+            params += [True] + list(ids)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {ValueHistory._meta.db_table} "
+                f"({', '.join(field.column for field in fields)}) "
+                f"{' UNION ALL '.join(selects)}",
+                params
+            )
+
+    def supersede(self, id, author, **changes):
+        """
+        Replaces the active version of a value with one changed as given,
+        moving the previous version to ValueHistory.  The new version keeps
+        the row (and entry_id) of the previous one.
+
+        :return: whether the value exists
+        """
+        current = self.lock(id)
+        if current is None:
+            return False
+
+        self.archive([id])
+        self.filter(entry_id=current.entry_id).update(
+            author=author, datetime=timezone.now(), first_last=False, **changes
+        )
+        return True
+
+    def lock_for_writes(self):
+        """
+        On SQLite, takes the write lock for the rest of the transaction, so
+        that nothing it reads afterwards (see reserve_entry_ids()) can be
+        changed by another writer before it commits.  Should be called
+        before the transaction reads anything, or taking the lock may fail
+        because another writer has committed since.
+        """
+        connection = self._write_connection()
+        if connection.vendor != 'sqlite':
+            return
+
+        with connection.cursor() as cursor:
+            # a write takes the lock, even if it changes nothing
+            cursor.execute(
+                "UPDATE sqlite_sequence SET seq = seq WHERE name = %s",
+                [self.model._meta.db_table]
+            )
+
+    def reserve_entry_ids(self, count):
+        """
+        Reserves the entry_ids of the next `count` rows, so that new values
+        can be inserted in bulk with their ids known up front.  On SQLite,
+        this must be called once the transaction holds the write lock, see
+        lock_for_writes().
+
+        :return: the entry_ids, or None if this database doesn't support it
+        """
+        connection = self._write_connection()
+        next_entry_id = self._next_entry_id_sql(connection)
+        if next_entry_id is None:
+            return None
+        if count == 0:
+            return []
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    f"SELECT {next_entry_id} FROM generate_series(1, %s)",
+                    [count]
+                )
+                return [row[0] for row in cursor.fetchall()]
+
+            cursor.execute(f"SELECT {next_entry_id}")
+            first = cursor.fetchone()[0]
+            return list(range(first, first + count))
+
+    def clear_paths_below(self, prefix):
+        """
+        Clears the paths which start with the given prefix, except for those
+        of the overrides of the value the prefix belongs to.
+        """
+        # LIKE is case insensitive on some databases, so the prefix is
+        # compared exactly as well
+        self.annotate(path_head=Left('path', len(prefix))).\
+            filter(active=True, path__startswith=prefix, path_head=prefix).\
+            exclude(path__startswith=prefix + ':').\
+            update(path=None)
+
+    def lock(self, id):
+        """
+        The active version of a value, locked against other writers until
+        the transaction ends, so that what is archived is exactly what is
+        then changed.  SQLite can't lock rows, but lets one writer at a time
+        past its first write, which archive() is.
+
+        :return: the Value, or None if it doesn't exist
+        """
+        return self.select_for_update().filter(active=True, id=id).first()
+
     def by_id(self, id):
         try:
             return self.get(active=True, id=id)
@@ -40,7 +262,28 @@ class ValueManager(models.Manager):
             return None
 
 
+def value_path(root_id, names, override=''):
+    """
+    The key stored in Value.path: the root id of the environment, the names
+    along the path and the override, e.g. '12/a/b/:override'.
+    """
+    return f"{root_id}/{''.join(name + '/' for name in names)}:{override}"
+
+
+def child_value_path(parent_path, parent_override, name, override=''):
+    # paths only lead through global values, so the children of an
+    # override can't be reached by one
+    if parent_path is None or parent_override:
+        return None
+    return f"{parent_path[:parent_path.rindex('/') + 1]}{name}/:{override}"
+
+
 class Value(models.Model):
+    """
+    The current version of a value.  Superseded versions are moved to
+    ValueHistory (see ValueManager.archive), so this table only holds rows
+    which are active.
+    """
     entry_id = models.AutoField(primary_key=True)
     active = models.BooleanField()
     id = models.IntegerField()
@@ -52,6 +295,9 @@ class Value(models.Model):
     entry = models.TextField(max_length=2048)
     protect = models.BooleanField()
     first_last = models.BooleanField()
+    # see value_path(); set on values which can be reached from the root of
+    # their environment
+    path = models.TextField(null=True, db_index=True)
 
     objects = ValueManager()
 
@@ -60,23 +306,77 @@ class Value(models.Model):
             ['active', 'id'],
             ['active', 'parent', 'id'],
             ['active', 'parent', 'name', 'override'],
+            ['active', 'name', 'parent'],
         ]
 
-    @transaction.atomic
     def save(self, *args, **kwargs):
+        """
+        Saves a new version of a value.  A new value (one without an id) is
+        given one from the entry_id of its first version, and, for roots and
+        children of global values, a path.
+        """
         need_new_id = (self.id is None) or (self.id < 0)
+        self.override = self.override or ''
+
+        if need_new_id and not kwargs and not args:
+            if Value.objects.insert_new(self):
+                return
 
         if need_new_id:
-            self.datetime = None
+            with transaction.atomic():
+                self._save_with_new_id(*args, **kwargs)
+        else:
+            super(Value, self).save(*args, **kwargs)
 
-        self.id = -1 if need_new_id else self.id
-        self.override = self.override or ''
+    def _save_with_new_id(self, *args, **kwargs):
+        # for databases which can't do it in one statement, see insert_new()
+        self.datetime = None
+        self.id = -1
+        super(Value, self).save(*args, **kwargs)
 
+        self.id = self.pk
+        if self.parent < 0:
+            self.path = value_path(self.id, [])
+        elif self.path is None:
+            parent = Value.objects.by_id(self.parent)
+            self.path = parent.child_path(self.name, self.override) \
+                if parent else None
         super(Value, self).save(*args, **kwargs)
 
-        if need_new_id:
-            self.id = self.pk
-            super(Value, self).save(*args, **kwargs)
+    @property
+    def path_prefix(self):
+        """
+        The path of this value without its override, which is what the paths
+        of its children start with.
+        """
+        return self.path[:self.path.rindex('/') + 1]
+
+    def child_path(self, name, override=''):
+        return child_value_path(self.path, self.override, name, override)
+
+
+class ValueHistory(models.Model):
+    """
+    Every superseded version of a value, and the deletion of a value as its
+    last version.  All of them are inactive.  Rows keep the datetime of the
+    version they were copied from, and are in order of entry_id for each id.
+    """
+    entry_id = models.AutoField(primary_key=True)
+    id = models.IntegerField()
+    parent = models.IntegerField()
+    name = models.TextField(max_length=128)
+    override = models.TextField(max_length=64)
+    author = models.TextField(max_length=64)
+    datetime = models.DateTimeField()
+    entry = models.TextField(max_length=2048)
+    protect = models.BooleanField()
+    first_last = models.BooleanField()
+
+    class Meta:
+        index_together = [
+            ['id', 'datetime'],
+            ['parent', 'first_last', 'datetime'],
+        ]
 
 
 class UserManager(models.Manager):
@@ -111,4 +411,5 @@ class User(models.Model):
     class Meta:
         index_together = [
             ['name', 'password', 'active'],
+            ['user_root', 'active'],
         ]
@@ -13,14 +13,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import simplejson as json
+from django.conf import settings
+from django.core import signing
 from restless.views import HttpResponse
-from api.session.serialize import serialize_auth, deserialize_auth
+from api.session.serialize import serialize_auth, deserialize_auth, pack_env
 from api.db import Rights
 from api.db.connection import Instance
 from six import text_type
 
 
 SESSION_AUTH = 'cityhall-auth'
+TOKEN_SCHEME = 'Token'
+TOKEN_SALT = 'cityhall-token'
+# where the Auth of a request's token is kept, once it has been verified
+TOKEN_AUTH = 'cityhall_token_auth'
 NOT_AUTHENTICATED = HttpResponse(
     content='{"Response": "Failure",'
     '"Message": "Session is not authenticated, and could not obtain get a guest credentials"}',
@@ -28,14 +34,69 @@ NOT_AUTHENTICATED = HttpResponse(
 )
 
 
+def token_options():
+    return settings.CITY_HALL_OPTIONS.get('token', {})
+
+
+def issue_token(auth):
+    """
+    Signs what auth may do right now into a token, which stands in for a
+    session until it expires: requests which carry it in their
+    'Authorization: Token <token>' header don't use the session at all.
+
+    The token holds the user's rights to every environment as they are
+    now, however many there are.  Until it expires, rights granted or
+    revoked afterwards, and even deleting the user, don't change what it
+    allows; the user has to get a new token to use new rights.
+    """
+    auth_state = serialize_auth(auth)
+    auth_state['envs'] = {
+        env: pack_env(auth.db.get_env_root(env), int(rights))
+        for env, rights in auth.get_user(auth.name).items()
+    }
+    return signing.dumps(auth_state, salt=TOKEN_SALT, compress=True)
+
+
+def get_token(request):
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return token if scheme == TOKEN_SCHEME and token else None
+
+
+def auth_from_token(request, token):
+    """
+    The Auth in the token the request carries, or None if the token is bad
+    or has expired.  The token is only verified once per request.
+    """
+    if not hasattr(request, TOKEN_AUTH):
+        setattr(request, TOKEN_AUTH, _verify_token(token))
+    return getattr(request, TOKEN_AUTH)
+
+
+def _verify_token(token):
+    try:
+        auth_state = signing.loads(
+            token, salt=TOKEN_SALT,
+            max_age=token_options().get('max_age', None),
+        )
+    except signing.BadSignature:
+        return None
+    return deserialize_auth(auth_state)
+
+
 def get_auth_or_create_guest(request):
-    auth_json = request.session.get(SESSION_AUTH, None)
-    if auth_json is None:
+    token = get_token(request)
+    if token is not None:
+        # a bad or expired token is not silently turned into a guest
+        return auth_from_token(request, token)
+
+    auth_state = request.session.get(SESSION_AUTH, None)
+    if auth_state is None:
         auth = Instance.get_auth('guest', '')
         if auth is not None:
             request.session[SESSION_AUTH] = serialize_auth(auth)
+            auth.mark_clean()
     else:
-        auth = deserialize_auth(auth_json)
+        auth = deserialize_auth(auth_state)
     return auth
 
 
@@ -86,6 +147,11 @@ def is_valid(request):
     if (request.method == 'POST') \
             or (request.method == 'DELETE')\
             or (request.method == 'PUT'):
+        token = get_token(request)
+        if token is not None:
+            return None \
+                if auth_from_token(request, token) is not None \
+                else NOT_AUTHENTICATED
         return None \
             if SESSION_AUTH in request.session \
             else HttpResponse('Must log in, first')
@@ -95,7 +161,11 @@ def is_valid(request):
 
 
 def end_request(request, auth):
-    request.session[SESSION_AUTH] = serialize_auth(auth)
+    # assigning to the session would save it, even if nothing changed; and
+    # a token can't be changed at all
+    if auth.dirty and get_token(request) is None:
+        request.session[SESSION_AUTH] = serialize_auth(auth)
+        auth.mark_clean()
 
 
 
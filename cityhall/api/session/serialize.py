@@ -18,55 +18,105 @@ from api.db.env import Env
 from api.db.connection import Instance
 
 
-def serialize_env(env):
-    env_dict = {
-        'env': env.env,
-        'permissions': env.permissions,
-        'name': env.name,
-        'root_id': env.root_id,
-        'cache': {name: value for name, value in env.cache.values.items()}
-    }
-    return json.dumps(env_dict)
+# written by serialize_auth(); what came before it was a JSON string with a
+# JSON string in it for every Env, which deserialize_auth() still reads
+AUTH_FORMAT = 2
+# an Env's permissions, from -1 (Rights.DontExist) up, are packed into the
+# low bits of its root id
+PERMISSION_BITS = 3
+PERMISSION_MASK = (1 << PERMISSION_BITS) - 1
 
 
-def deserialize_env(env_json):
-    env_dict = json.loads(env_json)
-    ret = Env(
-        db=Instance.db_connection.get_db(),
-        env=env_dict['env'],
-        permissions=env_dict['permissions'],
-        name=env_dict['name'],
-        root_id=env_dict['root_id']
-    )
+def pack_env(root_id, permissions):
+    """
+    Packs the root id and permissions of an Env into one integer, or into a
+    pair if the permissions don't fit.
+    """
+    if -1 <= permissions < PERMISSION_MASK:
+        return (root_id << PERMISSION_BITS) | (permissions + 1)
+    return [root_id, permissions]
 
-    for k, v in env_dict['cache'].items():
-        ret.cache[k] = v
 
-    return ret
+def unpack_env(packed):
+    """
+    :return: the root id and permissions packed by pack_env()
+    """
+    if isinstance(packed, list):
+        return packed[0], packed[1]
+    return packed >> PERMISSION_BITS, (packed & PERMISSION_MASK) - 1
+
+
+class SerializedEnv(object):
+    """
+    An Env as it is kept in the session, which deserialize_auth() leaves
+    alone until Auth.cached_env() asks for it, so that a request only pays
+    for the environments it uses.
+    """
+    __slots__ = ('env', 'name', 'packed')
+
+    def __init__(self, env, name, packed):
+        self.env = env
+        self.name = name
+        self.packed = packed
+
+    def load(self, db):
+        root_id, permissions = unpack_env(self.packed)
+        return Env(
+            db=db, env=self.env, permissions=permissions, name=self.name,
+            root_id=root_id,
+        )
 
 
 def serialize_auth(auth):
-    auth_dict = {
+    """
+    The state of auth as plain data, which the session (or a token, see
+    api.session.issue_token()) encodes in a single pass.  Each Env is
+    packed into an integer by its environment's name, and Envs which were
+    never decoded are written back as they were read.
+    """
+    envs = {}
+    for name, env in auth.roots_cache.values.items():
+        envs[name] = env.packed if isinstance(env, SerializedEnv) else \
+            pack_env(env.root_id, env.permissions)
+
+    return {
+        'format': AUTH_FORMAT,
         'name': auth.name,
         'user_root': auth.user_root,
         'users_env': auth.users_env,
-        'roots_cache': {
-            name: serialize_env(value)
-            for name, value in auth.roots_cache.values.items()
-        }
+        'envs': envs,
     }
-    return json.dumps(auth_dict)
 
 
-def deserialize_auth(auth_json):
+def _deserialize_old_auth(auth_json):
     auth_dict = json.loads(auth_json)
+    envs = {}
+    for name, env_json in auth_dict['roots_cache'].items():
+        env_dict = json.loads(env_json)
+        envs[name] = pack_env(env_dict['root_id'], env_dict['permissions'])
+    auth_dict['envs'] = envs
+    return auth_dict
+
+
+def deserialize_auth(auth_state):
+    old = isinstance(auth_state, str)
+    if old:
+        auth_state = _deserialize_old_auth(auth_state)
+
     ret = Auth(
         db=Instance.db_connection.get_db(),
-        name=auth_dict['name'],
-        user_root=auth_dict['user_root']
+        name=auth_state['name'],
+        user_root=auth_state['user_root']
+    )
+    ret.users_env = auth_state['users_env']
+    # a token holds every environment of its user, see
+    # api.session.issue_token()
+    ret.roots_cache.capacity = max(
+        ret.roots_cache.capacity, len(auth_state['envs'])
     )
-    ret.users_env = auth_dict['users_env']
-    for name, value in auth_dict['roots_cache'].items():
-        ret.roots_cache[name] = deserialize_env(value)
+    for name, packed in auth_state['envs'].items():
+        ret.roots_cache[name] = SerializedEnv(name, ret.name, packed)
+    ret.mark_clean()
+    # so that the session is written again in the current format
+    ret.changed = old
     return ret
-
@@ -17,7 +17,7 @@ from api.views import (Info, Create)
 from api.views.auth import (
     Authenticate, Environments, Users, GrantRights, UserDefaultEnv
 )
-from api.views.env import EnvView
+from api.views.env import EnvView, EnvBatchView
 
 urlpatterns = [
     url(r"^info/?$", Info.as_view(), name="info_home"),
@@ -41,6 +41,11 @@ urlpatterns = [
     ),
     url(r"^auth/grant/?$", GrantRights.as_view(), name="grant_rights"),
 
+    url(
+        r"^batch/(?P<env>[0-9a-zA-Z\-_.$]+)/?$",
+        EnvBatchView.as_view(),
+        name="batch"
+    ),
     url(
         r"^env/(?P<env_path>.*)$",
         EnvView.as_view(),
@@ -17,7 +17,8 @@ from django.conf import settings
 from api.db.connection import Instance
 from api.session import (
     is_valid, get_auth_from_request, get_auth_or_create_guest,
-    end_request, NOT_AUTHENTICATED, SESSION_AUTH, clean_data
+    end_request, NOT_AUTHENTICATED, SESSION_AUTH, clean_data,
+    issue_token, get_token
 )
 
 
@@ -46,11 +47,16 @@ class Authenticate(Endpoint):
                     'Message': 'Invalid username/password'
                 }
 
+            version = Instance.db_connection.get_db().settings('version')
+            if request.data.get('token', False):
+                return {
+                    'Response': 'Ok',
+                    'version': version,
+                    'Token': issue_token(auth),
+                }
+
             end_request(request, auth)
-            return {
-                'Response': 'Ok',
-                'version': Instance.db_connection.get_db().settings('version'),
-            }
+            return {'Response': 'Ok', 'version': version}
 
         return {
             'Response': 'Failure',
@@ -59,6 +65,13 @@ class Authenticate(Endpoint):
         }
 
     def delete(self, request, *args, **kwargs):
+        if get_token(request) is not None:
+            return {
+                "Response": "Failure",
+                "Message": "Tokens are not kept by City Hall, so they can't "
+                           "be logged out of, they expire instead"
+            }
+
         auth_json = request.session.get(SESSION_AUTH, None)
         if auth_json is None:
             return {
@@ -12,9 +12,73 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import simplejson as json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from django.utils.dateparse import parse_datetime
 from restless.views import Endpoint
 from api.session import is_valid, get_auth_from_request, end_request
-from api.db import Rights
+from api.db import Rights, CHILD_RESPONSE_FIELDS
+
+
+def parse_protect(protect):
+    return str(protect).upper() in ['1', 'TRUE', 'Y', 'YES', ]
+
+
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    :return: the pair encoded by encode_cursor(), e.g. the (name, override)
+     of a child
+    :raises ValueError: if the cursor wasn't made by encode_cursor()
+    """
+    try:
+        first, second = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return first, second
+
+
+def decode_history_cursor(cursor):
+    """
+    :return: the (datetime, seen) of a cursor into history
+    :raises ValueError: if the cursor isn't one
+    """
+    when, seen = decode_cursor(cursor)
+    try:
+        when, seen = parse_datetime(when), int(seen)
+    except (TypeError, ValueError):
+        when = None
+    if when is None:
+        raise ValueError(f'Invalid cursor: {cursor}')
+    return when, seen
+
+
+def parse_time(name, value):
+    """
+    :return: the ISO 8601 datetime in value, or None if there is no value
+    :raises ValueError: if value isn't one
+    """
+    if not value:
+        return None
+    try:
+        when = parse_datetime(value)
+    except ValueError:
+        when = None
+    if when is None:
+        raise ValueError(f'Expected {name} to be an ISO 8601 datetime')
+    return when
+
+
+def parse_limit(limit):
+    limit = None if limit is None else int(limit)
+    if limit is not None and limit < 1:
+        raise ValueError('Expected limit to be a positive number')
+    return limit
 
 
 class EnvView(Endpoint):
@@ -85,7 +149,7 @@ class EnvView(Endpoint):
             }
 
         if protect is not None:
-            protect = str(protect).upper() in ['1', 'TRUE', 'Y', 'YES', ]
+            protect = parse_protect(protect)
 
         env = info.auth.get_env(info.env)
 
@@ -118,8 +182,29 @@ class EnvView(Endpoint):
 
         call_args = [info.auth, info.env, info.path, info.override]
 
-        if 'viewchildren' in request.GET:
+        if 'tree' in request.GET:
+            ret = EnvView.get_tree_for(
+                *call_args, request.GET.get('depth', None)
+            )
+        elif 'viewchildren' in request.GET and (
+                {'limit', 'after', 'fields'} & set(request.GET)):
+            ret = EnvView.get_children_page_for(
+                *call_args,
+                request.GET.get('limit', None),
+                request.GET.get('after', None),
+                request.GET.get('fields', None),
+            )
+        elif 'viewchildren' in request.GET:
             ret = EnvView.get_children_for(*call_args)
+        elif 'viewhistory' in request.GET and (
+                {'since', 'until', 'limit', 'cursor'} & set(request.GET)):
+            ret = EnvView.get_history_page_for(
+                *call_args,
+                request.GET.get('since', None),
+                request.GET.get('until', None),
+                request.GET.get('limit', None),
+                request.GET.get('cursor', None),
+            )
         elif 'viewhistory' in request.GET:
             ret = EnvView.get_history_for(*call_args)
         else:
@@ -156,6 +241,36 @@ class EnvView(Endpoint):
             'History': auth.get_env(env).get_history(path, override)
         }
 
+    @staticmethod
+    def get_history_page_for(auth, env, path, override, since, until, limit,
+                             cursor):
+        """
+        History, oldest first, a page at a time.  'since' and 'until' are
+        ISO 8601 datetimes to leave out versions before and from, 'limit'
+        is the size of the page, and 'cursor' the 'next' cursor returned
+        with the previous page.
+        """
+        override = '' if not override else override
+
+        try:
+            since = parse_time('since', since)
+            until = parse_time('until', until)
+            limit = parse_limit(limit)
+            after = None if not cursor else decode_history_cursor(cursor)
+        except ValueError as e:
+            return {'Response': 'Failure', 'Message': str(e)}
+
+        history, after = auth.get_env(env).get_history_page(
+            path, override, since, until, after, limit
+        )
+
+        return {
+            'Response': 'Ok',
+            'History': history,
+            'next': None if after is None else
+            encode_cursor((after[0].isoformat(), after[1])),
+        }
+
     @staticmethod
     def get_children_for(auth, env, path, override=None):
         if override:
@@ -172,3 +287,123 @@ class EnvView(Endpoint):
             'path': sanitized_path,
             'children': children
         }
+
+    @staticmethod
+    def get_tree_for(auth, env, path, override, depth):
+        if override:
+            return {
+                'Response': 'Failure',
+                'Message': 'Cannot get children for an override',
+            }
+
+        try:
+            depth = None if depth in (None, '') else int(depth)
+            if depth is not None and depth < 1:
+                raise ValueError
+        except ValueError:
+            return {
+                'Response': 'Failure',
+                'Message': 'Expected depth to be a positive number',
+            }
+
+        return {
+            'Response': 'Ok',
+            'path': EnvView._sanitize(env, path),
+            'children': auth.get_env(env).get_tree(path, depth),
+        }
+
+    @staticmethod
+    def get_children_page_for(auth, env, path, override, limit, after, fields):
+        """
+        Children, sorted by name and override, a page at a time.  'limit' is
+        the size of the page, 'after' the 'next' cursor returned with the
+        previous page, and 'fields' a comma separated list of the fields to
+        return for each child.
+        """
+        if override:
+            return {
+                'Response': 'Failure',
+                'Message': 'Cannot get children for an override',
+            }
+
+        try:
+            limit = parse_limit(limit)
+            after = None if not after else decode_cursor(after)
+        except ValueError as e:
+            return {'Response': 'Failure', 'Message': str(e)}
+
+        fields = [field for field in (fields or '').split(',') if field]
+        unknown = [
+            field for field in fields if field not in CHILD_RESPONSE_FIELDS
+        ]
+        if unknown:
+            return {
+                'Response': 'Failure',
+                'Message': f'Unknown fields: {", ".join(unknown)}, expected '
+                           f'any of: {", ".join(CHILD_RESPONSE_FIELDS)}',
+            }
+
+        children, cursor = auth.get_env(env).get_children_page(
+            path, after, limit, fields or None
+        )
+
+        return {
+            'Response': 'Ok',
+            'path': EnvView._sanitize(env, path),
+            'children': children,
+            'next': encode_cursor(cursor),
+        }
+
+
+class EnvBatchView(Endpoint):
+    """
+    Sets many values of one environment at once, all or nothing.  Expects
+    {"operations": [{"path": ..., "override": ..., "value": ...,
+    "protect": ...}, ...]}, and returns a result for each operation.
+    """
+    def authenticate(self, request):
+        return is_valid(request)
+
+    def post(self, request, *args, **kwargs):
+        env_name = kwargs.get('env', None)
+        operations = request.data.get('operations', None)
+
+        if (not env_name) or (not isinstance(operations, list)) or \
+                not all(isinstance(op, dict) for op in operations):
+            return {
+                'Response': 'Failure',
+                'Message': 'Expected an environment, and a list of '
+                           'operations to apply to it'
+            }
+
+        auth = get_auth_from_request(request, env_name)
+        if not auth[0]:
+            return auth[1]
+
+        env = auth[1].get_env(env_name)
+        if int(env.permissions) < Rights.Write:
+            return {
+                'Response': 'Failure',
+                'Message': f'Do not have write permissions to {env_name}'
+            }
+
+        items = [
+            dict(op, protect=parse_protect(op['protect']))
+            if op.get('protect', None) is not None else op
+            for op in operations
+        ]
+
+        try:
+            applied, results = env.set_many(items)
+        except Exception as e:
+            return {'Response': 'Failure', 'Message': str(e)}
+
+        if not applied:
+            return {
+                'Response': 'Failure',
+                'Message': 'No operations were applied, see Results',
+                'Results': results,
+            }
+
+        end_request(request, auth[1])
+        return {'Response': 'Ok', 'Results': results}
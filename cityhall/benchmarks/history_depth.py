@@ -0,0 +1,136 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures reads of active values on the Django db as their history grows,
+with the history in ValueHistory, against the same history left inline in
+api_value as inactive rows (how every version used to be stored).  Run from
+the cityhall directory:
+
+    python -m benchmarks.history_depth [--values 1000] [--depth 1 10 100]
+
+A throwaway test database is created and migrated.  For every depth and
+layout, an environment of 'values' values is built, each with 'depth'
+versions, and get_value, get_value_for and get_children_of are timed on it,
+before it is deleted again.
+"""
+
+import argparse
+import os
+import random
+import timeit
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cityhall.settings')
+django.setup()
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+from api.db.django.db_factory import Factory
+from api.models import Value, ValueHistory, value_path
+
+LAYOUTS = ('history', 'inline')
+
+
+def build_env(db, env, values, depth, layout):
+    """
+    :return: the root id of the new environment, and the ids and names of
+     its values
+    """
+    root = db.create_root('cityhall', env)
+    next_id = Value.objects.order_by('-id').values_list('id', flat=True)[0] + 1
+    now = timezone.now()
+    names = [f'item{i}' for i in range(values)]
+    ids = [next_id + i for i in range(values)]
+
+    def version(index, name, entry, active):
+        fields = dict(
+            id=index, parent=root, name=name, override='', author='cityhall',
+            datetime=now, entry=entry, protect=False, first_last=entry == '0',
+        )
+        if layout == 'history' and not active:
+            return ValueHistory(**fields)
+        return Value(active=active, path=value_path(root, [name]), **fields)
+
+    # older versions first, as they would have been written
+    old = [
+        version(index, name, str(number), False)
+        for number in range(depth - 1)
+        for index, name in zip(ids, names)
+    ]
+    current = [
+        version(index, name, str(depth - 1), True)
+        for index, name in zip(ids, names)
+    ]
+
+    if layout == 'history':
+        ValueHistory.objects.bulk_create(old, batch_size=400)
+    else:
+        Value.objects.bulk_create(old, batch_size=400)
+    Value.objects.bulk_create(current, batch_size=400)
+
+    return root, ids, names
+
+
+def measure(read, repeat):
+    seconds = min(timeit.repeat(read, number=1, repeat=repeat))
+    return seconds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--values', type=int, default=1000)
+    parser.add_argument('--depth', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--reads', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    connection.creation.create_test_db(verbosity=0)
+    db = Factory(settings.CITY_HALL_OPTIONS).get_db()
+
+    print(f"{'depth':>5} {'layout':>8} {'rows':>9} {'get_value ms':>12} "
+          f"{'value_for ms':>12} {'children ms':>11}")
+
+    for depth in args.depth:
+        for layout in LAYOUTS:
+            root, ids, names = build_env(
+                db, f'bench{depth}{layout}', args.values, depth, layout
+            )
+            sample = random.sample(range(args.values), min(args.reads, args.values))
+
+            def get_value():
+                for i in sample:
+                    db.get_value(ids[i])
+
+            def get_value_for():
+                for i in sample:
+                    db.get_value_for(root, names[i], '')
+
+            def get_children_of():
+                db.get_children_of(root)
+
+            assert db.get_value(ids[0]) == (str(depth - 1), False)
+            print(f"{depth:>5} {layout:>8} {Value.objects.count():>9} "
+                  f"{measure(get_value, args.repeat):>12.2f} "
+                  f"{measure(get_value_for, args.repeat):>12.2f} "
+                  f"{measure(get_children_of, args.repeat):>11.2f}")
+
+            # so the next environment is measured on its own
+            Value.objects.filter(parent=root).delete()
+            ValueHistory.objects.filter(parent=root).delete()
+
+
+if __name__ == '__main__':
+    main()
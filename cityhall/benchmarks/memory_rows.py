@@ -0,0 +1,82 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the memory used per value by the in-memory db, with and without
+'compact_rows'.  Run from the cityhall directory:
+
+    python -m benchmarks.memory_rows [--count 1000000]
+
+Names and authors are built fresh for every write, the way they would be
+when parsed out of separate requests, so that duplicated strings show up in
+the measurement.
+"""
+
+import argparse
+import gc
+import tracemalloc
+from api.db.memory.db_factory import CityHallDbFactory
+
+
+FOLDERS = 1000
+
+
+def populate(factory, count):
+    db = factory.get_db()
+    root = db.create_root('cityhall', 'bench')
+    folders = [
+        db.create('cityhall', root, f'folder{i}', '')
+        for i in range(FOLDERS)
+    ]
+
+    for i in range(count):
+        author = ''.join(['city', 'hall'])
+        name = f'value{i // FOLDERS}'
+        db.create(author, folders[i % FOLDERS], name, str(i))
+
+
+def measure(compact, count):
+    factory = CityHallDbFactory({
+        'cache': {'path_capacity': 50, 'env_capacity': 10},
+        'memory': {'compact_rows': compact},
+    })
+    factory.open()
+    factory.create_default_tables()
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    populate(factory, count)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return (after - before) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--count', type=int, default=1000000)
+    args = parser.parse_args()
+
+    for compact in (False, True):
+        per_row = measure(compact, args.count)
+        print(
+            f"compact_rows={compact!s:5}: {args.count} values, "
+            f"{per_row:.1f} bytes per value (rows, history and indexes)"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Compares resolving a path on the Django db one level at a time (a query per
+level, scanning every sibling) against Db.get_path_index (one indexed lookup
+of Value.path).  Run
+from the cityhall directory:
+
+    python -m benchmarks.path_resolution [--depth 20] [--fanout 10 100 1000 10000]
+
+A throwaway test database is created and migrated.  For every fan-out, a
+chain 'depth' levels deep is built, with 'fanout' siblings at each level,
+and each prefix of the chain is resolved with a cold cache.
+"""
+
+import argparse
+import os
+import timeit
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cityhall.settings')
+django.setup()
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from api.db import Rights
+from api.db.django.db_factory import Factory
+from api.db.env import Env
+from api.models import Value, value_path
+
+
+def build_chain(db, env, depth, fanout):
+    """
+    :return: the root id of the new environment, and the names along the
+     chain
+    """
+    root = db.create_root('cityhall', env)
+    next_id = Value.objects.order_by('-id').values_list('id', flat=True)[0] + 1
+    parent = root
+    names = []
+
+    for level in range(depth):
+        rows = [
+            Value(
+                active=True, id=next_id + i, parent=parent,
+                name=f'item{level}_{i}', override='', author='cityhall',
+                entry='', protect=False, first_last=True,
+                path=value_path(root, names + [f'item{level}_{i}']),
+            )
+            for i in range(fanout)
+        ]
+        Value.objects.bulk_create(rows, batch_size=400)
+        names.append(rows[-1].name)
+        parent = rows[-1].id
+        next_id += fanout
+
+    return root, names
+
+
+def measure(resolve, repeat):
+    with CaptureQueriesContext(connection) as queries:
+        resolve()
+    seconds = min(timeit.repeat(resolve, number=1, repeat=repeat))
+    return seconds * 1000, len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--depth', type=int, default=20)
+    parser.add_argument(
+        '--fanout', type=int, nargs='+', default=[10, 100, 1000, 10000]
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    connection.creation.create_test_db(verbosity=0)
+    db = Factory(settings.CITY_HALL_OPTIONS).get_db()
+
+    print(f"{'fanout':>7} {'depth':>5} {'walk ms':>9} {'queries':>7} "
+          f"{'path ms':>8} {'queries':>7}")
+
+    for fanout in args.fanout:
+        root, names = build_chain(db, f'bench{fanout}', args.depth, fanout)
+
+        for depth in range(1, args.depth + 1):
+            path = names[:depth]
+
+            def walk():
+                env = Env(db, f'bench{fanout}', Rights.Grant, 'cityhall', root)
+                return env._get_index_of(path, '', root, '/')
+
+            def lookup():
+                return db.get_path_index(root, path, '')
+
+            assert walk() == lookup() > 0
+            walk_ms, walk_queries = measure(walk, args.repeat)
+            path_ms, path_queries = measure(lookup, args.repeat)
+            print(f"{fanout:>7} {depth:>5} {walk_ms:>9.2f} {walk_queries:>7} "
+                  f"{path_ms:>8.2f} {path_queries:>7}")
+
+
+if __name__ == '__main__':
+    main()
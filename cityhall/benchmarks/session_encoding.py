@@ -0,0 +1,145 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measures the size of the auth state kept in the session, and the time to
+encode and decode it, in the current format against the JSON-in-JSON one it
+replaced.  Run from the cityhall directory:
+
+    python -m benchmarks.session_encoding [--envs 1 10 100 1000]
+
+An Auth is built with 'envs' environments in its roots_cache, i.e. with an
+'env_capacity' of at least that many.  Encoding is timed through the
+session's own serializer, and decoding includes getting one Env back out,
+as a request would.  'path_capacity' isn't varied: the path cache has been
+shared by the process, and not kept in the session, since it was added.
+"""
+
+import argparse
+import os
+import timeit
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'cityhall.settings')
+django.setup()
+
+import simplejson as json
+from django.core.signing import JSONSerializer
+from api.db import Rights
+from api.db.auth import Auth
+from api.db.connection import Instance
+from api.db.env import Env
+from api.session import SESSION_AUTH
+from api.session.serialize import serialize_auth, deserialize_auth
+
+
+def build_auth(db, envs):
+    auth = Auth(db, 'cityhall', 1)
+    auth.users_env = 2
+    auth.roots_cache.capacity = envs
+    for i in range(envs):
+        name = f'environment{i}'
+        auth.roots_cache[name] = Env(db, name, Rights.Grant, auth.name, 1000 + i)
+    return auth
+
+
+def serialize_env(env):
+    return json.dumps({
+        'env': env.env,
+        'permissions': env.permissions,
+        'name': env.name,
+        'root_id': env.root_id,
+    })
+
+
+def deserialize_env(env_json, db):
+    env_dict = json.loads(env_json)
+    return Env(
+        db=db,
+        env=env_dict['env'],
+        permissions=env_dict['permissions'],
+        name=env_dict['name'],
+        root_id=env_dict['root_id']
+    )
+
+
+def encode_old(auth):
+    return json.dumps({
+        'name': auth.name,
+        'user_root': auth.user_root,
+        'users_env': auth.users_env,
+        'roots_cache': {
+            name: serialize_env(env)
+            for name, env in auth.roots_cache.values.items()
+        },
+    })
+
+
+def decode_old(auth_json, db):
+    auth_dict = json.loads(auth_json)
+    auth = Auth(db, auth_dict['name'], auth_dict['user_root'])
+    auth.users_env = auth_dict['users_env']
+    for name, env_json in auth_dict['roots_cache'].items():
+        auth.roots_cache[name] = deserialize_env(env_json, db)
+    return auth
+
+
+def measure(func, repeat, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=repeat))
+    return seconds / number * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--envs', type=int, nargs='+', default=[1, 10, 100, 1000])
+    parser.add_argument('--number', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db = Instance.db_connection.get_db()
+    serializer = JSONSerializer()
+
+    formats = {
+        'old': (
+            lambda auth: {SESSION_AUTH: encode_old(auth)},
+            lambda session: decode_old(session[SESSION_AUTH], db),
+        ),
+        'compact': (
+            lambda auth: {SESSION_AUTH: serialize_auth(auth)},
+            lambda session: deserialize_auth(session[SESSION_AUTH]),
+        ),
+    }
+
+    print(f"{'envs':>5} {'format':>8} {'bytes':>8} {'encode us':>10} "
+          f"{'decode us':>10}")
+
+    for envs in args.envs:
+        auth = build_auth(db, envs)
+        for name, (encode, decode) in formats.items():
+            data = serializer.dumps(encode(auth))
+            last = f'environment{envs - 1}'
+
+            def encode_session():
+                serializer.dumps(encode(auth))
+
+            def decode_session():
+                decode(serializer.loads(data)).get_permissions(last)
+
+            print(f"{envs:>5} {name:>8} {len(data):>8} "
+                  f"{measure(encode_session, args.repeat, args.number):>10.1f} "
+                  f"{measure(decode_session, args.repeat, args.number):>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
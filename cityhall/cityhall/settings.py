@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'api.db.django.router.StickyPrimaryMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -79,6 +80,9 @@ DATABASES = {
     }
 }
 
+# Reads can be sent to a replica of 'default', see CITY_HALL_OPTIONS['replica']
+DATABASE_ROUTERS = ['api.db.django.router.ReplicaRouter']
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/3.0/topics/i18n/
@@ -108,23 +112,100 @@ STATICFILES_DIRS = ( os.path.join(BASE_DIR, 'static'), )
 
 CITY_HALL_OPTIONS = {
     'cache': {
-        # As a user looks at an environment, the index of paths is stored
-        # in the user session.  This value stores how many paths to store
-        # in session memory for a particular environment.
-        'path_capacity': 50,
+        # The index of every path looked up is cached, in one cache per
+        # environment shared by every session of the process.  This value
+        # stores how many paths to cache for a particular environment, and
+        # the next for how many seconds at most, which is how long a path
+        # deleted and created again by another process may go unseen.
+        'path_capacity': 10000,
+        'path_seconds': 60,
+
+        # Paths which are looked up but don't exist are remembered as well,
+        # so asking for them again doesn't go to the database.  This value
+        # stores how many such paths to remember for a particular
+        # environment, and the next how many seconds to remember each for.
+        # Creating a value forgets it at once, but only in the process
+        # which created it.
+        'missing_capacity': 10000,
+        'missing_seconds': 10,
+
+        # The values themselves are cached too, and forgotten whenever
+        # anything in their environment is written by this process.  This
+        # value stores how many values to cache for a particular
+        # environment, and the next for how many seconds at most, which is
+        # how long a write by another process may go unseen.
+        'value_capacity': 10000,
+        'value_seconds': 5,
 
         # As a user looks at an environment, information about that
         # environment is stored in the user session.  Things like the index
-        # of the root, the permissions to it, as well as PATH_CAPACITY
-        # number of indexes.  This value stores how the max number of
-        # environments to store in a session.
+        # of the root and the permissions to it.  This value stores the max
+        # number of environments to store in a session.
         'env_capacity': 10,
     },
 
+    # Logging in with {"token": true} returns a signed token, which can be
+    # sent as 'Authorization: Token <token>' instead of keeping a session.
+    # 'max_age' is how many seconds a token is good for, or None for ever.
+    # A token carries its user's rights as they were when it was issued, so
+    # rights revoked afterwards, or the user being deleted, only take
+    # effect once it expires (and new rights once the user logs in again).
+    'token': {
+        'max_age': 3600,
+    },
+
     # Type of database connection.
     # This is honored by api.db.Connection.get_new_db()
     # Current possible options are: 'django' or 'memory'
     'db_type': 'django',
 
+    # Options which only apply when 'db_type' is 'memory'
+    'memory': {
+        # Store rows as compact __slots__ objects, with interned names,
+        # authors and overrides, instead of as dicts.  This roughly halves
+        # the memory used per value, at the cost of converting rows to dicts
+        # whenever they are handed out of the db.
+        'compact_rows': False,
+
+        # If set, the path of a file every change is appended to.  When the
+        # db is opened, it is restored from this journal (and its snapshot,
+        # stored alongside as <journal>.snapshot), and the create_default
+        # call no longer resets it.
+        'journal': None,
+
+        # How many changes to append to the journal before compacting it
+        # into a new snapshot.
+        'snapshot_every': 10000,
+    },
+
+    # Every change to a value keeps the previous version as history.  These
+    # options have a background thread prune old versions; it only runs if
+    # either 'keep_versions' or 'keep_days' is set.  The newest version of
+    # a value is always kept.
+    'history': {
+        # Keep only this many versions of each value, or None for all.
+        'keep_versions': None,
+
+        # Prune inactive versions older than this many days, or None.
+        'keep_days': None,
+
+        # How many versions to prune at a time, and how many seconds to
+        # wait between compactions.
+        'batch_size': 1000,
+        'interval': 60,
+    },
+
+    # Options which only apply when 'db_type' is 'django'
+    'replica': {
+        # The alias in DATABASES of a read replica of 'default', which reads
+        # of values and users are sent to, or None to read from 'default'.
+        'alias': None,
+
+        # After a session writes, how many seconds its reads keep going to
+        # 'default', so that it sees its own writes while the replica
+        # catches up.
+        'sticky_seconds': 5,
+    },
+
     'version': 1,
 }
@@ -12,8 +12,21 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import mock
+from api.db.connection import Instance
+from api.session import TOKEN_SALT
+from api.session.serialize import deserialize_auth
 from test.test_api import ApiTestCase
 from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core import signing
+from django.test import override_settings
+
+
+def token_options(max_age):
+    options = dict(settings.CITY_HALL_OPTIONS)
+    options['token'] = {'max_age': max_age}
+    return options
 
 
 class TestApiLogin(ApiTestCase):
@@ -41,6 +54,90 @@ class TestApiLogin(ApiTestCase):
         self.check_failure(result)
 
 
+class TestApiToken(ApiTestCase):
+    def setUp(self):
+        result = self.post(
+            '/api/v1/auth/',
+            {'username': 'cityhall', 'passhash': '', 'token': True},
+        )
+        self.check_result(result)
+        self.token = self.result_to_dict(result)['Token']
+
+    def with_token(self, method, *args, token=None, **kwargs):
+        kwargs['HTTP_AUTHORIZATION'] = f'Token {token or self.token}'
+        return method(*args, **kwargs)
+
+    def test_login_doesnt_start_session(self):
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, self.client.cookies)
+
+    def test_requests_dont_use_session(self):
+        with mock.patch.object(SessionStore, 'load') as load, \
+                mock.patch.object(SessionStore, 'save') as save:
+            self.check_result(self.with_token(
+                self.post, '/api/v1/env/auto/value/', {'value': 'abc'}
+            ))
+            self.check_value(
+                self.with_token(self.client.get, '/api/v1/env/auto/value/'),
+                'abc'
+            )
+            self.check_result(
+                self.with_token(self.client.get, '/api/v1/env/users/')
+            )
+        load.assert_not_called()
+        save.assert_not_called()
+
+    def test_bad_token(self):
+        self.check_failure(self.with_token(
+            self.client.get, '/api/v1/env/auto/', token=self.token + 'x'
+        ))
+        self.check_failure(self.with_token(
+            self.post, '/api/v1/env/auto/value/', {'value': 'abc'},
+            token='abc'
+        ))
+
+    @override_settings(CITY_HALL_OPTIONS=token_options(max_age=-1))
+    def test_expired_token(self):
+        self.check_failure(
+            self.with_token(self.client.get, '/api/v1/env/auto/')
+        )
+
+    def test_token_holds_every_env(self):
+        auth = Instance.get_auth('cityhall', '')
+        capacity = settings.CITY_HALL_OPTIONS['cache']['env_capacity']
+        names = [f'token_env{i}' for i in range(capacity + 2)]
+        for name in names:
+            auth.create_env(name)
+
+        self.setUp()
+        auth_state = signing.loads(self.token, salt=TOKEN_SALT)
+        for name in names:
+            self.assertIn(name, auth_state['envs'])
+
+        restored = deserialize_auth(auth_state)
+        self.assertEqual(len(auth_state['envs']), len(restored.roots_cache.values))
+
+    def test_token_verified_once(self):
+        with mock.patch(
+                'api.session.signing.loads', side_effect=signing.loads) as loads:
+            self.check_result(self.with_token(
+                self.post, '/api/v1/env/auto/value/', {'value': 'abc'}
+            ))
+        self.assertEqual(1, loads.call_count)
+
+        with mock.patch(
+                'api.session.signing.loads', side_effect=signing.loads) as loads:
+            self.check_value(
+                self.with_token(self.client.get, '/api/v1/env/auto/value/'),
+                'abc'
+            )
+        self.assertEqual(1, loads.call_count)
+
+    def test_token_cant_log_out(self):
+        self.check_failure(
+            self.with_token(self.client.delete, '/api/v1/auth/')
+        )
+
+
 class TestApiAuthUsers(ApiTestCase):
     def setUp(self):
         self.post('/api/v1/auth/', {'username': 'cityhall', 'passhash': ''})
@@ -12,6 +12,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import mock
+from django.contrib.sessions.backends.db import SessionStore
 from test.test_api import ApiTestCase
 
 
@@ -23,6 +25,18 @@ class TestApiEnv(ApiTestCase):
         result = self.client.get('/api/v1/env/auto/')
         self.check_value(result)
 
+    def test_reads_dont_save_session(self):
+        self.check_value(self.client.get('/api/v1/env/auto/'))
+
+        with mock.patch.object(SessionStore, 'save') as save:
+            self.check_value(self.client.get('/api/v1/env/auto/'))
+            self.check_result(self.client.get('/api/v1/env/auto/?viewchildren'))
+        save.assert_not_called()
+
+        with mock.patch.object(SessionStore, 'save') as save:
+            self.check_result(self.client.get('/api/v1/env/users/'))
+        save.assert_called()
+
     def test_get_for_env_that_doesnt_exist(self):
         result = self.client.get('/api/v1/env/environment/doesnt/exist/')
         self.check_failure(result)
@@ -97,6 +111,36 @@ class TestApiEnv(ApiTestCase):
         self.assertIn('History', result_dict)
         self.assertLess(0, len(result_dict['History']))
 
+    def test_get_history_page(self):
+        for value in ['a', 'b', 'c']:
+            self.post('/api/v1/env/auto/value/', {'value': value})
+
+        result = self.client.get('/api/v1/env/auto/value/?viewhistory&limit=2')
+        self.check_result(result)
+        first = self.result_to_dict(result)
+        self.assertEqual(['a', 'b'], [version['value'] for version in first['History']])
+
+        result = self.client.get(
+            f'/api/v1/env/auto/value/?viewhistory&limit=2&cursor={first["next"]}'
+        )
+        second = self.result_to_dict(result)
+        self.assertEqual(['c'], [version['value'] for version in second['History']])
+        self.assertIsNone(second['next'])
+
+        since = first['History'][1]['datetime']
+        result = self.client.get(
+            '/api/v1/env/auto/value/', {'viewhistory': '', 'since': since}
+        )
+        self.assertEqual(
+            ['b', 'c'],
+            [version['value'] for version in self.result_to_dict(result)['History']]
+        )
+
+    def test_get_history_page_bad_arguments(self):
+        self.check_failure(self.client.get('/api/v1/env/auto/?viewhistory&since=yesterday'))
+        self.check_failure(self.client.get('/api/v1/env/auto/?viewhistory&limit=0'))
+        self.check_failure(self.client.get('/api/v1/env/auto/?viewhistory&cursor=abc'))
+
     def test_children(self):
         self.post('/api/v1/env/auto/value/?override=cityhall', {'value': 'some_value'})
         result = self.client.get('/api/v1/env/auto/?viewchildren=true')
@@ -105,3 +149,79 @@ class TestApiEnv(ApiTestCase):
         result_dict = self.result_to_dict(result)
         children = [(c['name'], c['override']) for c in result_dict['children']]
         self.assertIn(('value', 'cityhall'), children)
+
+    def test_batch(self):
+        self.post('/api/v1/env/auto/existing/', {'value': 'old'})
+        result = self.post('/api/v1/batch/auto/', {'operations': [
+            {'path': '/existing', 'value': 'new'},
+            {'path': '/folder/', 'value': ''},
+            {'path': '/folder/value', 'value': 'abc', 'protect': 'true'},
+            {'path': '/folder/value', 'override': 'cityhall', 'value': 'def'},
+        ]})
+        self.check_result(result)
+
+        results = self.result_to_dict(result)['Results']
+        self.assertEqual(['Ok'] * 4, [item['Response'] for item in results])
+        self.check_value(self.client.get('/api/v1/env/auto/existing'), 'new')
+        self.check_value(self.client.get('/api/v1/env/auto/folder/value'), 'def')
+
+        result = self.client.get('/api/v1/env/auto/folder/value?override=')
+        self.assertTrue(self.result_to_dict(result)['protect'])
+
+    def test_batch_is_all_or_nothing(self):
+        result = self.post('/api/v1/batch/auto/', {'operations': [
+            {'path': '/value', 'value': 'abc'},
+            {'path': '/missing/value', 'value': 'abc'},
+        ]})
+        self.check_failure(result)
+
+        results = self.result_to_dict(result)['Results']
+        self.assertEqual(
+            ['Ok', 'Failure'], [item['Response'] for item in results]
+        )
+        result = self.client.get('/api/v1/env/auto/value')
+        self.assertIsNone(self.result_to_dict(result)['value'])
+
+    def test_batch_expects_operations(self):
+        self.check_failure(self.post('/api/v1/batch/auto/', {'value': 'abc'}))
+
+    def test_children_pages(self):
+        self.post('/api/v1/env/auto/folder/', {'value': ''})
+        for name in ['c', 'a', 'b']:
+            self.post(f'/api/v1/env/auto/folder/{name}', {'value': name})
+
+        result = self.client.get('/api/v1/env/auto/folder/?viewchildren=true&limit=2&fields=name,value')
+        self.check_result(result)
+        first = self.result_to_dict(result)
+        self.assertEqual(
+            [{'name': 'a', 'value': 'a'}, {'name': 'b', 'value': 'b'}],
+            first['children']
+        )
+
+        result = self.client.get(
+            f'/api/v1/env/auto/folder/?viewchildren=true&limit=2&fields=name&after={first["next"]}'
+        )
+        second = self.result_to_dict(result)
+        self.assertEqual([{'name': 'c'}], second['children'])
+        self.assertIsNone(second['next'])
+
+    def test_children_pages_bad_arguments(self):
+        self.check_failure(self.client.get('/api/v1/env/auto/?viewchildren=true&fields=name,secret'))
+        self.check_failure(self.client.get('/api/v1/env/auto/?viewchildren=true&limit=0'))
+        self.check_failure(self.client.get('/api/v1/env/auto/?viewchildren=true&after=xyz'))
+
+    def test_tree(self):
+        self.post('/api/v1/env/auto/folder/', {'value': ''})
+        self.post('/api/v1/env/auto/folder/value', {'value': 'abc'})
+
+        result = self.client.get('/api/v1/env/auto/?tree=true&depth=2')
+        self.check_result(result)
+        tree = self.result_to_dict(result)['children']
+        folder = [node for node in tree if node['name'] == 'folder'][0]
+        self.assertEqual(
+            [('value', 'abc')],
+            [(node['name'], node['value']) for node in folder['children']]
+        )
+        self.assertNotIn('children', folder['children'][0])
+
+        self.check_failure(self.client.get('/api/v1/env/auto/?tree=true&depth=x'))
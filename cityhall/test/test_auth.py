@@ -91,6 +91,28 @@ class TestAuthentication(TestCase):
         self.assertIn('test', users)
         self.assertEqual(users['test'], Rights.ReadProtected)
 
+    def test_get_users_follows_changes(self):
+        self.auth.create_user('test', '')
+        test_auth = self.conn.get_auth('test', '')
+        test_auth.create_env('test_env')
+        self.assertEqual(
+            {'test': Rights.Grant}, test_auth.get_users('test_env')
+        )
+
+        test_auth.grant('test_env', 'cityhall', Rights.Read)
+        test_auth.grant('test_env', 'cityhall', Rights.Write)
+        self.assertEqual(
+            {'test': Rights.Grant, 'cityhall': Rights.Write},
+            self.auth.get_users('test_env')
+        )
+
+        self.auth.grant('auto', 'test', Rights.Read)
+        self.assertTrue(self.auth.delete_user('test'))
+        self.assertEqual(
+            {'cityhall': Rights.Write}, self.auth.get_users('test_env')
+        )
+        self.assertNotIn('test', self.auth.get_users('auto'))
+
     def test_get_user(self):
         self.auth.create_env('add')
         self.auth.create_user('test', '')
@@ -223,3 +245,33 @@ class TestAuthentication(TestCase):
 
         self.env.set('/connect/test', 'some other val', 'test')
         self.assertEqual('dev', test_auth.get_default_env())
+
+    def test_dirty_until_saved(self):
+        self.assertTrue(self.auth.dirty)
+        self.auth.mark_clean()
+        self.assertFalse(self.auth.dirty)
+
+        self.auth.get_env('auto')
+        self.auth.get_permissions('users')
+        self.assertFalse(self.auth.dirty)
+
+        self.auth.create_env('dev')
+        self.auth.get_env('dev')
+        self.assertTrue(self.auth.dirty)
+
+    def test_recreated_user_gets_new_folder(self):
+        users = self.auth.get_env('users')
+        self.auth.create_user('test', '')
+        old_folder = users._get_index_of('/test')
+        self.assertTrue(self.auth.delete_user('test'))
+
+        self.auth.create_user('test', '')
+        users_root = self.db.get_db().get_env_root('users')
+        new_folder = self.db.get_db().get_child(users_root, 'test')['id']
+        self.assertNotEqual(old_folder, new_folder)
+        self.assertEqual(new_folder, users._get_index_of('/test'))
+
+        self.auth.grant('auto', 'test', Rights.Read)
+        self.assertEqual(
+            ['auto'], [child['name'] for child in users.get_children('/test')]
+        )
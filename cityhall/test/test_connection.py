@@ -34,7 +34,7 @@ class TestConnection(TestCase):
     def test_create_env(self):
         self.conn.connect()
         self.conn.create_default_env()
-        self.assertIsInstance(self.db_conn.valsTable, list)
+        self.assertIsInstance(self.db_conn.valsTable, dict)
         self.assertIsInstance(self.db_conn.authTable, list)
 
     def test_open_required(self):
@@ -12,14 +12,28 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import mock
+from datetime import timedelta
+from importlib import import_module
+from django.apps import apps
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from api.models import User, Value
+from api.models import User, Value, ValueHistory, ValueManager, value_path
+from api.db.django import environments
 from api.db.django.environments import Environments
 from api.db.django.users import Users
 from api.db.django.values import Values
 
 
+def returning_supported():
+    # whether values are written with single INSERT ... RETURNINGs, which
+    # the statement counts below depend on
+    return Value.objects.reserve_entry_ids(0) is not None
+
+
 class TestEnvironments(TestCase):
     def setUp(self):
         self.envs = Environments()
@@ -37,6 +51,12 @@ class TestEnvironments(TestCase):
         self.assertTrue(entry.first_last)
         self.assertEqual(root_id, entry.id)
 
+    def test_root_has_path(self):
+        root_id = self.envs.create_root('cityhall', 'test_root')
+        self.assertEqual(
+            value_path(root_id, []), Value.objects.by_id(root_id).path
+        )
+
     def test_get_env_root(self):
         self.envs.create_root('cityhall', 'test_root')
         entry = Value.objects.get(
@@ -51,6 +71,24 @@ class TestEnvironments(TestCase):
         self.assertTrue(id1)
         self.assertFalse(id2)
 
+    @mock.patch.dict(environments._env_roots, clear=True)
+    @mock.patch.object(environments.transaction, 'on_commit', lambda f: f())
+    def test_env_roots_are_remembered_once_committed(self):
+        root_id = self.envs.create_root('cityhall', 'test_root')
+        auto_id = self.envs.get_env_root('auto')
+
+        with self.assertNumQueries(0):
+            self.assertEqual(root_id, self.envs.get_env_root('test_root'))
+            self.assertEqual(auto_id, self.envs.get_env_root('auto'))
+
+    @mock.patch.dict(environments._env_roots, clear=True)
+    def test_env_roots_are_not_remembered_before_commit(self):
+        self.envs.create_root('cityhall', 'test_root')
+        self.assertNotIn('test_root', environments._env_roots)
+
+        with self.assertNumQueries(1):
+            self.envs.get_env_root('test_root')
+
 
 class TestUsers(TestCase):
     def setUp(self):
@@ -173,10 +211,10 @@ class TestValues(TestCase):
         before = Value.objects.count()
         self.values.update('cityhall', index, '123')
         after = Value.objects.count()
-        inactive = Value.objects.get(active=False, id=index)
+        inactive = ValueHistory.objects.get(id=index)
         active = Value.objects.get(active=True, id=index)
 
-        self.assertEqual(before+1, after)
+        self.assertEqual(before, after)
         self.assertEqual('', inactive.entry)
         self.assertEqual('123', active.entry)
         self.assertIsNotNone(active.datetime)
@@ -193,14 +231,14 @@ class TestValues(TestCase):
         self.values.delete('cityhall', index)
         after = Value.objects.count()
 
-        entries = list(Value.objects.filter(id=index).order_by('entry_id'))
+        entries = list(ValueHistory.objects.filter(id=index).order_by('entry_id'))
         created = entries[0]
         deleted = entries[1]
 
-        self.assertEqual(before+1, after)
+        self.assertEqual(before-1, after)
         self.assertEqual(2, len(entries))
-        self.assertFalse(created.active)
-        self.assertFalse(deleted.active)
+        self.assertTrue(created.first_last)
+        self.assertIsNone(Value.objects.by_id(index))
         self.assertEqual(created.id, deleted.id)
         self.assertEqual(created.parent, deleted.parent)
         self.assertEqual(created.name, deleted.name)
@@ -215,10 +253,10 @@ class TestValues(TestCase):
         before = Value.objects.count()
         self.values.set_protect_status('cityhall', index, True)
         after = Value.objects.count()
-        inactive = Value.objects.get(active=False, id=index)
+        inactive = ValueHistory.objects.get(id=index)
         active = Value.objects.get(active=True, id=index)
 
-        self.assertEqual(before+1, after)
+        self.assertEqual(before, after)
         self.assertEqual(active.entry, inactive.entry)
         self.assertIsNotNone(active.datetime)
         self.assertEqual(inactive.parent, active.parent)
@@ -353,3 +391,396 @@ class TestValues(TestCase):
         self.assertEqual(4, len(history))
         history = self.values.get_history(self.auto_id)
         self.assertEqual(4, len(history))
+
+    def test_get_history_page(self):
+        index = self._create('test', '0')
+        for i in range(1, 6):
+            self.values.update('cityhall', index, str(i))
+        # versions written at the same time are paged through in order
+        ValueHistory.objects.filter(id=index, entry__in=['1', '2', '3']).\
+            update(datetime=ValueHistory.objects.get(id=index, entry='1').datetime)
+
+        pages = []
+        with self.assertNumQueries(2):
+            history, cursor = self.values.get_history_page(index, limit=2)
+        pages.append(history)
+        while cursor:
+            history, cursor = self.values.get_history_page(
+                index, after=cursor, limit=2
+            )
+            pages.append(history)
+
+        self.assertEqual(
+            [['0', '1'], ['2', '3'], ['4', '5']],
+            [[version['value'] for version in page] for page in pages]
+        )
+        self.assertTrue(pages[-1][-1]['active'])
+
+    def test_get_history_page_between_times(self):
+        index = self._create('test', '0')
+        for i in range(1, 4):
+            self.values.update('cityhall', index, str(i))
+        times = [version['datetime'] for version in self.values.get_history(index)]
+
+        history, cursor = self.values.get_history_page(index, times[1], times[3])
+        self.assertEqual(['1', '2'], [version['value'] for version in history])
+        self.assertIsNone(cursor)
+        # naive datetimes are in the current time zone
+        history, cursor = self.values.get_history_page(
+            index, timezone.make_naive(times[3])
+        )
+        self.assertEqual(['3'], [version['value'] for version in history])
+
+    def test_get_path_index(self):
+        first = self._create('first', '')
+        second = self.values.create('cityhall', first, 'second', '')
+        override = self.values.create('cityhall', first, 'second', '', 'me')
+        self.values.delete('cityhall', self._create('gone', ''))
+
+        with self.assertNumQueries(1):
+            index = self.values.get_path_index(
+                self.auto_id, ['first', 'second']
+            )
+
+        self.assertEqual(second, index)
+        self.assertEqual(
+            override,
+            self.values.get_path_index(self.auto_id, ['first', 'second'], 'me')
+        )
+        self.assertEqual(first, self.values.get_path_index(self.auto_id, ['first']))
+        self.assertEqual(-1, self.values.get_path_index(self.auto_id, ['second']))
+        self.assertEqual(-1, self.values.get_path_index(self.auto_id, ['gone']))
+        self.assertEqual(
+            -1, self.values.get_path_index(self.auto_id, ['first', 'x', 'y'])
+        )
+
+    def test_paths_are_kept_on_active_values(self):
+        first = self._create('first', '')
+        second = self.values.create('cityhall', first, 'second', '', 'me')
+        self.values.update('cityhall', second, 'abc')
+        self.values.set_protect_status('cityhall', second, True)
+
+        self.assertEqual(
+            value_path(self.auto_id, ['first', 'second'], 'me'),
+            Value.objects.by_id(second).path
+        )
+        self.assertEqual(
+            second,
+            self.values.get_path_index(self.auto_id, ['first', 'second'], 'me')
+        )
+
+    def test_delete_clears_paths_below(self):
+        first = self._create('first', '')
+        first_override = self._create('first', '', 'me')
+        second = self.values.create('cityhall', first, 'second', '')
+        self.values.delete('cityhall', first)
+
+        self.assertIsNone(Value.objects.by_id(second).path)
+        self.assertEqual(
+            first_override,
+            self.values.get_path_index(self.auto_id, ['first'], 'me')
+        )
+
+        recreated = self._create('first', '')
+        self.values.create('cityhall', recreated, 'second', 'again')
+        self.assertEqual(
+            ('again', False),
+            self.values.get_value_by_path(self.auto_id, ['first', 'second'], '')
+        )
+
+    def test_get_value_by_path(self):
+        first = self._create('first', '')
+        self.values.create('cityhall', first, 'second', 'global')
+        self.values.create('cityhall', first, 'second', 'mine', 'me')
+        names = ['first', 'second']
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                ('mine', False),
+                self.values.get_value_by_path(self.auto_id, names, 'me')
+            )
+        self.assertEqual(
+            ('global', False),
+            self.values.get_value_by_path(self.auto_id, names, 'you')
+        )
+        self.assertEqual(
+            (None, None),
+            self.values.get_value_by_path(self.auto_id, names, 'you', False)
+        )
+        self.assertEqual(
+            (None, None),
+            self.values.get_value_by_path(self.auto_id, ['second'], '')
+        )
+
+    def test_backfill_paths(self):
+        first = self._create('first', '')
+        second = self.values.create('cityhall', first, 'second', '', 'me')
+        orphan = self.values.create('cityhall', second, 'orphan', '')
+        expected = dict(Value.objects.values_list('entry_id', 'path'))
+        Value.objects.update(path=None)
+
+        migration = import_module('api.migrations.0004_value_path')
+        migration.backfill_paths(apps, mock.Mock(connection=connection))
+
+        self.assertEqual(
+            expected, dict(Value.objects.values_list('entry_id', 'path'))
+        )
+        self.assertEqual(
+            second, self.values.get_path_index(self.auto_id, ['first', 'second'], 'me')
+        )
+        self.assertIsNone(Value.objects.by_id(orphan).path)
+
+    def test_move_history(self):
+        # the layout from before ValueHistory: every version in one table
+        index = self._create('test', '0')
+        for entry in ['1', '2', '3']:
+            row = Value.objects.by_id(index)
+            Value.objects.filter(entry_id=row.entry_id).update(active=False)
+            row.pk = None
+            row.entry = entry
+            row.save()
+
+        migration = import_module('api.migrations.0005_value_history')
+        with mock.patch.object(migration, 'BATCH_SIZE', 2):
+            migration.move_history(apps, mock.Mock(connection=connection))
+
+        self.assertFalse(Value.objects.filter(active=False).exists())
+        self.assertEqual(
+            ['0', '1', '2'],
+            list(ValueHistory.objects.order_by('entry_id').values_list('entry', flat=True))
+        )
+        self.assertEqual(
+            [('0', False), ('1', False), ('2', False), ('3', True)],
+            [(val['value'], val['active']) for val in self.values.get_history(index)]
+        )
+
+    def test_write_statements(self):
+        # pins the cost of each write; see ValueManager.insert_new/archive
+        if not returning_supported():
+            self.skipTest('needs INSERT ... RETURNING')
+        with self.assertNumQueries(1):
+            folder = self._create('folder', '')
+        with self.assertNumQueries(1):
+            index = self.values.create('cityhall', folder, 'test', '123')
+        with self.assertNumQueries(3):
+            self.values.update('cityhall', index, '456')
+        with self.assertNumQueries(3):
+            self.values.set_protect_status('cityhall', index, True)
+        with self.assertNumQueries(4):
+            self.values.delete('cityhall', folder)
+        with self.assertNumQueries(1):
+            self.values.delete('cityhall', -1)
+
+        self.assertEqual(
+            -1, self.values.get_path_index(self.auto_id, ['folder', 'test'])
+        )
+        self.assertEqual(
+            [('123', False), ('456', False), ('456', True)],
+            [(val['value'], val['protect'])
+             for val in self.values.get_history(index)]
+        )
+
+    def test_writes_lock_before_archiving(self):
+        index = self._create('test', '123')
+        for write in [
+                lambda: self.values.update('cityhall', index, '456'),
+                lambda: self.values.set_protect_status('cityhall', index, True),
+                lambda: self.values.delete('cityhall', index)]:
+            with CaptureQueriesContext(connection) as queries:
+                write()
+            self.assertTrue(queries[0]['sql'].startswith('SELECT'))
+            if connection.features.has_select_for_update:
+                self.assertIn('FOR UPDATE', queries[0]['sql'])
+            self.assertIn('INSERT', queries[1]['sql'])
+
+        self.assertEqual(
+            [('123', False), ('456', False), ('456', True), ('456', True)],
+            [(val['value'], val['protect'])
+             for val in self.values.get_history(index)]
+        )
+
+    def test_writes_without_returning(self):
+        with mock.patch.object(
+                ValueManager, '_next_entry_id_sql', return_value=None):
+            folder = self._create('folder', '')
+            index = self.values.create('cityhall', folder, 'test', '123')
+            self.values.update('cityhall', index, '456')
+            self.values.set_protect_status('cityhall', index, True)
+
+            self.assertEqual(Value.objects.by_id(index).pk, index)
+            self.assertEqual(('456', True), self.values.get_value(index))
+            self.assertEqual(
+                index, self.values.get_path_index(self.auto_id, ['folder', 'test'])
+            )
+
+            self.values.delete('cityhall', folder)
+            self.assertEqual(
+                -1, self.values.get_path_index(self.auto_id, ['folder', 'test'])
+            )
+
+    def _batch(self, writes):
+        for write in writes:
+            for key, default in [
+                    ('id', None), ('override', ''),
+                    ('value', None), ('protect', None)]:
+                write.setdefault(key, default)
+        self.values.set_many('cityhall', writes)
+        return writes
+
+    def _set_many(self):
+        existing = self._create('existing', 'old')
+        folder = {'parent': self.auto_id, 'name': 'folder', 'value': ''}
+        writes = self._batch([
+            {'id': existing, 'value': 'new', 'protect': True},
+            folder,
+            {'parent': folder, 'name': 'child', 'value': 'abc'},
+            {'parent': folder, 'name': 'child', 'override': 'me', 'value': 'x'},
+        ])
+
+        self.assertEqual(('new', True), self.values.get_value(existing))
+        self.assertEqual(writes[1]['id'], Value.objects.by_id(writes[1]['id']).pk)
+        self.assertEqual(
+            writes[2]['id'],
+            self.values.get_path_index(self.auto_id, ['folder', 'child'])
+        )
+        self.assertEqual(
+            ('x', False),
+            self.values.get_value_by_path(self.auto_id, ['folder', 'child'], 'me')
+        )
+        return existing
+
+    def test_set_many(self):
+        existing = self._set_many()
+        # without INSERT ... RETURNING, the writes are applied one by one, so
+        # the value and protect status are separate versions
+        self.assertEqual(
+            2 if returning_supported() else 3,
+            len(self.values.get_history(existing))
+        )
+
+    def test_set_many_locks_before_reading(self):
+        # even a batch which only creates values must hold SQLite's write
+        # lock before it reserves their ids
+        if not returning_supported():
+            self.skipTest('ids are only reserved with INSERT ... RETURNING')
+        with CaptureQueriesContext(connection) as queries:
+            self._batch([{'parent': self.auto_id, 'name': 'new', 'value': 'a'}])
+        if connection.vendor == 'sqlite':
+            self.assertIn('UPDATE sqlite_sequence', queries[0]['sql'])
+
+    def test_set_many_fails_if_a_target_was_deleted(self):
+        existing = self._create('existing', 'old')
+        parent = self._create('parent', '')
+        writes = [
+            {'id': existing, 'value': 'new', 'protect': None},
+            {'id': None, 'parent': parent, 'name': 'child', 'override': '',
+             'value': 'abc', 'protect': None},
+            {'id': None, 'parent': self.auto_id, 'name': 'other',
+             'override': '', 'value': 'abc', 'protect': None},
+        ]
+        self.values.delete('cityhall', parent)
+
+        failed = self.values.set_many('cityhall', writes)
+        self.assertEqual([writes[1]], failed)
+        self.assertEqual(('old', False), self.values.get_value(existing))
+        self.assertEqual(
+            -1, self.values.get_path_index(self.auto_id, ['other'])
+        )
+
+    def test_set_many_without_returning(self):
+        with mock.patch.object(
+                ValueManager, '_next_entry_id_sql', return_value=None):
+            existing = self._set_many()
+        self.assertEqual(3, len(self.values.get_history(existing)))
+
+    def test_set_many_statements_do_not_grow(self):
+        # 40 rows fit in one INSERT, even with SQLite's limit on parameters
+        if not returning_supported():
+            self.skipTest('needs INSERT ... RETURNING')
+        existing = [self._create(f'existing{i}', '') for i in range(20)]
+
+        # on SQLite, one more to take the write lock
+        with self.assertNumQueries(6 if connection.vendor == 'sqlite' else 5):
+            self._batch(
+                [{'id': index, 'value': 'new'} for index in existing] +
+                [{'parent': self.auto_id, 'name': f'new{i}', 'value': 'new'}
+                 for i in range(20)]
+            )
+
+        self.assertEqual(
+            41, Value.objects.filter(active=True, parent=self.auto_id).count()
+        )
+
+    def test_get_children_page(self):
+        folder = self._create('folder', '')
+        for name in ['c', 'a', 'b']:
+            self.values.create('cityhall', folder, name, name)
+        self.values.create('cityhall', folder, 'a', 'a2', 'me')
+        self.values.set_protect_status(
+            'cityhall', self.values.get_child(folder, 'c')['id'], True
+        )
+
+        with self.assertNumQueries(1):
+            page = self.values.get_children_page(folder, None, 2, ['name', 'override'])
+        self.assertEqual(
+            [{'name': 'a', 'override': ''}, {'name': 'a', 'override': 'me'}], page
+        )
+        self.assertEqual(
+            [{'name': 'b', 'value': 'b'}, {'name': 'c', 'value': 'c'}],
+            self.values.get_children_page(folder, ('a', 'me'), 2, ['name', 'value'])
+        )
+        self.assertEqual(
+            [{'name': 'b'}],
+            self.values.get_children_page(folder, ('a', 'me'), None, ['name'], False)
+        )
+
+    def test_get_subtree(self):
+        a = self._create('a', '1')
+        b = self.values.create('cityhall', a, 'b', '2')
+        self.values.create('cityhall', a, 'b', '3', 'me')
+        c = self.values.create('cityhall', b, 'c', '4')
+        self.values.create('cityhall', c, 'd', '5')
+        self.values.set_protect_status('cityhall', c, True)
+
+        with self.assertNumQueries(1):
+            tree = self.values.get_subtree(a)
+        self.assertEqual(
+            [('b', '', 1), ('b', 'me', 1), ('c', '', 2), ('d', '', 3)],
+            sorted((v['name'], v['override'], v['depth']) for v in tree)
+        )
+        self.assertEqual(
+            ['b', 'b'], [v['name'] for v in self.values.get_subtree(a, 1)]
+        )
+        self.assertEqual(
+            ['b', 'b'],
+            [v['name'] for v in self.values.get_subtree(a, None, False)]
+        )
+
+    def test_compact_history_keeps_newest_versions(self):
+        index = self._create('test', '0')
+        for i in range(1, 10):
+            self.values.update('cityhall', index, str(i))
+
+        pruned = self.values.compact_history(3, None, 1000)
+
+        self.assertEqual(7, pruned)
+        self.assertEqual(
+            ['7', '8', '9'],
+            [val['value'] for val in self.values.get_history(index)]
+        )
+        self.assertEqual(('9', False), self.values.get_value(index))
+        self.assertEqual(0, self.values.compact_history(3, None, 1000))
+
+    def test_compact_history_by_age_runs_in_batches(self):
+        index = self._create('test', '0')
+        for i in range(1, 5):
+            self.values.update('cityhall', index, str(i))
+        ValueHistory.objects.filter(id=index).update(
+            datetime=timezone.now() - timedelta(days=10)
+        )
+
+        self.assertEqual(0, self.values.compact_history(None, 30, 1000))
+        self.assertEqual(2, self.values.compact_history(None, 7, 2))
+        self.assertEqual(2, self.values.compact_history(None, 7, 2))
+        self.assertEqual(0, self.values.compact_history(None, 7, 2))
+        self.assertEqual(1, len(self.values.get_history(index)))
@@ -0,0 +1,192 @@
+# Copyright 2015 Digital Borderlands Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License, version 3,
+# as published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+import os
+import shutil
+import tempfile
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.db import connections
+from django.test import Client, override_settings
+
+from api.db.django import router
+from api.db.django.router import ReplicaRouter, SESSION_PRIMARY_UNTIL
+from api.db.django.environments import Environments
+from api.db.django.values import Values
+from api.models import Value
+from test.test_api import ApiTestCase
+
+
+def replica_options(alias='replica', sticky_seconds=5):
+    options = dict(settings.CITY_HALL_OPTIONS)
+    options['replica'] = {'alias': alias, 'sticky_seconds': sticky_seconds}
+    return options
+
+
+@override_settings(CITY_HALL_OPTIONS=replica_options())
+class ReplicaTestCase(ApiTestCase):
+    """
+    Runs against a second SQLite file standing in for a replica, which
+    (unlike a real one) never catches up with the primary.
+    """
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replica_dir = tempfile.mkdtemp()
+        settings.DATABASES['replica'] = {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3'),
+        }
+        call_command('migrate', database='replica', verbosity=0)
+        super(ReplicaTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super(ReplicaTestCase, cls).tearDownClass()
+        connections['replica'].close()
+        del connections['replica']
+        del settings.DATABASES['replica']
+        shutil.rmtree(cls.replica_dir)
+
+    def setUp(self):
+        router._pinned.until = 0
+
+    def tearDown(self):
+        router._pinned.until = 0
+
+
+class TestReplicaRouter(ReplicaTestCase):
+    def setUp(self):
+        super(TestReplicaRouter, self).setUp()
+        self.router = ReplicaRouter()
+        self.values = Values()
+        self.root_id = Environments().get_env_root('auto')
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual('replica', self.router.db_for_read(Value))
+        self.assertEqual('default', self.router.db_for_write(Value))
+
+    def test_other_apps_are_left_alone(self):
+        self.assertIsNone(self.router.db_for_read(Session))
+        self.assertIsNone(self.router.db_for_write(Session))
+
+    @override_settings(CITY_HALL_OPTIONS=replica_options(alias=None))
+    def test_no_replica(self):
+        self.assertEqual('default', self.router.db_for_read(Value))
+
+    def test_writes_go_to_primary(self):
+        index = self.values.create('cityhall', self.root_id, 'value', 'abc')
+        self.assertTrue(Value.objects.using('default').filter(id=index).exists())
+        self.assertFalse(Value.objects.using('replica').filter(id=index).exists())
+
+    def test_reads_after_write_go_to_primary(self):
+        index = self.values.create('cityhall', self.root_id, 'value', 'abc')
+        self.assertEqual('default', self.router.db_for_read(Value))
+        self.assertEqual(('abc', False), self.values.get_value(index))
+
+    def test_reads_after_pin_expires_go_to_replica(self):
+        index = self.values.create('cityhall', self.root_id, 'value', 'abc')
+        router._pinned.until = 0
+        self.assertEqual((None, None), self.values.get_value(index))
+        self.assertEqual([], self.values.get_history(index))
+
+    @override_settings(CITY_HALL_OPTIONS=replica_options(sticky_seconds=0))
+    def test_write_reads_from_primary(self):
+        # the value only exists on the primary, so updating it has to find
+        # it there, even without a sticky window
+        index = self.values.create('cityhall', self.root_id, 'value', 'abc')
+        self.values.update('cityhall', index, 'def')
+        self.assertEqual(
+            'def', Value.objects.using('default').get(active=True, id=index).entry
+        )
+        self.assertEqual((None, None), self.values.get_value(index))
+
+
+class TestStickySession(ReplicaTestCase):
+    def setUp(self):
+        super(TestStickySession, self).setUp()
+        self.post('/api/v1/auth/', {'username': 'cityhall', 'passhash': ''})
+
+    def expire_pin(self):
+        session = self.client.session
+        session[SESSION_PRIMARY_UNTIL] = 0
+        session.save()
+
+    def test_session_sees_its_writes(self):
+        self.post('/api/v1/env/auto/value/', {'value': 'some_value'})
+        self.assertIn(SESSION_PRIMARY_UNTIL, self.client.session)
+        self.check_value(self.client.get('/api/v1/env/auto/value/'), 'some_value')
+
+    def test_session_reads_replica_after_pin_expires(self):
+        self.post('/api/v1/env/auto/value/', {'value': 'some_value'})
+        self.expire_pin()
+
+        result = self.client.get('/api/v1/env/auto/value/')
+        self.check_result(result)
+        self.assertIsNone(self.result_to_dict(result)['value'])
+
+    def test_others_reads_dont_hide_writes(self):
+        other = Client()
+        other.post(
+            '/api/v1/auth/', {'username': 'cityhall', 'passhash': ''},
+            content_type='application/json',
+        )
+
+        self.post('/api/v1/env/auto/value/', {'value': 'some_value'})
+        result = other.get('/api/v1/env/auto/value/')
+        self.assertIsNone(self.result_to_dict(result)['value'])
+        self.check_value(self.client.get('/api/v1/env/auto/value/'), 'some_value')
+
+    def test_reads_dont_pin(self):
+        self.expire_pin()
+        self.client.get('/api/v1/env/auto/')
+        self.assertNotIn(SESSION_PRIMARY_UNTIL, self.client.session)
+
+    def test_token_sees_its_writes(self):
+        result = self.post(
+            '/api/v1/auth/',
+            {'username': 'cityhall', 'passhash': '', 'token': True},
+        )
+        header = f"Token {self.result_to_dict(result)['Token']}"
+        self.client.cookies.clear()
+
+        self.post(
+            '/api/v1/env/auto/value/', {'value': 'some_value'},
+            HTTP_AUTHORIZATION=header,
+        )
+        self.assertIn(SESSION_PRIMARY_UNTIL, self.client.cookies)
+        self.check_value(
+            self.client.get('/api/v1/env/auto/value/', HTTP_AUTHORIZATION=header),
+            'some_value'
+        )
+
+
+class TestNoReplica(ApiTestCase):
+    def setUp(self):
+        router._pinned.until = 0
+        self.post('/api/v1/auth/', {'username': 'cityhall', 'passhash': ''})
+
+    def test_writes_dont_pin_session(self):
+        self.post('/api/v1/env/auto/value/', {'value': 'some_value'})
+        self.assertNotIn(SESSION_PRIMARY_UNTIL, self.client.session)
+
+        with mock.patch.object(SessionStore, 'save') as save:
+            self.check_value(
+                self.client.get('/api/v1/env/auto/value/'), 'some_value'
+            )
+        save.assert_not_called()
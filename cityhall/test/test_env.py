@@ -12,11 +12,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import mock
+import simplejson as json
+from time import time
 from django.test import TestCase
-from api.db.connection import Connection
+from api.db.connection import Connection, Instance
 from django.conf import settings
 from api.db.memory.db_factory import CityHallDbFactory
 from api.db import Rights
+from api.db.env import Env
+from api.session.serialize import (
+    serialize_auth, deserialize_auth, SerializedEnv, pack_env, unpack_env
+)
 
 
 cityhall_settings = settings.CITY_HALL_OPTIONS
@@ -39,19 +46,23 @@ class TestEnvironment(TestCase):
         self.auth.create_env('test_env')
         self.env = self.auth.get_env('test_env')
 
+    def _active(self, position=-1):
+        # valsTable keeps active values in the order they were created
+        return list(self.db.valsTable.values())[position]
+
     def test_can_get_auth_from_env(self):
         auth = self.env.get_auth()
         self.assertTrue(auth is not None)
 
     def test_setting(self):
         self.env.set('/new_item', '')
-        self.assertEqual('new_item', self.db.valsTable[-1]['name'])
+        self.assertEqual('new_item', self._active()['name'])
 
     def test_add_children(self):
         self.env.set('/parent', '')
         self.env.set('/parent/child', '')
-        parent = self.db.valsTable[-2]
-        child = self.db.valsTable[-1]
+        parent = self._active(-2)
+        child = self._active()
         self.assertEqual(child['parent'], parent['id'])
         self.assertEqual(child['name'], 'child')
 
@@ -63,8 +74,8 @@ class TestEnvironment(TestCase):
         self.env.set('/value', override_val, override_name)
         after = len(self.db.valsTable)
 
-        global_val = self.db.valsTable[-2]
-        override_val = self.db.valsTable[-1]
+        global_val = self._active(-2)
+        override_val = self._active()
 
         self.assertEqual(before+2, after)
         self.assertEqual(override_val['override'], override_name)
@@ -106,8 +117,8 @@ class TestEnvironment(TestCase):
         self.env.set('/value', 'abc', 'cityhall')
         after = len(self.db.valsTable)
 
-        val1 = self.db.valsTable[-2]
-        val2 = self.db.valsTable[-1]
+        val1 = self._active(-2)
+        val2 = self._active()
 
         self.assertTrue(val1['name'], val2['name'])
         self.assertTrue(val1['override'] == '' or val2['override'] == '')
@@ -139,8 +150,8 @@ class TestEnvironment(TestCase):
         self.env.set('/value', 'old value')
         self.env.set('/value', 'new value')
 
-        first_added = self.db.valsTable[-2]
-        second_added = self.db.valsTable[-1]
+        first_added, second_added = \
+            self.db.valsHistory[self._active()['id']][-2:]
 
         self.assertEqual(first_added['id'], second_added['id'])
         self.assertNotEqual(first_added['active'], second_added['active'])
@@ -294,7 +305,7 @@ class TestEnvironment(TestCase):
     def test_can_protect(self):
         self.env.set('/value1', 'abc')
         self.env.set_protect(True, '/value1', '')
-        protect = self.db.valsTable[-1]
+        protect = self._active()
         self.assertEqual('value1', protect['name'])
         self.assertTrue(protect['protect'])
 
@@ -302,14 +313,14 @@ class TestEnvironment(TestCase):
         self.env.set('/value1', 'abc')
         self.env.set_protect(True, '/value1', '')
         self.env.set_protect(False, '/value1', '')
-        unprotect = self.db.valsTable[-1]
+        unprotect = self._active()
         self.assertEqual('value1', unprotect['name'])
         self.assertFalse(unprotect['protect'])
 
     def test_can_protect_override(self):
         self.env.set('/value1', 'abc', 'test')
         self.env.set_protect(True, '/value1', 'test')
-        protect = self.db.valsTable[-1]
+        protect = self._active()
         self.assertEqual('test', protect['override'])
         self.assertTrue(protect['protect'])
 
@@ -321,17 +332,19 @@ class TestEnvironment(TestCase):
         test_env = auth_test.get_env('auto')
 
         self.env.set('/value1', 'abc')
-        before = len(self.db.valsTable)
+        history = self.db.valsHistory[self._active()['id']]
+        before = len(history)
         self.assertFalse(test_env.set_protect(True, '/value1', ''))
-        after = len(self.db.valsTable)
+        after = len(history)
         self.assertEqual(before, after)
 
     def test_protect_again_is_noop(self):
         self.env.set('/value1', 'abc')
         self.env.set_protect(True, '/value1', '')
-        before = len(self.db.valsTable)
+        history = self.db.valsHistory[self._active()['id']]
+        before = len(history)
         self.assertTrue(self.env.set_protect(True, '/value1', ''))
-        after = len(self.db.valsTable)
+        after = len(history)
         self.assertEqual(before, after)
 
     def test_protect_shows_up_in_history(self):
@@ -351,3 +364,366 @@ class TestEnvironment(TestCase):
         test_auth = self.conn.get_auth('test', '')
         test_env = test_auth.get_env('auto')
         self.assertEqual((None, None), test_env.get('/value1'))
+
+    def test_set_many(self):
+        self.env.set('/existing', 'old')
+        applied, results = self.env.set_many([
+            {'path': '/existing', 'value': 'new'},
+            {'path': '/parent', 'value': ''},
+            {'path': '/parent/child', 'value': 'abc', 'protect': True},
+            {'path': '/parent/child', 'override': 'cityhall', 'value': 'def'},
+            {'path': '/parent/other', 'override': 'cityhall', 'value': 'ghi'},
+        ])
+
+        self.assertTrue(applied)
+        self.assertEqual(['Ok'] * 5, [result['Response'] for result in results])
+        self.assertEqual(('new', False), self.env.get('/existing'))
+        self.assertEqual(('abc', True), self.env.get_explicit('/parent/child'))
+        self.assertEqual(('def', False), self.env.get('/parent/child'))
+        self.assertEqual(('', False), self.env.get_explicit('/parent/other'))
+        self.assertEqual(('ghi', False), self.env.get('/parent/other'))
+        self.assertEqual(
+            results[2]['id'],
+            self.env._get_index_of('/parent/child')
+        )
+
+    def test_set_many_is_all_or_nothing(self):
+        before = len(self.db.valsTable)
+        applied, results = self.env.set_many([
+            {'path': '/value1', 'value': 'abc'},
+            {'path': '/missing/child', 'value': 'abc'},
+            {'path': '/value2'},
+        ])
+
+        self.assertFalse(applied)
+        self.assertEqual(
+            ['Ok', 'Failure', 'Failure'],
+            [result['Response'] for result in results]
+        )
+        self.assertEqual(before, len(self.db.valsTable))
+
+    def test_set_many_fails_if_a_target_is_deleted(self):
+        self.env.set('/value1', 'abc')
+        self.env.set('/value2', 'abc')
+        db = self.env.db
+        set_many = db.set_many
+
+        def delete_first(author, writes):
+            db.delete(author, self.env._get_index_of('/value2'))
+            return set_many(author, writes)
+
+        with mock.patch.object(db, 'set_many', delete_first):
+            applied, results = self.env.set_many([
+                {'path': '/value1', 'value': 'def'},
+                {'path': '/value2', 'value': 'def'},
+                {'path': '/value3', 'value': 'def'},
+            ])
+
+        self.assertFalse(applied)
+        self.assertEqual(
+            ['Ok', 'Failure', 'Ok'],
+            [result['Response'] for result in results]
+        )
+        self.assertEqual(('abc', False), self.env.get('/value1'))
+        self.assertEqual((None, None), self.env.get('/value3'))
+
+    def test_set_many_requires_write_permissions(self):
+        auth = self.conn.get_auth('cityhall', '')
+        auth.create_user('test', '')
+        auth.grant('auto', 'test', Rights.Read)
+        test_env = self.conn.get_auth('test', '').get_env('auto')
+
+        applied, results = test_env.set_many([{'path': '/value1', 'value': 'a'}])
+        self.assertFalse(applied)
+        self.assertEqual((None, None), test_env.get('/value1'))
+
+    def test_get_children_page(self):
+        for name in ['e', 'c', 'a', 'd', 'b']:
+            self.env.set(f'/{name}', name)
+        self.env.set('/b', 'b2', 'cityhall')
+
+        pages = []
+        children, cursor = self.env.get_children_page('/', None, 2, ['name', 'override'])
+        pages.append(children)
+        while cursor:
+            children, cursor = self.env.get_children_page('/', cursor, 2, ['name', 'override'])
+            pages.append(children)
+
+        self.assertEqual(
+            [[('a', ''), ('b', '')], [('b', 'cityhall'), ('c', '')],
+             [('d', ''), ('e', '')]],
+            [[(child['name'], child['override']) for child in page]
+             for page in pages]
+        )
+
+    def test_path_cache_is_shared(self):
+        self.env.set('/parent', '')
+        self.env.set('/parent/child', 'abc')
+        other = self.conn.get_auth('cityhall', '').get_env('test_env')
+        self.assertIs(self.env.cache, other.cache)
+
+        index = self.env._get_index_of('/parent/child')
+        with mock.patch.object(self.db.get_db().__class__, 'get_path_index') as lookup:
+            self.assertEqual(index, other._get_index_of('/parent/child'))
+        lookup.assert_not_called()
+
+    def test_delete_invalidates_path_cache(self):
+        self.env.set('/parent', '')
+        self.env.set('/parent', 'x', 'cityhall')
+        self.env.set('/parent/child', 'abc')
+        self.env.set('/parents', '')
+        for path, override in [
+                ('/parent', None), ('/parent', 'cityhall'),
+                ('/parent/child', None), ('/parents', None)]:
+            self.env._get_index_of(path, override)
+
+        self.env.delete('/parent')
+
+        self.assertEqual(['/parents/:'], list(self.env.cache.values))
+        self.assertEqual(-1, self.env._get_index_of('/parent/child'))
+
+    def test_repeated_misses_dont_query(self):
+        self.env.set('/parent', '')
+        self.assertEqual((None, None), self.env.get('/parent/missing'))
+        self.assertEqual((None, None), self.env.get_explicit('/parent/missing'))
+        self.assertEqual(-1, self.env._get_index_of('/parent/missing', 'x'))
+
+        db_class = self.db.get_db().__class__
+        with mock.patch.object(db_class, 'get_value_by_path') as by_path, \
+                mock.patch.object(db_class, 'get_path_index') as path_index, \
+                mock.patch.object(db_class, 'get_children_of') as children:
+            self.assertEqual((None, None), self.env.get('/parent/missing'))
+            self.assertEqual(
+                (None, None), self.env.get_explicit('/parent/missing')
+            )
+            self.assertEqual(-1, self.env._get_index_of('/parent/missing', 'x'))
+        by_path.assert_not_called()
+        path_index.assert_not_called()
+        children.assert_not_called()
+
+    def test_set_invalidates_missing(self):
+        self.env.set('/value1', 'abc')
+        other = self.conn.get_auth('cityhall', '').get_env('test_env')
+        self.assertEqual((None, None), other.get('/value2'))
+        self.assertEqual(-1, other._get_index_of('/value2', 'cityhall'))
+
+        self.env.set('/value2', 'def', 'cityhall')
+        self.assertEqual(('def', False), other.get('/value2'))
+        self.assertLess(0, other._get_index_of('/value2', 'cityhall'))
+
+        self.assertEqual((None, None), other.get('/value3'))
+        self.env.set_many([{'path': '/value3', 'value': 'ghi'}])
+        self.assertEqual(('ghi', False), other.get('/value3'))
+
+    def test_missing_expires(self):
+        self.assertEqual((None, None), self.env.get('/value1'))
+        self.db.get_db().create(
+            'cityhall', self.env.root_id, 'value1', 'abc'
+        )
+        self.assertEqual((None, None), self.env.get('/value1'))
+
+        with mock.patch('api.db.env.time', return_value=time() + 60):
+            self.assertEqual(('abc', False), self.env.get('/value1'))
+
+    def test_cached_paths_expire(self):
+        self.env.set('/value1', 'abc')
+        old_index = self.env._get_index_of('/value1')
+        db = self.db.get_db()
+        db.delete('cityhall', old_index)
+        new_index = db.create('cityhall', self.env.root_id, 'value1', 'def')
+        self.assertEqual(old_index, self.env._get_index_of('/value1'))
+
+        with mock.patch('api.db.env.time', return_value=time() + 120):
+            self.assertEqual(new_index, self.env._get_index_of('/value1'))
+
+    def test_hot_values_dont_query(self):
+        self.env.set('/parent', '')
+        self.env.set('/parent/value1', 'abc')
+        self.env.set('/parent/value1', 'def', 'cityhall')
+        self.assertEqual(('def', False), self.env.get('/parent/value1'))
+        self.assertEqual(('abc', False), self.env.get_explicit('/parent/value1'))
+
+        db_class = self.db.get_db().__class__
+        with mock.patch.object(db_class, 'get_value_by_path') as by_path, \
+                mock.patch.object(db_class, 'get_value') as value:
+            self.assertEqual(('def', False), self.env.get('/parent/value1'))
+            self.assertEqual(
+                ('abc', False), self.env.get_explicit('/parent/value1')
+            )
+        by_path.assert_not_called()
+        value.assert_not_called()
+
+    def test_writes_invalidate_values(self):
+        self.env.set('/value1', 'abc')
+        other = self.conn.get_auth('cityhall', '').get_env('test_env')
+        self.assertIs(self.env.resolved, other.resolved)
+        self.assertEqual(('abc', False), other.get('/value1'))
+
+        self.env.set('/value1', 'def')
+        self.assertEqual(('def', False), other.get('/value1'))
+        self.env.set_protect(True, '/value1', None)
+        self.assertEqual(('def', True), other.get_explicit('/value1'))
+        self.env.set_many([{'path': '/value1', 'value': 'ghi'}])
+        self.assertEqual(('ghi', True), other.get('/value1'))
+        self.env.delete('/value1')
+        self.assertEqual((None, None), other.get('/value1'))
+
+    def test_cached_values_honor_permissions(self):
+        self.env.set('/value1', 'abc')
+        self.env.set_protect(True, '/value1', None)
+        self.assertEqual(('abc', True), self.env.get('/value1'))
+
+        self.auth.create_user('test', '')
+        self.auth.grant('test_env', 'test', Rights.Read)
+        test_env = self.conn.get_auth('test', '').get_env('test_env')
+        self.assertEqual((None, None), test_env.get('/value1'))
+
+    def test_path_cache_is_not_in_session(self):
+        self.env.set('/value1', 'abc')
+        self.env._get_index_of('/value1')
+
+        auth_state = serialize_auth(self.auth)
+        self.assertNotIn('/value1/:', json.dumps(auth_state))
+        restored = deserialize_auth(auth_state).get_env('test_env')
+        self.assertIs(
+            Instance.db_connection.get_env_cache('path', self.env.root_id),
+            restored.cache
+        )
+
+    def test_session_envs_are_decoded_lazily(self):
+        self.auth.create_env('other_env')
+        self.auth.get_env('other_env')
+        auth_state = serialize_auth(self.auth)
+
+        restored = deserialize_auth(auth_state)
+        for env in ['test_env', 'other_env']:
+            self.assertIsInstance(restored.roots_cache.values[env], SerializedEnv)
+
+        self.assertEqual(Rights.Grant, restored.get_permissions('test_env'))
+        self.assertIsInstance(restored.roots_cache.values['test_env'], Env)
+        self.assertIsInstance(
+            restored.roots_cache.values['other_env'], SerializedEnv
+        )
+        self.assertFalse(restored.dirty)
+        self.assertEqual(auth_state, serialize_auth(restored))
+
+    def test_envs_are_packed(self):
+        for root_id, permissions in [
+                (0, Rights.DontExist), (12345, Rights.Grant),
+                (-1, Rights.DontExist), (7, 99)]:
+            packed = pack_env(root_id, permissions)
+            self.assertEqual((root_id, permissions), unpack_env(packed))
+        self.assertIsInstance(pack_env(12345, Rights.Grant), int)
+
+    def test_old_session_format_is_read(self):
+        self.auth.users_env = 5
+        old = json.dumps({
+            'name': self.auth.name,
+            'user_root': self.auth.user_root,
+            'users_env': self.auth.users_env,
+            'roots_cache': {
+                'test_env': json.dumps({
+                    'env': self.env.env,
+                    'permissions': self.env.permissions,
+                    'name': self.env.name,
+                    'root_id': self.env.root_id,
+                }),
+            },
+        })
+
+        restored = deserialize_auth(old)
+        self.assertTrue(restored.dirty)
+        self.assertEqual(Rights.Grant, restored.get_permissions('test_env'))
+        self.assertEqual(self.env.root_id, restored.get_env('test_env').root_id)
+        self.assertEqual(serialize_auth(self.auth), serialize_auth(restored))
+
+    def test_get_history_page(self):
+        for value in ['a', 'b', 'c', 'd', 'e']:
+            self.env.set('/value1', value)
+
+        pages = []
+        history, cursor = self.env.get_history_page('/value1', limit=2)
+        pages.append(history)
+        while cursor:
+            history, cursor = self.env.get_history_page(
+                '/value1', after=cursor, limit=2
+            )
+            pages.append(history)
+
+        self.assertEqual(
+            [['a', 'b'], ['c', 'd'], ['e']],
+            [[version['value'] for version in page] for page in pages]
+        )
+
+    def test_get_history_page_between_times(self):
+        self.env.set('/value1', 'a')
+        self.env.set('/value1', 'b')
+        self.env.set('/value1', 'c')
+        times = [version['datetime'] for version in self.env.get_history('/value1')]
+
+        history, cursor = self.env.get_history_page(
+            '/value1', since=times[1], until=times[2]
+        )
+        self.assertEqual(['b'], [version['value'] for version in history])
+        self.assertIsNone(cursor)
+
+        # aware datetimes, as parsed from a request, work as well
+        history, cursor = self.env.get_history_page(
+            '/value1', since=times[1].astimezone()
+        )
+        self.assertEqual(['b', 'c'], [version['value'] for version in history])
+
+    def test_get_children_page_fields(self):
+        self.env.set('/parent', '')
+        self.env.set('/parent/child', 'abc')
+
+        children, cursor = self.env.get_children_page('/parent', fields=['path', 'value'])
+        self.assertEqual([{'path': '/parent/child/', 'value': 'abc'}], children)
+        self.assertIsNone(cursor)
+
+    def test_get_children_page_honors_protect(self):
+        self.env.set('/value1', 'abc')
+        self.env.set('/value2', 'def')
+        self.env.set_protect(True, '/value1', '')
+        auth = self.conn.get_auth('cityhall', '')
+        auth.create_user('test', '')
+        auth.grant('test_env', 'test', Rights.Read)
+        test_env = self.conn.get_auth('test', '').get_env('test_env')
+
+        children, cursor = test_env.get_children_page('/', limit=1, fields=['name'])
+        self.assertEqual([{'name': 'value2'}], children)
+        self.assertIsNone(cursor)
+
+    def test_get_tree(self):
+        self.env.set('/a', '1')
+        self.env.set('/a/b', '2')
+        self.env.set('/a/b', '3', 'cityhall')
+        self.env.set('/a/b/c', '4')
+        self.env.set('/d', '5')
+
+        tree = self.env.get_tree('/')
+        self.assertEqual(['a', 'd'], [node['name'] for node in tree])
+        a = tree[0]
+        self.assertEqual(
+            [('b', '', '2'), ('b', 'cityhall', '3')],
+            [(n['name'], n['override'], n['value']) for n in a['children']]
+        )
+        self.assertNotIn('children', a['children'][1])
+        self.assertEqual('/a/b/c/', a['children'][0]['children'][0]['path'])
+
+        tree = self.env.get_tree('/a', 1)
+        self.assertEqual(2, len(tree))
+        self.assertNotIn('children', tree[0])
+
+    def test_get_tree_honors_protect(self):
+        self.env.set('/a', '1')
+        self.env.set('/a/b', '2')
+        self.env.set('/c', '3')
+        self.env.set_protect(True, '/a', '')
+        auth = self.conn.get_auth('cityhall', '')
+        auth.create_user('test', '')
+        auth.grant('test_env', 'test', Rights.Read)
+        test_env = self.conn.get_auth('test', '').get_env('test_env')
+
+        self.assertEqual(['c'], [node['name'] for node in test_env.get_tree('/')])
+        self.assertEqual(2, len(self.env.get_tree('/')))
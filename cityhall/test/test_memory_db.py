@@ -12,9 +12,18 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from sys import intern
+from threading import Barrier, Thread
 from django.test import TestCase
 from api.db import DbState, Rights
+from api.db.compactor import HistoryCompactor
 from api.db.memory.db_factory import CityHallDbFactory
+from api.db.memory.rows import ValueRow, AuthRow
+from api.db.connection import Connection
 from django.conf import settings
 
 
@@ -38,11 +47,12 @@ class TestMemoryDb(TestCase):
         db.open()
         db.create_default_tables()
         self.assertIsInstance(db.authTable, list)
-        self.assertIsInstance(db.valsTable, list)
-        self.assertEqual(1, len(db.authTable))
+        self.assertIsInstance(db.valsTable, dict)
+        self.assertIsInstance(db.valsHistory, dict)
         self.assertEqual(1, len(db.authTable))
+        self.assertEqual(6, len(db.valsTable))
         self.assertIsInstance(db.authTable[0], dict)
-        self.assertIsInstance(db.valsTable[0], dict)
+        self.assertIsInstance(db.valsTable[1], dict)
 
     def test_is_open(self):
         db = CityHallDbFactory(cityhall_settings)
@@ -129,9 +139,9 @@ class TestMemoryDbWithEnv(TestCase):
         self.assertEqual(auth_before, len(self.conn.authTable))
 
     def test_create_root_is_complete(self):
-        self.conn.get_db().create_root('cityhall', 'dev')
+        root_id = self.conn.get_db().create_root('cityhall', 'dev')
 
-        val = self.conn.valsTable[-1]
+        val = self.conn.valsTable[root_id]
         self.assertEqual('dev', val['name'])
         self.assertEqual(val['id'], val['parent'])
         self.assertEqual('', val['value'])
@@ -143,21 +153,32 @@ class TestMemoryDbWithEnv(TestCase):
     def test_get_env_root_on_nonexistant(self):
         self.assertEqual(-1, self.conn.get_db().get_env_root('dev'))
 
+    def test_env_roots_are_indexed(self):
+        db = self.conn.get_db()
+        root_id = db.create_root('cityhall', 'dev')
+        db.update('cityhall', root_id, 'new value')
+
+        self.assertEqual(
+            {'auto': 1, 'users': 2, 'dev': root_id}, self.conn.rootsByName
+        )
+
     def test_get_env_root_on_existant(self):
         db = self.conn.get_db()
-        db.create_root('cityhall', 'dev')
-        val = self.conn.valsTable[-1]
+        root_id = db.create_root('cityhall', 'dev')
+        val = self.conn.valsTable[root_id]
         self.assertEqual(val['id'], db.get_env_root('dev'))
 
 
 class TestMemoryDbWithEnvAndUser(TestCase):
+    settings = cityhall_settings
+
     def __init__(self, obj):
         super(TestCase, self).__init__(obj)
         self.conn = None
         self.db = None
 
     def setUp(self):
-        self.conn = CityHallDbFactory(cityhall_settings)
+        self.conn = CityHallDbFactory(self.settings)
         self.conn.open()
         self.conn.create_default_tables()
         self.db = self.conn.get_db()
@@ -190,9 +211,9 @@ class TestMemoryDbWithEnvAndUser(TestCase):
     def test_create_value(self):
         dev_root = self.db.get_env_root('dev')
         before = len(self.conn.valsTable)
-        self.db.create('test', dev_root, 'value1', 'some value')
+        val_id = self.db.create('test', dev_root, 'value1', 'some value')
         after = len(self.conn.valsTable)
-        val = self.conn.valsTable[-1]
+        val = self.conn.valsTable[val_id]
 
         self.assertEqual(before+1, after)
         self.assertTrue(val['active'])
@@ -211,17 +232,38 @@ class TestMemoryDbWithEnvAndUser(TestCase):
         self.assertEqual('value1', children[0]['name'])
         self.assertEqual('some value', children[0]['value'])
 
+    def test_get_path_index(self):
+        dev_root = self.db.get_env_root('dev')
+        first = self.db.create('test', dev_root, 'first', '')
+        second = self.db.create('test', first, 'second', '')
+        override = self.db.create('test', first, 'second', '', 'me')
+
+        self.assertEqual(
+            second, self.db.get_path_index(dev_root, ['first', 'second'])
+        )
+        self.assertEqual(
+            override,
+            self.db.get_path_index(dev_root, ['first', 'second'], 'me')
+        )
+        self.assertEqual(-1, self.db.get_path_index(dev_root, ['second']))
+        self.assertEqual(
+            -1, self.db.get_path_index(dev_root, ['first', 'x', 'y'])
+        )
+
     def test_update(self):
         dev_root = self.db.get_env_root('dev')
-        self.db.create('test', dev_root, 'value1', 'some value')
+        val_id = self.db.create('test', dev_root, 'value1', 'some value')
 
-        original_value = self.conn.valsTable[-1]
+        original_value = self.conn.valsTable[val_id]
         before = len(self.conn.valsTable)
         self.db.update('test', original_value['id'], 'another value')
         after = len(self.conn.valsTable)
-        new_value = self.conn.valsTable[-1]
+        new_value = self.conn.valsTable[val_id]
 
-        self.assertEqual(before+1, after)
+        self.assertEqual(before, after)
+        self.assertEqual(
+            [original_value, new_value], self.conn.valsHistory[val_id]
+        )
         self.assertEqual(original_value['id'], new_value['id'])
         self.assertFalse(original_value['active'])
         self.assertTrue(new_value['id'])
@@ -230,13 +272,13 @@ class TestMemoryDbWithEnvAndUser(TestCase):
 
     def test_create_override(self):
         dev_root = self.db.get_env_root('dev')
-        self.db.create('test', dev_root, 'value1', 'some value')
+        val_id = self.db.create('test', dev_root, 'value1', 'some value')
 
-        original_value = self.conn.valsTable[-1]
+        original_value = self.conn.valsTable[val_id]
         before = len(self.conn.valsTable)
-        self.db.create('test', dev_root, 'value1', 'test value', 'test')
+        new_id = self.db.create('test', dev_root, 'value1', 'test value', 'test')
         after = len(self.conn.valsTable)
-        new_value = self.conn.valsTable[before]
+        new_value = self.conn.valsTable[new_id]
 
         self.assertEqual(before+1, after)
         self.assertNotEqual(original_value['id'], new_value['id'])
@@ -246,8 +288,8 @@ class TestMemoryDbWithEnvAndUser(TestCase):
 
     def test_get_value(self):
         dev_root = self.db.get_env_root('dev')
-        self.db.create('test', dev_root, 'value1', 'some value')
-        item_in_db = self.conn.valsTable[-1]
+        val_id = self.db.create('test', dev_root, 'value1', 'some value')
+        item_in_db = self.conn.valsTable[val_id]
 
         val_from_db = self.db.get_value(item_in_db['id'])
         self.assertEqual('some value', val_from_db[0])
@@ -260,26 +302,27 @@ class TestMemoryDbWithEnvAndUser(TestCase):
 
     def test_delete(self):
         dev_root = self.db.get_env_root('dev')
-        self.db.create('test', dev_root, 'value1', 'abc')
+        val_id = self.db.create('test', dev_root, 'value1', 'abc')
         before = len(self.conn.valsTable)
-        val_id = self.conn.valsTable[-1]['id']
         self.db.delete('test', val_id)
         after = len(self.conn.valsTable)
-        entry = self.conn.valsTable[-1]
+        entry = self.conn.valsHistory[val_id][-1]
 
-        self.assertEqual(before+1, after)
+        self.assertEqual(before-1, after)
+        self.assertNotIn(val_id, self.conn.valsTable)
+        self.assertEqual(2, len(self.conn.valsHistory[val_id]))
         self.assertFalse(entry['active'])
         self.assertTrue(entry['first_last'])
 
     def test_protect(self):
         dev_root = self.db.get_env_root('dev')
-        self.db.create('test', dev_root, 'value1', 'some value')
+        val_id = self.db.create('test', dev_root, 'value1', 'some value')
 
-        before = len(self.conn.valsTable)
-        created = self.conn.valsTable[-1]
+        before = len(self.conn.valsHistory[val_id])
+        created = self.conn.valsTable[val_id]
         self.db.set_protect_status('dev', created['id'], True)
-        after = len(self.conn.valsTable)
-        updated = self.conn.valsTable[-1]
+        after = len(self.conn.valsHistory[val_id])
+        updated = self.conn.valsTable[val_id]
 
         self.assertEqual(before+1, after)
         self.assertEqual(created['id'], updated['id'])
@@ -292,14 +335,13 @@ class TestMemoryDbWithEnvAndUser(TestCase):
 
     def test_unprotect(self):
         dev_root = self.db.get_env_root('dev')
-        self.db.create('test', dev_root, 'value1', 'some value')
-        val_id = self.conn.valsTable[-1]['id']
+        val_id = self.db.create('test', dev_root, 'value1', 'some value')
         self.db.set_protect_status('dev', val_id, True)
 
-        before = len(self.conn.valsTable)
+        before = len(self.conn.valsHistory[val_id])
         self.db.set_protect_status('dev', val_id, False)
-        after = len(self.conn.valsTable)
-        public = self.conn.valsTable[-1]
+        after = len(self.conn.valsHistory[val_id])
+        public = self.conn.valsTable[val_id]
 
         self.assertEqual(before+1, after)
         self.assertFalse(public['protect'])
@@ -346,3 +388,418 @@ class TestMemoryDbWithEnvAndUser(TestCase):
         self.assertFalse(entries[0]['active'])
         self.assertTrue(entries[1]['active'])
         self.assertEqual('password', entries[1]['pass'])
+
+    def test_auth_index_follows_users(self):
+        self.db.update_user('cityhall', 'test', 'password')
+        self.assertIs(self.conn.authTable[-1], self.conn.authByUser['test'])
+        self.assertFalse(self.conn.authenticate('test', ''))
+        self.assertTrue(self.conn.authenticate('test', 'password'))
+
+        self.db.delete_user('cityhall', 'test')
+        self.assertNotIn('test', self.conn.authByUser)
+        self.assertFalse(self.conn.authenticate('test', 'password'))
+        self.assertFalse(self.db.update_user('cityhall', 'test', ''))
+
+        user_folder = self.db.get_child(self.users_root, 'test')
+        self.db.create_user('cityhall', 'test', '', user_folder['id'])
+        self.assertTrue(self.conn.authenticate('test', ''))
+
+    def test_indexes_follow_update(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', 'abc')
+        self.db.update('test', val_id, 'def')
+
+        self.assertEqual(('def', False), self.db.get_value(val_id))
+        self.assertEqual('def', self.db.get_child(dev_root, 'value1')['value'])
+        self.assertEqual(
+            ('def', False),
+            self.db.get_value_for(dev_root, 'value1', 'test')
+        )
+        self.assertEqual(1, len(self.db.get_children_of(dev_root)))
+
+    def test_update_keeps_siblings_in_place(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', 'abc')
+        siblings = self.conn.valsByParent[dev_root]
+        self.db.update('test', val_id, 'def')
+
+        self.assertIs(siblings, self.conn.valsByParent[dev_root])
+        self.assertEqual('def', siblings[val_id]['value'])
+
+        self.db.create('test', dev_root, 'value2', 'ghi')
+        self.assertIsNot(siblings, self.conn.valsByParent[dev_root])
+        self.assertEqual(1, len(siblings))
+
+    def test_indexes_follow_delete(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', 'abc')
+        override_id = self.db.create('test', dev_root, 'value1', 'def', 'test')
+        self.db.delete('test', override_id)
+
+        self.assertEqual((None, None), self.db.get_value(override_id))
+        self.assertIsNone(self.db.get_child(dev_root, 'value1', 'test'))
+        self.assertEqual(
+            ('abc', False),
+            self.db.get_value_for(dev_root, 'value1', 'test')
+        )
+
+        self.db.delete('test', val_id)
+        self.assertEqual([], self.db.get_children_of(dev_root))
+        self.assertEqual(
+            (None, None),
+            self.db.get_value_for(dev_root, 'value1', 'test')
+        )
+
+    def test_index_values_rebuilds_from_table(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', 'abc')
+        self.db.update('test', val_id, 'def')
+        next_id = self.conn.nextValId
+
+        self.conn.index_values()
+        self.assertEqual(next_id, self.conn.nextValId)
+        self.assertEqual(('def', False), self.db.get_value(val_id))
+        self.assertEqual(1, len(self.db.get_children_of(dev_root)))
+
+    def test_history_is_kept_per_id(self):
+        dev_root = self.db.get_env_root('dev')
+        parent_id = self.db.create('test', dev_root, 'parent', '')
+        child_id = self.db.create('test', parent_id, 'child', 'abc')
+        self.db.update('test', child_id, 'def')
+        self.db.delete('test', child_id)
+
+        child_history = self.db.get_history(child_id)
+        parent_history = self.db.get_history(parent_id)
+
+        self.assertEqual(
+            ['abc', 'def', 'def'], [val['value'] for val in child_history]
+        )
+        self.assertEqual(
+            [(parent_id, True), (child_id, True), (child_id, True)],
+            [(val['id'], val['first_last']) for val in parent_history]
+        )
+        self.assertFalse(any(val['active'] for val in child_history))
+
+    def test_active_state_does_not_grow_with_edits(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', '0')
+        before = len(self.conn.valsTable)
+
+        for i in range(1, 100):
+            self.db.update('test', val_id, str(i))
+
+        self.assertEqual(before, len(self.conn.valsTable))
+        self.assertEqual(100, len(self.db.get_history(val_id)))
+        self.assertEqual(('99', False), self.db.get_value(val_id))
+
+    def test_compact_history_keeps_newest_versions(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', '0')
+        for i in range(1, 10):
+            self.db.update('test', val_id, str(i))
+
+        pruned = self.db.compact_history(3, None, 1000)
+
+        self.assertEqual(7, pruned)
+        self.assertEqual(
+            ['7', '8', '9'],
+            [val['value'] for val in self.db.get_history(val_id)]
+        )
+        self.assertEqual(('9', False), self.db.get_value(val_id))
+        self.assertEqual(0, self.db.compact_history(3, None, 1000))
+
+    def test_compact_history_cleans_parent_history(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', '0')
+        self.db.delete('test', val_id)
+
+        pruned = self.db.compact_history(1, None, 1000)
+
+        self.assertEqual(1, pruned)
+        self.assertEqual(
+            [False], [val['active'] for val in self.db.get_history(val_id)]
+        )
+        self.assertEqual(
+            [dev_root, val_id],
+            [val['id'] for val in self.db.get_history(dev_root)]
+        )
+        self.assertEqual(val_id + 1, self.conn.nextValId)
+
+    def test_compact_history_by_age_runs_in_batches(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', '0')
+        for i in range(1, 5):
+            self.db.update('test', val_id, str(i))
+        for val in self.conn.valsHistory[val_id][:-1]:
+            val['datetime'] = datetime.now() - timedelta(days=10)
+
+        self.assertEqual(0, self.db.compact_history(None, 30, 1000))
+        self.assertEqual(2, self.db.compact_history(None, 7, 2))
+        self.assertEqual(2, self.db.compact_history(None, 7, 2))
+        self.assertEqual(0, self.db.compact_history(None, 7, 2))
+        self.assertEqual(1, len(self.db.get_history(val_id)))
+
+    def test_compactor_runs_until_done(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', '0')
+        for i in range(1, 10):
+            self.db.update('test', val_id, str(i))
+
+        compactor = HistoryCompactor(
+            self.conn, {'keep_versions': 1, 'batch_size': 4}
+        )
+
+        self.assertEqual(9, compactor.compact())
+        self.assertEqual(9, compactor.reclaimed)
+        self.assertEqual(1, len(self.db.get_history(val_id)))
+
+
+class TestMemoryDbCompactRows(TestMemoryDbWithEnvAndUser):
+    settings = dict(cityhall_settings, memory={'compact_rows': True})
+
+    def test_rows_are_compact(self):
+        self.assertIsInstance(self.conn.valsTable[1], ValueRow)
+        self.assertIsInstance(self.conn.authTable[0], AuthRow)
+        self.assertFalse(hasattr(self.conn.valsTable[1], '__dict__'))
+
+    def test_rows_are_returned_as_dicts(self):
+        dev_root = self.db.get_env_root('dev')
+        val_id = self.db.create('test', dev_root, 'value1', 'abc')
+        child = self.db.get_child(dev_root, 'value1')
+
+        self.assertIsInstance(child, dict)
+        self.assertEqual(self.conn.valsTable[val_id].as_dict(), child)
+        self.assertIsInstance(self.db.get_children_of(dev_root)[0], dict)
+        self.assertIsInstance(self.db.get_history(val_id)[0], dict)
+
+    def test_strings_are_interned(self):
+        dev_root = self.db.get_env_root('dev')
+        name = ''.join(['val', 'ue1'])
+        author = ''.join(['te', 'st'])
+        val_id = self.db.create(author, dev_root, name, 'abc')
+        stored = self.conn.valsTable[val_id]
+
+        self.assertIs(intern('value1'), stored['name'])
+        self.assertIs(intern('test'), stored['author'])
+
+
+class TestMemoryDbJournal(TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = os.path.join(self.dir.name, 'cityhall.journal')
+        self.settings = dict(
+            cityhall_settings,
+            memory={'journal': self.journal, 'snapshot_every': 1000},
+        )
+        self.conn = self._open()
+        self.conn.create_default_tables()
+        self.db = self.conn.get_db()
+
+    def tearDown(self):
+        self.conn.journal.close()
+        self.dir.cleanup()
+
+    def _open(self):
+        conn = CityHallDbFactory(self.settings)
+        conn.open()
+        return conn
+
+    def _restart(self):
+        self.conn.journal.close()
+        self.conn = self._open()
+        self.db = self.conn.get_db()
+
+    def _populate(self):
+        dev_root = self.db.create_root('cityhall', 'dev')
+        val_id = self.db.create('cityhall', dev_root, 'value1', 'abc')
+        self.db.update('cityhall', val_id, 'def')
+        self.db.set_protect_status('cityhall', val_id, True)
+        deleted_id = self.db.create('cityhall', dev_root, 'value2', 'abc')
+        self.db.delete('cityhall', deleted_id)
+
+        users_root = self.db.get_env_root('users')
+        user_root = self.db.create('cityhall', users_root, 'test', '')
+        self.db.create_user('cityhall', 'test', '', user_root)
+        self.db.update_user('cityhall', 'test', 'password')
+        return dev_root, val_id, deleted_id
+
+    def _check_restored(self, dev_root, val_id, deleted_id):
+        self.assertTrue(self.conn.restored)
+        self.assertEqual(dev_root, self.db.get_env_root('dev'))
+        self.assertEqual(('def', True), self.db.get_value(val_id))
+        self.assertEqual((None, None), self.db.get_value(deleted_id))
+        self.assertEqual(3, len(self.db.get_history(val_id)))
+        self.assertEqual(1, len(self.db.get_children_of(dev_root)))
+        self.assertFalse(self.conn.authenticate('test', ''))
+        self.assertTrue(self.conn.authenticate('test', 'password'))
+        self.assertEqual(deleted_id + 2, self.conn.nextValId)
+
+    def test_nothing_to_restore(self):
+        self.assertFalse(CityHallDbFactory(self.settings).restored)
+        self.assertEqual(('', False), self.db.get_value(1))
+
+    def test_restore_from_journal(self):
+        state = self._populate()
+        self._restart()
+        self._check_restored(*state)
+
+    def test_restore_from_snapshot_and_journal_tail(self):
+        self.conn.journal.snapshot_every = 5
+        state = self._populate()
+        self.assertTrue(os.path.exists(self.journal + '.snapshot'))
+        self.assertLess(self.conn.journal.entries, 5)
+
+        self._restart()
+        self._check_restored(*state)
+
+    def test_create_default_tables_keeps_restored_state(self):
+        state = self._populate()
+        self._restart()
+        self.conn.create_default_tables()
+        self._check_restored(*state)
+
+    def test_torn_write_is_ignored(self):
+        state = self._populate()
+        with open(self.journal, 'a') as journal:
+            journal.write('{"seq": 1000, "table": "va')
+
+        self._restart()
+        self._check_restored(*state)
+
+        dev_root = self.db.get_env_root('dev')
+        created = self.db.create('cityhall', dev_root, 'value3', 'ghi')
+        self._restart()
+        self.assertEqual(('ghi', False), self.db.get_value(created))
+
+    def test_snapshot_of_compact_rows(self):
+        self.conn.journal.close()
+        self.settings['memory']['compact_rows'] = True
+        self.conn = self._open()
+        self.db = self.conn.get_db()
+        self.conn.journal.snapshot_every = 5
+
+        state = self._populate()
+        self._restart()
+        self._check_restored(*state)
+        self.assertIsInstance(self.conn.valsTable[state[1]], ValueRow)
+
+
+class TestMemoryDbThreads(TestCase):
+    THREADS = 8
+    ITERATIONS = 200
+    SHARED = 5
+    NEW = 50
+
+    def setUp(self):
+        self.conn = Connection(CityHallDbFactory(cityhall_settings))
+        self.conn.connect()
+        self.conn.create_default_env()
+        self.db = self.conn.db_connection
+
+        auth = self.conn.get_auth('cityhall', '')
+        auth.create_env('stress')
+        env = auth.get_env('stress')
+        for i in range(self.SHARED):
+            env.set(f'/shared{i}', 'start')
+
+        self.errors = []
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def _hammer(self, thread):
+        try:
+            env = self.conn.get_auth('cityhall', '').get_env('stress')
+            env.set(f'/thread{thread}', '')
+
+            for i in range(self.ITERATIONS):
+                shared = f'/shared{i % self.SHARED}'
+                env.set(shared, f'{thread}-{i}')
+                env.set(f'/thread{thread}/value{i}', str(i))
+
+                value = env.get(shared)
+                if value[0] is None:
+                    self.errors.append(f'{shared} was missing')
+                if env.get(f'/thread{thread}/value{i}') != (str(i), False):
+                    self.errors.append(f'/thread{thread}/value{i} was wrong')
+                env.get_children('/')
+        except Exception as ex:
+            self.errors.append(repr(ex))
+
+    def test_concurrent_set_and_get(self):
+        threads = [
+            Thread(target=self._hammer, args=(i,))
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], self.errors)
+
+        for val_id, history in self.db.valsHistory.items():
+            versions = [val for val in history if val['id'] == val_id]
+            active = [val for val in versions if val['active']]
+
+            if val_id in self.db.valsTable:
+                self.assertEqual([versions[-1]], active)
+                self.assertIs(versions[-1], self.db.valsTable[val_id])
+            else:
+                self.assertEqual([], active)
+
+        for val in self.db.valsTable.values():
+            if val['id'] != val['parent']:
+                key = (val['parent'], val['name'], val['override'])
+                self.assertIs(val, self.db.valsByName[key])
+                self.assertIs(val, self.db.valsByParent[val['parent']][val['id']])
+
+        env = self.conn.get_auth('cityhall', '').get_env('stress')
+        for i in range(self.SHARED):
+            history = env.get_history(f'/shared{i}')
+            self.assertEqual(
+                1 + self.THREADS * self.ITERATIONS // self.SHARED,
+                len(history)
+            )
+        self.assertEqual(
+            self.THREADS + self.SHARED, len(env.get_children('/'))
+        )
+
+    def test_concurrent_create(self):
+        # every thread creates the same new paths, which were not there
+        # when any of them looked
+        start = Barrier(self.THREADS)
+
+        def create(thread):
+            try:
+                env = self.conn.get_auth('cityhall', '').get_env('stress')
+                for i in range(self.NEW):
+                    start.wait()
+                    env.set(f'/new{i}', str(thread), 'cityhall')
+            except Exception as ex:
+                self.errors.append(repr(ex))
+
+        threads = [
+            Thread(target=create, args=(i,)) for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], self.errors)
+        root = self.db.get_db().get_env_root('stress')
+        for i in range(self.NEW):
+            for override in ['', 'cityhall']:
+                created = [
+                    val for val in self.db.valsByParent[root].values()
+                    if (val['name'], val['override']) == (f'new{i}', override)
+                ]
+                self.assertEqual(1, len(created))
+
+        env = self.conn.get_auth('cityhall', '').get_env('stress')
+        self.assertEqual(
+            self.THREADS, len(env.get_history('/new0', 'cityhall'))
+        )